@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Scans per second by ClamavPlugin for a campaign of identical messages, with
+# and without the AV verdict cache. Then for messages which only share their
+# attachment, scanning the message source compared to scanning the decoded
+# attachments (scanmode=attachments).
+#
+# usage: bench_avcache.py [messages] [distinct messages] [clamd scan time in ms]
+#
+# clamd is replaced by a local stand-in answering INSTREAM after the given scan
+# time and VERSION with a fixed signature version.
+
+import sys
+import os
+import time
+import socket
+import struct
+import tempfile
+import threading
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from configparser import RawConfigParser
+from fuglu.shared import Suspect
+from fuglu.lib.patchedemail import PatchedMIMEMultipart
+from fuglu.plugins.clamav import ClamavPlugin
+
+
+class FakeClamd(threading.Thread):
+    """clamd stand-in for one connection"""
+    received = 0
+
+    def __init__(self, sock, scantime):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+        self.scantime = scantime
+
+    def recvall(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def run(self):
+        try:
+            command = b''
+            while not command.endswith(b'\0'):
+                command += self.recvall(1)
+            if command == b'zVERSION\0':
+                self.sock.sendall(b'ClamAV 0.103.8/26902/Mon May  8 07:24:40 2023\0')
+            elif command == b'zINSTREAM\0':
+                while True:
+                    size = struct.unpack('!L', self.recvall(4))[0]
+                    if not size:
+                        break
+                    self.recvall(size)
+                    FakeClamd.received += size
+                time.sleep(self.scantime)
+                self.sock.sendall(b'stream: OK\0')
+        except EOFError:
+            pass
+        self.sock.close()
+
+
+def clamd(scantime):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(50)
+
+    def serve():
+        while True:
+            FakeClamd(server.accept()[0], scantime).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def create_suspects(messages, attachment):
+    suspects = []
+    for index in range(messages):
+        msg = PatchedMIMEMultipart()
+        msg['Subject'] = 'invoice %d' % index
+        msg.attach(MIMEText('Dear customer %d, please find the invoice attached' % index))
+        part = MIMEApplication(attachment)
+        part.add_header('Content-Disposition', 'attachment', filename='invoice.pdf')
+        msg.attach(part)
+        handle, filename = tempfile.mkstemp(prefix='fuglu-bench-avcache')
+        with os.fdopen(handle, 'wb') as fh:
+            fh.write(msg.as_bytes())
+        suspect = Suspect('sender@fuglu.org', 'recipient@fuglu.org', filename)
+        # the MIME parts are usually parsed already by other plugins (attachment, archive)
+        suspect.att_mgr.get_objectlist()
+        suspects.append(suspect)
+    return suspects
+
+
+def run_suspects(name, config, suspects):
+    plugin = ClamavPlugin(config)
+    FakeClamd.received = 0
+    start = time.time()
+    for suspect in suspects:
+        plugin.examine(suspect)
+    duration = time.time() - start
+    print("%-24s %.0f messages/s, %.1f MB sent to clamd" % (
+        name, len(suspects) / duration, FakeClamd.received / 1048576))
+
+
+def run(name, config, messages, contents):
+    plugin = ClamavPlugin(config)
+    start = time.time()
+    for index in range(messages):
+        plugin.scan_stream_cached(contents[index % len(contents)])
+    duration = time.time() - start
+    print("%-10s %.0f scans/s" % (name, messages / duration))
+
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    scantime = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005
+    line = b'A' * 76 + b'\r\n'
+    contents = [b'Subject: newsletter %d\r\n\r\n' % i + line * 1000 for i in range(distinct)]
+
+    config = RawConfigParser()
+    config.add_section('ClamavPlugin')
+    config.set('ClamavPlugin', 'host', '127.0.0.1')
+    config.set('ClamavPlugin', 'port', str(clamd(scantime)))
+    config.set('ClamavPlugin', 'timeout', '30')
+    config.set('ClamavPlugin', 'pipelining', 'False')
+    config.set('ClamavPlugin', 'retries', '1')
+    config.set('ClamavPlugin', 'maxsize', '22000000')
+    config.set('ClamavPlugin', 'skip_on_previous_virus', 'none')
+    config.set('ClamavPlugin', 'clamscanfallback', 'False')
+    config.set('ClamavPlugin', 'problemaction', 'DEFER')
+    config.add_section('performance')
+    config.set('performance', 'avcache_ttl', '0')
+    config.set('performance', 'avcache_maxsize', '10000')
+    config.set('performance', 'avcache_redis', '')
+    config.set('performance', 'avcache_redispw', '')
+    run('uncached', config, messages, contents)
+    config.set('performance', 'avcache_ttl', '300')
+    run('cached', config, messages, contents)
+
+    suspects = create_suspects(messages // 5, os.urandom(1048576))
+    try:
+        config.set('ClamavPlugin', 'scanmode', 'message')
+        run_suspects('message, cached', config, suspects)
+        config.set('ClamavPlugin', 'scanmode', 'attachments')
+        run_suspects('attachments, cached', config, suspects)
+    finally:
+        for suspect in suspects:
+            os.remove(suspect.tempfile)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Scans per second by ClamavPlugin from several scanner threads over tcp, opening
+# a connection for every scan compared to pooled IDSESSION connections
+# (pipelining), then with the pool limited to fewer connections than threads.
+#
+# usage: bench_backendpool.py [threads] [scans per thread] [max pool size]
+#
+# clamd is replaced by a local stand-in answering INSTREAM, with or without
+# IDSESSION. The backend pool statistics are printed after each run.
+
+import sys
+import time
+import socket
+import struct
+import threading
+from configparser import RawConfigParser
+from fuglu.plugins.clamav import ClamavPlugin
+
+
+class FakeClamd(threading.Thread):
+    """clamd stand-in for one connection"""
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+
+    def recvall(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def run(self):
+        session = 0
+        try:
+            while True:
+                command = b''
+                while not command.endswith(b'\0'):
+                    command += self.recvall(1)
+                if command == b'zIDSESSION\0':
+                    session = 1
+                    continue
+                if command == b'zEND\0':
+                    break
+                while True:
+                    size = struct.unpack('!L', self.recvall(4))[0]
+                    if not size:
+                        break
+                    self.recvall(size)
+                if not session:
+                    self.sock.sendall(b'stream: OK\0')
+                    break
+                self.sock.sendall(b'%d: stream: OK\0' % session)
+                session += 1
+        except EOFError:
+            pass
+        self.sock.close()
+
+
+def clamd():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+
+    def serve():
+        while True:
+            FakeClamd(server.accept()[0]).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def run(name, config, threads, scans, content):
+    plugin = ClamavPlugin(config)
+
+    def scanner():
+        for _ in range(scans):
+            plugin.scan_stream(content)
+
+    workers = [threading.Thread(target=scanner) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+    stats = plugin._backend_pool().stats()
+    print("%-22s %6.0f scans/s, %u connections opened, %u reused, %u waits (max %.3fs)" % (
+        name, threads * scans / duration, stats['created'], stats['reused'], stats['waits'], stats['maxwaittime']))
+
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    scans = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    maxsize = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    content = b'Subject: benchmark\r\n\r\n' + b'A' * 76 * 100
+
+    port = clamd()
+    config = RawConfigParser()
+    config.add_section('ClamavPlugin')
+    config.set('ClamavPlugin', 'host', '127.0.0.1')
+    config.set('ClamavPlugin', 'timeout', '30')
+    config.add_section('performance')
+    config.set('performance', 'backendpool_maxsize', '0')
+    config.set('performance', 'backendpool_maxidle', '20')
+    config.set('performance', 'backendpool_waittimeout', '30')
+
+    # a new port per run gives a new pool with fresh statistics
+    config.set('ClamavPlugin', 'port', str(port))
+    config.set('ClamavPlugin', 'pipelining', 'False')
+    run('connection per scan', config, threads, scans, content)
+    config.set('ClamavPlugin', 'port', str(clamd()))
+    config.set('ClamavPlugin', 'pipelining', 'True')
+    run('pooled sessions', config, threads, scans, content)
+    config.set('ClamavPlugin', 'port', str(clamd()))
+    config.set('performance', 'backendpool_maxsize', str(maxsize))
+    run('pooled, max %u' % maxsize, config, threads, scans, content)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Messages per second checked by SAPlugin from several scanner threads against
+# one spamd compared to several, with leastconn and roundrobin selection, with
+# one slow spamd and with one spamd down.
+#
+# usage: bench_balancer.py [threads] [messages] [spamd hosts] [children per spamd] [scan time in ms]
+#
+# spamd is replaced by local stand-ins handling as many requests at the same
+# time as they have children, each taking the given scan time.
+
+import sys
+import time
+import socket
+import threading
+from configparser import RawConfigParser
+from fuglu.plugins.sa import SAPlugin
+
+REPLY = b'SPAMD/1.1 0 EX_OK\r\nSpam: False ; 1.0 / 5.0\r\n\r\nBAYES_00,HTML_MESSAGE'
+
+
+def spamd(children, scantime):
+    """start a spamd stand-in, returns its port"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+    slots = threading.Semaphore(children)
+
+    def handle(sock):
+        with sock:
+            while sock.recv(65536):
+                pass
+            with slots:
+                time.sleep(scantime)
+            sock.sendall(REPLY)
+
+    def serve():
+        while True:
+            threading.Thread(target=handle, args=(server.accept()[0],), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def run(name, backends, balance, threads, messages):
+    config = RawConfigParser()
+    config.add_section('SAPlugin')
+    config.set('SAPlugin', 'backends', ', '.join(backends))
+    config.set('SAPlugin', 'balance', balance)
+    config.set('SAPlugin', 'retries', '3')
+    config.set('SAPlugin', 'peruserconfig', 'False')
+    plugin = SAPlugin(config)
+    content = b'Subject: benchmark\r\n\r\n' + b'A' * 76 * 50
+    errors = []
+
+    def scanner(count):
+        for _ in range(count):
+            if plugin.safilter_symbols(content, 'benchmark') is None:
+                errors.append(1)
+
+    workers = [threading.Thread(target=scanner, args=(messages // threads,)) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+    requests = ' '.join('%u' % backend['requests'] for backend in plugin._balancer().stats())
+    print("%-28s %6.0f messages/s, %u failed, requests per spamd: %s" % (
+        name, messages // threads * threads / duration, len(errors), requests))
+
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+    hosts = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    children = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+    scantime = float(sys.argv[5]) / 1000 if len(sys.argv) > 5 else 0.02
+
+    run('1 spamd', ['127.0.0.1:%u' % spamd(children, scantime)], 'leastconn', threads, messages)
+    for balance in ('leastconn', 'roundrobin'):
+        backends = ['127.0.0.1:%u' % spamd(children, scantime) for _ in range(hosts)]
+        run('%u spamd, %s' % (hosts, balance), backends, balance, threads, messages)
+    for balance in ('leastconn', 'roundrobin'):
+        backends = ['127.0.0.1:%u' % spamd(children, scantime) for _ in range(hosts - 1)]
+        backends.append('127.0.0.1:%u' % spamd(children, scantime * 5))
+        run('%u spamd, 1 slow, %s' % (hosts, balance), backends, balance, threads, messages)
+    # nothing listens on the port of a closed socket
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    backends = ['127.0.0.1:%u' % spamd(children, scantime) for _ in range(hosts - 1)]
+    backends.append('127.0.0.1:%u' % closed.getsockname()[1])
+    run('%u spamd, 1 down' % hosts, backends, 'leastconn', threads, messages)
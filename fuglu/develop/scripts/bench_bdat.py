@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Re-inject throughput to a local SMTP sink using DATA (dot-stuffed in chunks) compared
+# to BDAT, sending the source from memory and from the tempfile using sendfile.
+#
+# usage: bench_bdat.py [message size in MB] [messages]
+#
+# The sink is included here because develop/scripts/smtpserver.py doesn't
+# advertise any ESMTP extensions.
+
+import sys
+import os
+import time
+import socket
+import tempfile
+import threading
+from fuglu.shared import Suspect
+from fuglu.connectors.smtpconnector import FUSMTPClient, StreamedMessage
+
+
+class SinkSession(threading.Thread):
+    """minimal ESMTP server discarding messages, supports DATA and BDAT"""
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+        self.buffer = b''
+
+    def readline(self):
+        while b'\r\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError()
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    def readdata(self):
+        tail = b''
+        while True:
+            data = self.buffer or self.sock.recv(1048576)
+            if not data:
+                raise EOFError()
+            self.buffer = b''
+            tail = tail[-4:] + data
+            end = tail.find(b'\r\n.\r\n')
+            if end >= 0:
+                self.buffer = tail[end + 5:]
+                return
+            tail = tail[-4:]
+
+    def readbytes(self, count):
+        count -= len(self.buffer)
+        self.buffer = b''
+        while count > 0:
+            data = self.sock.recv(min(count, 1048576))
+            if not data:
+                raise EOFError()
+            count -= len(data)
+        if count < 0:
+            raise ValueError("pipelined commands not supported")
+
+    def run(self):
+        self.sock.sendall(b'220 sink ESMTP\r\n')
+        try:
+            while True:
+                line = self.readline()
+                cmd = line[:4].upper()
+                if cmd == b'EHLO':
+                    self.sock.sendall(b'250-sink\r\n250-8BITMIME\r\n250 CHUNKING\r\n')
+                elif cmd == b'DATA':
+                    self.sock.sendall(b'354 go ahead\r\n')
+                    self.readdata()
+                    self.sock.sendall(b'250 queued\r\n')
+                elif cmd == b'BDAT':
+                    self.readbytes(int(line.split()[1]))
+                    self.sock.sendall(b'250 queued\r\n')
+                elif cmd == b'QUIT':
+                    self.sock.sendall(b'221 bye\r\n')
+                    break
+                else:
+                    self.sock.sendall(b'250 ok\r\n')
+        except EOFError:
+            pass
+        self.sock.close()
+
+
+def sink():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def serve():
+        while True:
+            SinkSession(server.accept()[0]).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def create_message(size):
+    handle, filename = tempfile.mkstemp(prefix='fuglu-bench-bdat')
+    line = b'A' * 76 + b'\r\n'
+    with os.fdopen(handle, 'wb') as fh:
+        fh.write(b'From: sender@fuglu.org\r\nTo: recipient@fuglu.org\r\nSubject: benchmark\r\n\r\n')
+        fh.write((b'.' + line) * (size // len(line) // 2))
+        fh.write(line * (size // len(line) // 2))
+    return filename
+
+
+def run(name, port, filename, messages, use_bdat, use_file):
+    start = time.time()
+    size = 0
+    for _ in range(messages):
+        suspect = Suspect('sender@fuglu.org', 'recipient@fuglu.org', filename)
+        msg = StreamedMessage.from_suspect(suspect, headers=b'X-Fuglu-Spamstatus: NO\r\n')
+        if not use_file:
+            msg.filename = None
+        client = FUSMTPClient('127.0.0.1', port)
+        client.use_bdat = use_bdat
+        client.ehlo()
+        client.sendmail(suspect.from_address, suspect.recipients, msg)
+        client.quit()
+        size += len(msg)
+        del msg
+        suspect.release_original_source()
+    duration = time.time() - start
+    print("%-16s %.1f MB/s, %.1fms per message" % (
+        name, size / duration / 1048576, 1000 * duration / messages))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    port = sink()
+    filename = create_message(size * 1048576)
+    try:
+        run('DATA', port, filename, messages, False, False)
+        run('BDAT', port, filename, messages, True, False)
+        run('BDAT sendfile', port, filename, messages, True, True)
+    finally:
+        os.remove(filename)
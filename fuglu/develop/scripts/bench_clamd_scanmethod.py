@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# CPU time used by ClamavPlugin to pass a message on disk to clamd using INSTREAM
+# compared to FILDES and SCAN over a unix socket.
+#
+# usage: bench_clamd_scanmethod.py [message size in MB] [messages]
+#
+# clamd is replaced by a local stand-in which reads the message (from the
+# stream, the passed descriptor or the path) and answers OK. Only the CPU time
+# of the thread running the plugin is counted.
+
+import sys
+import os
+import time
+import array
+import socket
+import struct
+import tempfile
+import threading
+from configparser import RawConfigParser
+from fuglu.shared import Suspect
+from fuglu.plugins.clamav import ClamavPlugin
+
+
+class FakeClamd(threading.Thread):
+    """clamd stand-in for one connection"""
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+
+    def recvall(self, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def run(self):
+        try:
+            command = b''
+            while not command.endswith(b'\0'):
+                command += self.recvall(1)
+            if command == b'zINSTREAM\0':
+                while True:
+                    size = struct.unpack('!L', self.recvall(4))[0]
+                    if not size:
+                        break
+                    self.recvall(size)
+                self.sock.sendall(b'stream: OK\0')
+            elif command == b'zFILDES\0':
+                fds = array.array('i')
+                ancdata = self.sock.recvmsg(1, socket.CMSG_LEN(fds.itemsize))[1]
+                fds.frombytes(ancdata[0][2])
+                with os.fdopen(fds[0], 'rb') as fh:
+                    fh.read()
+                self.sock.sendall(b'fd[10]: OK\0')
+            elif command.startswith(b'zSCAN '):
+                with open(command[6:-1], 'rb') as fh:
+                    fh.read()
+                self.sock.sendall(command[6:-1] + b': OK\0')
+        except EOFError:
+            pass
+        self.sock.close()
+
+
+def clamd(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(50)
+
+    def serve():
+        while True:
+            FakeClamd(server.accept()[0]).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+
+def run(scanmethod, config, filename, messages):
+    config.set('ClamavPlugin', 'scanmethod', scanmethod)
+    plugin = ClamavPlugin(config)
+    cputime = 0
+    start = time.time()
+    for _ in range(messages):
+        suspect = Suspect('sender@fuglu.org', 'recipient@fuglu.org', filename)
+        cpustart = time.thread_time()
+        plugin.examine(suspect)
+        cputime += time.thread_time() - cpustart
+    duration = time.time() - start
+    print("%-10s %.1fms cpu, %.1fms wall per message" % (
+        scanmethod, 1000 * cputime / messages, 1000 * duration / messages))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    tempdir = tempfile.mkdtemp(prefix='fuglu-bench-clamd')
+    socketpath = os.path.join(tempdir, 'clamd.sock')
+    filename = os.path.join(tempdir, 'message')
+    line = b'A' * 76 + b'\r\n'
+    with open(filename, 'wb') as fh:
+        fh.write(b'From: sender@fuglu.org\r\nTo: recipient@fuglu.org\r\nSubject: benchmark\r\n\r\n')
+        fh.write(line * (size * 1048576 // len(line)))
+    clamd(socketpath)
+
+    config = RawConfigParser()
+    config.add_section('ClamavPlugin')
+    config.set('ClamavPlugin', 'port', socketpath)
+    config.set('ClamavPlugin', 'maxsize', str((size + 1) * 1048576))
+    config.set('ClamavPlugin', 'retries', '1')
+    try:
+        for scanmethod in ('INSTREAM', 'FILDES', 'SCAN'):
+            run(scanmethod, config, filename, messages)
+    finally:
+        os.remove(filename)
+        os.remove(socketpath)
+        os.rmdir(tempdir)
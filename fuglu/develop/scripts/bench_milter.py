@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Messages per second through the milter connector with the stages negotiated
+# previously (connect, helo and data answered by fuglu) compared to the stages
+# negotiated from the plugins (no connect and helo, no reply for data).
+#
+# usage: bench_milter.py [messages per connection] [connections]
+#
+# The MTA side is a minimal milter client only waiting for the replies
+# required by the negotiated protocol flags.
+
+import sys
+import time
+import socket
+import struct
+import tempfile
+import threading
+from configparser import RawConfigParser
+import libmilter as lm
+from fuglu.connectors.milterconnector import MilterHandler
+
+
+class Plugin(object):
+    uses_clientinfo = False
+
+
+def packet(cmd, data=b''):
+    return struct.pack('!I', len(data) + 1) + cmd + data
+
+
+def readpacket(sock):
+    header = b''
+    while len(header) < 4:
+        header += sock.recv(4 - len(header))
+    size = struct.unpack('!I', header)[0]
+    data = b''
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+class MTA(object):
+    """milter client sending messages like postfix does"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.protos = 0
+
+    def negotiate(self):
+        self.sock.sendall(packet(lm.SMFIC_OPTNEG, struct.pack('!III', 6, lm.SMFIF_ALLOPTS, 0x1fffff)))
+        self.protos = struct.unpack('!III', readpacket(self.sock)[1:13])[2]
+
+    def stage(self, cmd, data, noflag, nrflag):
+        if self.protos & noflag:
+            return
+        self.sock.sendall(packet(cmd, data))
+        if not self.protos & nrflag:
+            readpacket(self.sock)
+
+    def connect(self):
+        self.stage(lm.SMFIC_CONNECT, b'mail.fuglu.org\0' + b'4' + struct.pack('!H', 25) + b'192.0.2.1\0',
+                   lm.SMFIP_NOCONNECT, lm.SMFIP_NR_CONN)
+        self.stage(lm.SMFIC_HELO, b'mail.fuglu.org\0', lm.SMFIP_NOHELO, lm.SMFIP_NR_HELO)
+
+    def message(self, body):
+        self.stage(lm.SMFIC_MAIL, b'<sender@fuglu.org>\0', lm.SMFIP_NOMAIL, lm.SMFIP_NR_MAIL)
+        self.stage(lm.SMFIC_RCPT, b'<recipient@fuglu.org>\0', lm.SMFIP_NORCPT, lm.SMFIP_NR_RCPT)
+        self.stage(lm.SMFIC_DATA, b'', lm.SMFIP_NODATA, lm.SMFIP_NR_DATA)
+        for name, value in ((b'From', b'sender@fuglu.org'), (b'To', b'recipient@fuglu.org'),
+                            (b'Subject', b'benchmark')):
+            self.stage(lm.SMFIC_HEADER, name + b'\0' + value + b'\0', lm.SMFIP_NOHDRS, lm.SMFIP_NR_HDR)
+        self.stage(lm.SMFIC_EOH, b'', lm.SMFIP_NOEOH, lm.SMFIP_NR_EOH)
+        self.stage(lm.SMFIC_BODY, body, lm.SMFIP_NOBODY, lm.SMFIP_NR_BODY)
+        self.sock.sendall(packet(lm.SMFIC_BODYEOB))
+        readpacket(self.sock)
+
+    def run(self, messages, body):
+        self.negotiate()
+        self.connect()
+        for index in range(messages):
+            if index:
+                self.sock.sendall(packet(lm.SMFIC_ABORT))
+            self.message(body)
+        self.sock.close()
+
+
+def serve(sock, config, legacy, messages):
+    handler = MilterHandler(sock, config)
+    if legacy:
+        handler.sess.protos &= ~lm.SMFIP_NR_DATA
+    else:
+        handler.set_plugins([Plugin()])
+    for _ in range(messages):
+        if handler.get_suspect() is None:
+            raise Exception("receive failed")
+        handler.sess.send(lm.CONTINUE)
+        handler.continuesession()
+    handler.endsession()
+
+
+def run(name, config, legacy, messages, connections):
+    body = b'A' * 76 + b'\r\n'
+    start = time.time()
+    for _ in range(connections):
+        server, client = socket.socketpair()
+        mta = threading.Thread(target=MTA(client).run, args=(messages, body * 40), daemon=True)
+        mta.start()
+        serve(server, config, legacy, messages)
+        mta.join()
+    duration = time.time() - start
+    print("%-12s %.0f messages/s" % (name, messages * connections / duration))
+
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    config = RawConfigParser()
+    config.add_section('main')
+    config.set('main', 'tempdir', tempfile.gettempdir())
+    config.add_section('performance')
+    config.set('performance', 'memory_spool_maxsize', '1000000')
+    run('previous', config, True, messages, connections)
+    run('negotiated', config, False, messages, connections)
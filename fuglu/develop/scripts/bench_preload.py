@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Compare start time and memory of the process backend with plugins loaded in every
+# worker (default) and plugins loaded once in the main process (preload_plugins).
+#
+# usage: bench_preload.py [processes] [plugins]
+#
+# memory is the sum of the proportional set size (Pss) of the workers, pages shared
+# copy-on-write are split between the processes
+
+import sys
+import os
+import time
+import tempfile
+import multiprocessing
+from configparser import RawConfigParser
+import fuglu.logtools as logtools
+from fuglu.core import MainController
+
+PLUGINS = 'fuglu.plugins.attachment.FiletypePlugin,fuglu.plugins.archive.ArchivePlugin,' \
+          'fuglu.plugins.domainauth.SPFPlugin,fuglu.plugins.actionoverride.ActionOverridePlugin'
+
+
+def pss(pid):
+    try:
+        with open('/proc/%u/smaps_rollup' % pid) as fp:
+            for line in fp:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return 0
+
+
+def run(preload, processes, plugins):
+    config = RawConfigParser()
+    config.add_section('main')
+    config.set('main', 'plugins', plugins)
+    config.set('main', 'prependers', '')
+    config.set('main', 'appenders', '')
+    config.set('main', 'tempdir', tempfile.gettempdir())
+    config.set('main', 'incomingport', '')
+    config.add_section('performance')
+    config.set('performance', 'backend', 'process')
+    config.set('performance', 'initialprocs', str(processes))
+    config.set('performance', 'preload_plugins', str(preload))
+    config.set('performance', 'join_timeout', '5.0')
+
+    logQueue = multiprocessing.Queue(-1)
+    logProcess = multiprocessing.Process(target=logtools.listener_process,
+                                         args=(logtools.logConfig(lint=True), logQueue))
+    logProcess.start()
+
+    mc = MainController(config, logQueue=logQueue, nolog=True)
+    mc.propagate_core_defaults()
+    mc.load_extensions()
+    if not mc.load_plugins():
+        print("failed to load plugins")
+    start = time.time()
+    mc.procpool = mc._start_processpool()
+    while True:
+        states = list(mc.procpool.shared_state.values())
+        if len(states) == processes and all(state == 'waiting for task' for state in states):
+            break
+        time.sleep(0.001)
+    duration = time.time() - start
+    memory = sum(pss(worker.pid) for worker in mc.procpool.workers)
+
+    mc.shutdown()
+    logQueue.put_nowait(None)
+    logProcess.join(5)
+    print("preload_plugins=%s: %u workers ready after %.0fms, workers Pss %.1fMB" % (
+        preload, processes, 1000 * duration, memory / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() * 2
+    plugins = sys.argv[2] if len(sys.argv) > 2 else PLUGINS
+    run(0, processes, plugins)
+    run(1, processes, plugins)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Compare the connection rate of the process backend with sockets passed through
+# the task queue (default) and worker processes binding the port with SO_REUSEPORT.
+#
+# usage: bench_reuseport.py [connections] [client threads] [processes]
+#
+# Uses the netcat protocol without plugins, so mostly connection handling is measured.
+
+import sys
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+import multiprocessing
+from configparser import RawConfigParser
+import fuglu.logtools as logtools
+from fuglu.core import MainController
+
+MESSAGE = b"Subject: benchmark\r\n\r\nreuseport benchmark\r\n"
+
+
+def nc_client(port, count, results, failed):
+    for _ in range(count):
+        start = time.time()
+        sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+        try:
+            sock.recv(1024)  # banner
+            sock.sendall(MESSAGE)
+            sock.shutdown(socket.SHUT_WR)
+            while sock.recv(4096):
+                pass
+            results.append(time.time() - start)
+        except socket.timeout:
+            failed.append(time.time() - start)
+        finally:
+            sock.close()
+
+
+def run(reuseport, port, connections, clients, processes):
+    config = RawConfigParser()
+    config.add_section('main')
+    config.set('main', 'plugins', '')
+    config.set('main', 'prependers', '')
+    config.set('main', 'appenders', '')
+    config.set('main', 'tempdir', tempfile.gettempdir())
+    config.set('main', 'incomingport', 'netcat:127.0.0.1:%u' % port)
+    config.add_section('performance')
+    config.set('performance', 'backend', 'process')
+    config.set('performance', 'initialprocs', str(processes))
+    config.set('performance', 'reuseport', str(reuseport))
+    config.set('performance', 'join_timeout', '5.0')
+
+    logQueue = multiprocessing.Queue(-1)
+    logProcess = multiprocessing.Process(target=logtools.listener_process,
+                                         args=(logtools.logConfig(lint=True), logQueue))
+    logProcess.start()
+
+    mc = MainController(config, logQueue=logQueue, nolog=True)
+    mc.propagate_core_defaults()
+    mc.procpool = mc._start_processpool()
+    if not mc._listen_in_workers():
+        mc._start_connectors()
+    time.sleep(2)  # let the workers start
+
+    results = []
+    failed = []
+    per_client = connections // clients
+    threads = [threading.Thread(target=nc_client, args=(port, per_client, results, failed)) for _ in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+
+    mc.shutdown()
+    logQueue.put_nowait(None)
+    logProcess.join(5)
+
+    results.sort()
+    print("reuseport=%s: %u connections in %.2fs -> %.1f conn/s, median %.2fms, p99 %.2fms, %u timed out" % (
+        reuseport, len(results), duration, len(results) / duration,
+        1000 * results[len(results) // 2], 1000 * results[int(len(results) * 0.99)], len(failed)))
+
+
+if __name__ == '__main__':
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    run(0, 10991, connections, clients, processes)
+    run(1, 10992, connections, clients, processes)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# MB/s ingested per core by SMTPSession, receiving 1024 byte lumps and unquoting
+# every lump with re.sub (previous implementation) compared to the buffered
+# receive state machine.
+#
+# usage: bench_smtp_receive.py [message size in MB] [messages] [memory_spool_maxsize]
+#
+# The client runs in another thread, only the CPU time of the receiving thread is
+# counted.
+
+import sys
+import os
+import re
+import time
+import socket
+import smtplib
+import tempfile
+import threading
+from configparser import RawConfigParser
+from fuglu.connectors.smtpconnector import SMTPSession
+from fuglu.stringencode import force_bString, force_uString
+
+
+class LegacySMTPSession(SMTPSession):
+    """SMTPSession receiving messages like the previous implementation"""
+
+    def getincomingmail(self):
+        self.socket.send(force_bString("220 fuglu scanner ready \r\n"))
+
+        while True:
+            completeLine = 0
+            collect_lumps = []
+            while not completeLine:
+                lump = self.socket.recv(1024)
+                if len(lump):
+                    collect_lumps.append(lump)
+                    if len(lump) > 1:
+                        if lump[-2:] == b'\r\n':
+                            completeLine = 1
+                    elif (len(collect_lumps) > 1 and (lump[-1:] == b'\n' and collect_lumps[-2][-1:] == b'\r')):
+                        completeLine = 1
+
+                    if completeLine == 1:
+                        rawdata = b"".join(collect_lumps)
+                        if self.state != SMTPSession.ST_DATA:
+                            rsp, keep = self.doCommand(force_uString(rawdata))
+                            if self.state == SMTPSession.ST_DATA:
+                                self.dataAccum = b""
+                        else:
+                            rsp = self.doData(rawdata)
+                            if rsp is None:
+                                continue
+                            return True
+                        self.socket.send(force_bString(rsp + "\r\n"))
+                        if keep == 0:
+                            self.closeconn()
+                            return False
+                else:
+                    return False
+
+    def doData(self, data):
+        data = re.sub(b'(?m)^\\.\\.', b'.', force_bString(data))
+        self.dataAccum = self.dataAccum + data
+        if len(self.dataAccum) > 4:
+            self.dataAccum = self.dataAccum[-5:]
+        if len(self.dataAccum) > 4 and self.dataAccum[-5:] == b'\r\n.\r\n':
+            if len(data) > 4:
+                self.tempfile.write(data[0:-5])
+            self._close_tempfile()
+            self.state = SMTPSession.ST_HELO
+            return "250 OK - Data and terminator. found"
+        self.tempfile.write(data)
+        return None
+
+
+def create_message(size):
+    line = b'A' * 76 + b'\r\n'
+    body = (b'.' + line + line) * (size // len(line) // 2)
+    return b'From: sender@fuglu.org\r\nTo: recipient@fuglu.org\r\nSubject: benchmark\r\n\r\n' + body
+
+
+def send(sock, message, messages):
+    client = smtplib.SMTP()
+    client.sock = sock
+    for _ in range(messages):
+        # a new session is used for every message
+        client.getreply()
+        client.ehlo()
+        client.sendmail('sender@fuglu.org', ['recipient@fuglu.org'], message)
+
+
+def run(sessionclass, config, message, messages):
+    server, clientsock = socket.socketpair()
+    client = threading.Thread(target=send, args=(clientsock, message, messages), daemon=True)
+    client.start()
+    cputime = 0
+    for _ in range(messages):
+        sess = sessionclass(server, config)
+        start = time.thread_time()
+        if not sess.getincomingmail():
+            raise Exception("receive failed")
+        cputime += time.thread_time() - start
+        server.send(b"250 OK\r\n")
+        if sess.tempfile.filename:
+            os.remove(sess.tempfile.filename)
+    print("%-20s %.1f MB/s per core" % (sessionclass.__name__, len(message) * messages / cputime / 1048576))
+    server.close()
+    clientsock.close()
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    config = RawConfigParser()
+    config.add_section('main')
+    config.set('main', 'tempdir', tempfile.gettempdir())
+    config.set('main', 'outgoinghelo', 'fuglu.bench')
+    config.add_section('performance')
+    config.set('performance', 'memory_spool_maxsize', sys.argv[3] if len(sys.argv) > 3 else '0')
+    message = create_message(size * 1048576)
+    run(LegacySMTPSession, config, message, messages)
+    run(SMTPSession, config, message, messages)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Bytes read from the tempfile per message when plugins access the original source,
+# reading the tempfile on every access (previous implementation) compared to the
+# memory mapped tempfile.
+#
+# usage: bench_source.py [message size in MB] [messages]
+#
+# The accesses resemble a scan with SuspectFilter body:full rules, DKIM verification,
+# SpamAssassin with scanoriginal, clamav and the archive plugin.
+
+import sys
+import os
+import time
+import tempfile
+from fuglu.shared import Suspect, SuspectFilter
+
+
+class ReadingSuspect(Suspect):
+    """Suspect reading the tempfile for every access to the original source"""
+
+    def get_original_source(self, maxbytes=None):
+        readbytes = -1
+        if maxbytes is not None:
+            readbytes = maxbytes
+        with open(self.tempfile, 'rb') as fh:
+            return fh.read(readbytes)
+
+    def get_original_source_view(self, maxbytes=None):
+        return memoryview(self.get_original_source(maxbytes))
+
+
+def bytes_read():
+    """bytes read by this process using read syscalls"""
+    with open('/proc/self/io') as fh:
+        for line in fh:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def create_message(size):
+    handle, filename = tempfile.mkstemp(prefix='fuglu-bench-source')
+    line = b'A' * 76 + b'\r\n'
+    with os.fdopen(handle, 'wb') as fh:
+        fh.write(b'From: sender@fuglu.org\r\nTo: recipient@fuglu.org\r\nSubject: benchmark\r\n\r\n')
+        fh.write(line * (size // len(line)))
+    return filename
+
+
+def scan(suspectclass, filename, devnull):
+    suspect = suspectclass('sender@fuglu.org', 'recipient@fuglu.org', filename)
+    suspect.get_message_rep()
+    suspect.get_headers()
+    SuspectFilter(None).get_field(suspect, 'body:full')  # filter rule on the full body
+    suspect.get_original_source()  # dkim verification
+    suspect.get_original_source()  # spamassassin, scanoriginal
+    content = suspect.get_source_view()  # clamav, sent in INSTREAM chunks
+    for chunk in range(0, len(content), 2048):
+        content[chunk:chunk + 2048]
+    del content
+    devnull.write(suspect.get_source_view())  # archive
+    suspect.release_original_source()
+
+
+def run(suspectclass, filename, messages):
+    with open(os.devnull, 'wb') as devnull:
+        before = bytes_read()
+        start = time.time()
+        for _ in range(messages):
+            scan(suspectclass, filename, devnull)
+        duration = time.time() - start
+        readbytes = bytes_read() - before
+    print("%-16s %.1f MB read per message, %.1fms per message" % (
+        suspectclass.__name__, readbytes / messages / 1048576, 1000 * duration / messages))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    filename = create_message(size * 1048576)
+    try:
+        run(ReadingSuspect, filename, messages)
+        run(Suspect, filename, messages)
+    finally:
+        os.remove(filename)
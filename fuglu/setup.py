@@ -45,6 +45,10 @@ setup(
     install_requires=[
         'packaging>=16.8',
     ],
+    extras_require={
+        # milter connector (incomingport milter:...)
+        'milter': ['python-libmilter'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: No Input/Output (Daemon)',
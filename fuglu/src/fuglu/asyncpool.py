@@ -0,0 +1,250 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2009-2019 Oli Schacher, Fumail Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+#
+import asyncio
+import threading
+import time
+import logging
+import weakref
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from fuglu.protocolbase import uncompress_task
+from fuglu.scansession import SessionHandler
+
+
+class AsyncSessionState(object):
+    """
+    Keeps track of the state of one connection handled by the AsyncioPool,
+    used as "worker" for the SessionHandler (see workerstate)
+    """
+
+    def __init__(self, sessionid, port):
+        self.sessionid = sessionid
+        self.port = port
+        self.workerstate = 'created'
+        self.task = None
+        # time the received message has been handed to the executor, None once a scanner thread took it
+        self.waiting_since = None
+        self.scanning = False
+
+    def __repr__(self):
+        return "%s (port %s): %s" % (self.sessionid, self.port, self.workerstate)
+
+
+class AsyncioPool(threading.Thread):
+    """
+    Connection handling with an asyncio event loop. Receiving the messages
+    from the MTA is done non-blocking in the event loop so idle or slow connections
+    don't occupy a scanner thread. Once a message is completely received the
+    scan is done by a bounded pool of scanner threads.
+    """
+
+    def __init__(self, controller, maxthreads=20):
+        self.maxthreads = maxthreads
+        self.workers = []
+        self.sessioncounter = 0
+        self.logger = logging.getLogger('%s.asyncpool' % __package__)
+        self.controller = weakref.ref(controller)  # keep a weak reference to controller
+        self._stayalive = True
+        self.ewma_alpha = 0.2
+        self.queue_wait_ewma = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=maxthreads, thread_name_prefix='Async scanner')
+        self.loop = asyncio.new_event_loop()
+        threading.Thread.__init__(self)
+        self.name = 'Asynciopool'
+        self.daemon = False
+        self.start()
+
+    @property
+    def stayalive(self):
+        return self._stayalive
+
+    @stayalive.setter
+    def stayalive(self, value):
+        if self._stayalive and not value:
+            self._stayalive = False
+            self.loop.call_soon_threadsafe(self._create_stop_task)
+        self._stayalive = value
+
+    def _create_stop_task(self):
+        self.loop.create_task(self._stop_loop())
+
+    async def _stop_loop(self, timeout=120):
+        """
+        Let running scans finish before stopping the loop, connections waiting
+        for the next message (milter) are closed.
+        """
+        for state in self.workers:
+            if state.workerstate == 'receiving message' and state.task is not None:
+                state.task.cancel()
+
+        waited = 0.0
+        while self.workers and waited < timeout:
+            await asyncio.sleep(0.1)
+            waited += 0.1
+        if self.workers:
+            self.logger.warning('Stopping event loop with %u unfinished sessions' % len(self.workers))
+        self.loop.stop()
+
+    def run(self):
+        self.logger.debug('Asynciopool initializing. maxthreads=%s' % self.maxthreads)
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.logger.info('Asynciopool shut down')
+
+    def queue_depth(self):
+        """number of received messages waiting for a scanner thread"""
+        return len([state for state in self.workers[:] if state.waiting_since is not None])
+
+    def estimated_wait(self):
+        """estimated time a new received message will wait for a scanner thread (seconds)"""
+        states = self.workers[:]
+        waiting = [state.waiting_since for state in states if state.waiting_since is not None]
+        if not waiting and len([state for state in states if state.scanning]) < self.maxthreads:
+            # the next message is picked up right away
+            return 0.0
+        oldest = time.time() - min(waiting) if waiting else 0.0
+        return max(self.queue_wait_ewma, oldest)
+
+    def _scan(self, sesshandler, state):
+        """run the session in a scanner thread, keeping track of the time waited for the thread"""
+        waited = time.time() - state.waiting_since
+        self.queue_wait_ewma = self.ewma_alpha * waited + (1.0 - self.ewma_alpha) * self.queue_wait_ewma
+        state.scanning = True
+        state.waiting_since = None
+        try:
+            sesshandler.handlesession(state)
+        finally:
+            state.scanning = False
+
+    def add_task(self, task):
+        """
+        Add a compressed task (see protocolbase.compress_task), this allows
+        to transfer the queue of a ThreadPool or ProcManager to this pool.
+
+        Args:
+            task (bytes): compressed task
+        """
+        sock, handler_modulename, handler_classname, port = uncompress_task(task)
+        self.add_task_from_socket(sock, handler_modulename, handler_classname, port)
+
+    def add_task_from_socket(self, sock, handler_modulename, handler_classname, port):
+        """
+        Consistent interface with threadpool/procpool. Schedule the session
+        for the socket in the event loop.
+
+        Args:
+            sock (socket): socket to receive the message
+            handler_modulename (str): module name of handler
+            handler_classname (str): class name of handler
+            port (int) : incoming port
+        """
+        if not self._stayalive:
+            self.logger.warning('Asynciopool is shutting down, closing connection on port %s' % port)
+            self._close_socket(sock)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._create_session, sock, handler_modulename, handler_classname, port)
+        except Exception as e:
+            self.logger.error("Exception happened trying to add task to event loop: %s" % str(e))
+            self.logger.exception(e)
+            self._close_socket(sock)
+
+    @staticmethod
+    def _close_socket(sock):
+        try:
+            sock.close()
+        except Exception:
+            pass
+
+    def _create_session(self, sock, handler_modulename, handler_classname, port):
+        self.loop.create_task(self._handle_connection(sock, handler_modulename, handler_classname, port))
+
+    async def _handle_connection(self, sock, handler_modulename, handler_classname, port):
+        controller = self.controller()
+        if controller is None:
+            # weak ref will point to None once object has been removed
+            return
+
+        self.sessioncounter += 1
+        state = AsyncSessionState("[%s]" % self.sessioncounter, port)
+        state.task = asyncio.current_task()
+        self.workers.append(state)
+        try:
+            handler_class = getattr(importlib.import_module(handler_modulename), handler_classname)
+            handler_instance = handler_class(sock, controller.config)
+            handler_instance.set_plugins(list(controller.prependers) + list(controller.plugins)
+                                         + list(controller.appenders))
+
+            # milter can handle several messages in the same connection, the session
+            # handler only processes one message per call because receiving is done here
+            keep_connection = getattr(handler_instance, 'keep_connection', False)
+            handler_instance.keep_connection = False
+
+            while self._stayalive:
+                state.workerstate = 'receiving message'
+                try:
+                    received = await handler_instance.receive_async(self.loop)
+                except Exception as e:
+                    self.logger.error("Exception receiving message: %s" % str(e))
+                    received = False
+                    handler_instance._received = received
+
+                # the session handler runs the plugins in a scanner thread, if nothing has been received
+                # it will end the session and clean up
+                state.workerstate = 'waiting for scanner thread'
+                state.waiting_since = time.time()
+                sesshandler = SessionHandler(handler_instance, controller.config, controller.prependers,
+                                             controller.plugins, controller.appenders, port)
+                await self.loop.run_in_executor(self.executor, self._scan, sesshandler, state)
+                del sesshandler
+
+                if not (keep_connection and received) or sock.fileno() < 0:
+                    break
+        except Exception as e:
+            self.logger.error('Unhandled Exception : %s' % e)
+            self.logger.exception(e)
+        finally:
+            state.workerstate = 'ending'
+            if not self._stayalive and sock.fileno() >= 0:
+                # pool is shutting down while the connection is still open
+                self._close_socket(sock)
+            try:
+                self.workers.remove(state)
+            except ValueError:
+                pass
+
+    def shutdown(self, newmanager=None):
+        """
+        Shutdown the event loop and the scanner threads once running scans are
+        finished. Connections are handled by the event loop directly and not queued,
+        so there is nothing to transfer to a new manager.
+
+        Keyword Args:
+            newmanager (ProcManager or ThreadPool): unused, for consistent interface with other pools
+        """
+        self.stayalive = False
+        self.join(120)  # wait 120 seconds max
+        self.executor.shutdown(wait=True)
+        if self.is_alive():
+            # closing a running loop raises, leave it to the thread
+            self.logger.warning('Asynciopool event loop still running after shutdown, not closing it')
+        else:
+            self.loop.close()
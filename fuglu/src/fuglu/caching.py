@@ -15,7 +15,11 @@
 #
 #
 #
+import collections
 import functools
+import json
+import logging
+import threading
 import time
 import operator
 import weakref
@@ -407,3 +411,77 @@ class Cachelimits(object):
             f_dict = {}
             self._smart_cached_limits[function] = f_dict
         f_dict[key] = value
+
+
+class VerdictCache(object):
+    """
+    Thread safe cache for scan verdicts with a time to live. Verdicts are kept in memory
+    (least recently used entries are dropped once maxsize is reached) or in redis if a
+    redis client is given, to share them between processes and hosts.
+
+    Verdicts have to be None or serializable as json.
+    """
+    prefix = 'fuglu-verdict:'
+
+    def __init__(self, ttl, maxsize=10000, redis=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.redis = redis
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('fuglu.VerdictCache')
+
+    def get(self, key):
+        """
+        Get a cached verdict
+
+        Args:
+            key (str): the cache key
+
+        Returns:
+            (bool, object): True and the verdict if found, (False, None) otherwise
+        """
+        if self.redis is not None:
+            try:
+                value = self.redis.get(self.prefix + key)
+            except Exception as e:
+                self.logger.warning('could not read verdict from redis: %s' % str(e))
+                return False, None
+            if value is None:
+                return False, None
+            return True, json.loads(value)
+
+        with self._lock:
+            try:
+                expires, verdict = self._entries[key]
+            except KeyError:
+                return False, None
+            if expires < time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, verdict
+
+    def put(self, key, verdict):
+        """
+        Store a verdict
+
+        Args:
+            key (str): the cache key
+            verdict (object): the verdict
+        """
+        if self.redis is not None:
+            try:
+                self.redis.set(self.prefix + key, json.dumps(verdict), ex=self.ttl)
+            except Exception as e:
+                self.logger.warning('could not store verdict in redis: %s' % str(e))
+            return
+
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, verdict)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -14,26 +14,19 @@
 #
 #
 #
-import smtplib
-import logging
-import socket
-import tempfile
-import os
 from fuglu.protocolbase import ProtocolHandler, BasicTCPServer
-from fuglu.shared import Suspect, apply_template
+from fuglu.shared import Suspect, MessageSpool, apply_template
+from fuglu.connectors.smtpconnector import FUSMTPClient, StreamedMessage, SMTPSession
 from fuglu.stringencode import force_bString, force_uString
 
 from email.header import Header
 import re
 
 
-def buildmsgsource(suspect):
-    """Build the message source with fuglu headers prepended"""
+def buildmsgheaders(suspect):
+    """Build the fuglu headers to prepend to the message source"""
     # we must prepend headers manually as we can't set a header order in email
     # objects
-
-    # -> the original message source is bytes
-    origmsgtxt = suspect.get_source()
     newheaders = ""
 
     for key in suspect.addheaders:
@@ -44,10 +37,17 @@ def buildmsgsource(suspect):
         hdr = Header(val, header_name=key, continuation_ws=' ')
 
         newheaders += "%s: %s\n" % (key, hdr.encode())
+    return force_bString(newheaders)
+
+
+def buildmsgsource(suspect):
+    """Build the message source with fuglu headers prepended"""
+    # -> the original message source is bytes
+    origmsgtxt = suspect.get_source()
 
     # the original message should be in bytes, make sure the header added
     # is an encoded string as well
-    modifiedtext = force_bString(newheaders) + force_bString(origmsgtxt)
+    modifiedtext = buildmsgheaders(suspect) + force_bString(origmsgtxt)
     return modifiedtext
 
 
@@ -70,26 +70,25 @@ class ESMTPHandler(ProtocolHandler):
             return 250, 'OK'
         if suspect.get_tag('reinjectoriginal'):
             self.logger.info('Injecting original message source without modifications')
-            msgcontent = suspect.get_original_source()
+            msgcontent = StreamedMessage.from_suspect(suspect, original=True)
         else:
-            msgcontent = buildmsgsource(suspect)
+            msgcontent = StreamedMessage.from_suspect(suspect, headers=buildmsgheaders(suspect))
 
-        code, answer = self.sess.forwardconn.data(force_bString(msgcontent))
+        code, answer = self.sess.forwardconn.data(msgcontent)
         answer = force_uString(answer)
         return code, answer
 
     def get_suspect(self):
-        success = self.sess.getincomingmail()
+        success = self.receive()
         if not success:
             self.logger.error('incoming esmtp transfer did not finish')
             return None
 
         sess = self.sess
         fromaddr = sess.from_address
-        tempfilename = sess.tempfilename
         
         try:
-            suspect = Suspect(fromaddr, sess.recipients, tempfilename, att_cachelimit=self._att_mgr_cachesize)
+            suspect = Suspect(fromaddr, sess.recipients, sess.tempfile, att_cachelimit=self._att_mgr_cachesize)
         except ValueError as e:
             if len(sess.recipients)>0:
                 toaddr = sess.recipients[0]
@@ -116,6 +115,11 @@ class ESMTPHandler(ProtocolHandler):
             self.sess.endsession(injectcode, injectanswer)
         self.sess = None
 
+    def refuse(self, reason):
+        # 421 greeting, the client has to close the connection (RFC 5321, 3.8)
+        self.sess.socket.sendall(force_bString("421 4.3.2 %s\r\n" % reason))
+        self.sess.closeconn()
+
     def defer(self, reason):
         self.sess.endsession(451, reason)
         self.sess.finish_outgoing_connection()
@@ -134,109 +138,47 @@ class ESMTPServer(BasicTCPServer):
     def __init__(self, controller, port=10125, address="127.0.0.1"):
         BasicTCPServer.__init__(self, controller, port, address, ESMTPHandler)
 
-class ESMTPPassthroughSession(object):
-    ST_INIT = 0
-    ST_HELO = 1
-    ST_MAIL = 2
-    ST_RCPT = 3
-    ST_DATA = 4
-    ST_QUIT = 5
+class ESMTPPassthroughSession(SMTPSession):
+    """
+    Commands are forwarded to the outgoing server, the message itself is received
+    like in SMTPSession.
+    """
+
+    # commands are forwarded using blocking smtplib
+    blocking_commands = True
+
+    # extensions implemented by the session itself, not by the outgoing server
+    SESSION_EXTENSIONS = ("PIPELINING", "CHUNKING", "BINARYMIME")
 
     def __init__(self, socket, config):
-        self.config = config
-        self.from_address = None
-        self.recipients = []
-        self.helo = None
-        self.dataAccum = None
-
-        self.socket = socket
-        self.state = ESMTPPassthroughSession.ST_INIT
-        self.logger = logging.getLogger("fuglu.smtpsession")
-        self.tempfilename = None
-        self.tempfile = None
+        SMTPSession.__init__(self, socket, config)
         self.forwardconn = None
 
         self.xforward_helo = None
         self.xforward_addr = None
         self.xforward_rdns = None
 
-    def endsession(self, code, message):
-        """End session with incoming postfix"""
-        self.socket.send(force_bString("%s %s\r\n" % (code, message)))
-        rawdata = b''
-        data = ''
-        while True:
-            lump = self.socket.recv(1024)
-            if len(lump):
-                rawdata += lump
-                if (len(rawdata) >= 2) and rawdata[-2:] == b'\r\n':
-                    cmd = data[0:4]
-                    cmd = cmd.upper()
-                    if cmd == b"QUIT":
-                        self.socket.send(force_bString("%s %s\r\n" % (220, "BYE")))
-                        self.closeconn()
-                        return
-                    self.socket.send(force_bString("%s %s\r\n" % (421, "Cannot accept further commands")))
-                    self.closeconn()
-                    return
-            else:
-                self.closeconn()
-                return
-
-    def closeconn(self):
-        """clocke socket to incoming postfix"""
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except (OSError, socket.error):
-            pass
-        finally:
-            self.socket.close()
-        
-    def _close_tempfile(self):
-        if self.tempfile and not self.tempfile.closed:
-            self.tempfile.close()
-
     def getincomingmail(self):
         """return true if mail got in, false on error Session will be kept open"""
-        self.socket.send(force_bString("220 fuglu scanner ready \r\n"))
-
-        while True:
-            rawdata = b''
-            completeLine = 0
-            while not completeLine:
-                lump = self.socket.recv(1024)
-                if len(lump):
-                    rawdata += lump
-                    if (len(rawdata) >= 2) and rawdata[-2:] == b'\r\n':
-                        completeLine = 1
-
-                        if self.state != ESMTPPassthroughSession.ST_DATA:
-                            # decode message (except data) from binary to unicode
-                            data = force_uString(rawdata)
-                            rsp, keep = self.doCommand(data)
-                        else:
-                            try:
-                                rsp = self.doData(rawdata)
-                            except IOError:
-                                self.endsession(421, "Could not write to temp file")
-                                self._close_tempfile()
-                                return False
-
-                            if rsp is None:
-                                continue
-                            else:
-                                # data finished.. keep connection open though
-                                self.logger.debug('incoming message finished')
-                                return True
-                        
-                        self.socket.send(force_bString(rsp + "\r\n"))
-                        if keep == 0:
-                            self.closeconn()
-                            self.finish_outgoing_connection()
-                            return False
-                else:
-                    # EOF
-                    return False
+        received = SMTPSession.getincomingmail(self)
+        if received:
+            self.logger.debug('incoming message finished')
+        elif self.forwardconn is not None:
+            self.finish_outgoing_connection()
+        return received
+
+    async def getincomingmail_async(self, loop):
+        """
+        asyncio variant of getincomingmail, socket has to be non-blocking. Commands are
+        forwarded to the outgoing server using blocking smtplib, so this is done in the
+        default executor of the loop.
+        """
+        received = await SMTPSession.getincomingmail_async(self, loop)
+        if received:
+            self.logger.debug('incoming message finished')
+        elif self.forwardconn is not None:
+            await loop.run_in_executor(None, self.finish_outgoing_connection)
+        return received
 
     def forwardCommand(self, command):
         """forward a esmtp command to outgoing postfix instance
@@ -252,7 +194,7 @@ class ESMTPPassthroughSession(object):
             targethost = self.config.get('main', 'outgoinghost')
             if targethost == '${injecthost}':
                 targethost = self.socket.getpeername()[0]
-            self.forwardconn = smtplib.SMTP(force_uString(targethost), self.config.getint('main', 'outgoingport'))
+            self.forwardconn = FUSMTPClient(force_uString(targethost), self.config.getint('main', 'outgoingport'))
         self.logger.debug("""SEND: "%s" """ % command)
 
         # docmd seems to have a normal string as input, so
@@ -289,14 +231,18 @@ class ESMTPPassthroughSession(object):
         cmd = cmd.upper()
         keep = 1
 
+        if self._bdat_transfer and cmd not in ("BDAT", "RSET", "NOOP", "QUIT"):
+            return "503 Bad command sequence", 1
         if cmd in["EHLO", 'HELO']:
             self.state = ESMTPPassthroughSession.ST_HELO
         elif cmd == "RSET":
             self.from_address = None
             self.recipients = []
             self.helo = None
-            self.dataAccum = ""
             self.state = ESMTPPassthroughSession.ST_INIT
+            if self._bdat_transfer:
+                self._bdat_transfer = False
+                self._discard_tempfile()
         elif cmd == "NOOP":
             pass
         elif cmd == "QUIT":
@@ -332,23 +278,43 @@ class ESMTPPassthroughSession(object):
             if self.state != ESMTPPassthroughSession.ST_RCPT:
                 return "503 Bad command sequence", 1
             self.state = ESMTPPassthroughSession.ST_DATA
-            self.dataAccum = b""
+            self._data_linestart = True
             try:
-                handle, tempfilename = tempfile.mkstemp(prefix='fuglu', dir=self.config.get('main', 'tempdir'))
-                self.tempfilename = tempfilename
-                self.tempfile = os.fdopen(handle, 'w+b')
+                self.tempfile = MessageSpool.from_config(self.config)
             except Exception as e:
                 self.endsession(421, "could not create file: %s" % str(e))
 
             return "354 OK, Enter data, terminated with a \\r\\n.\\r\\n", 1
 
+        elif cmd == "BDAT":
+            # the message is re-injected with FUSMTPClient.data, not forwarded in chunks
+            return self.doBdat(data)
+
         if data[0:8].upper() == 'XFORWARD':
             self.store_xforward(data)
 
         rv = self.forwardCommand(data)
+        if cmd == "EHLO":
+            rv = self.filter_ehlo(rv)
 
         return rv, keep
 
+    def filter_ehlo(self, reply):
+        """
+        Replace the extensions implemented by the session in the EHLO reply of the
+        outgoing server by the ones advertised by fuglu
+        """
+        lines = reply.split('\r\n')
+        if not lines[0].startswith('250'):
+            return reply
+        answer = [lines[0][4:]]
+        for line in lines[1:]:
+            keyword = line[4:].split(' ', 1)[0].upper()
+            if keyword not in self.SESSION_EXTENSIONS:
+                answer.append(line[4:])
+        answer.extend(opt for opt in self.ehlo_options if opt in self.SESSION_EXTENSIONS)
+        return '\r\n'.join(['250-%s' % line for line in answer[:-1]] + ['250 %s' % answer[-1]])
+
     def store_xforward(self, data):
         parts = data.split()[1:]
         for part in parts:
@@ -376,40 +342,6 @@ class ESMTPPassthroughSession(object):
             except Exception:
                 continue
 
-    def doData(self, data):
-        """
-
-        Args:
-            data (str or bytes): byte string
-
-        Returns:
-
-        """
-        data = self.unquoteData(data)
-        # store the last few bytes in memory to keep track when the msg is
-        # finished
-        self.dataAccum = self.dataAccum + data
-
-        if len(self.dataAccum) > 4:
-            self.dataAccum = self.dataAccum[-5:]
-
-        if len(self.dataAccum) > 4 and self.dataAccum[-5:] == b'\r\n.\r\n':
-            # check if there is more data to write to the file
-            if len(data) > 4:
-                self.tempfile.write(data[0:-5])
-
-            self._close_tempfile()
-
-            self.state = ESMTPPassthroughSession.ST_HELO
-            return "250 OK - Data and terminator. found"
-        else:
-            self.tempfile.write(data)
-            return None
-
-    def unquoteData(self, data):
-        """two leading dots at the beginning of a line must be unquoted to a single dot"""
-        return re.sub(b'(?m)^\.\.', b'.', data)
-
     def stripAddress(self, address):
         """
         Strip the leading & trailing <> from an address.  Handy for
@@ -17,10 +17,10 @@
 
 import logging
 import socket
+import threading
 
-from fuglu.shared import Suspect
+from fuglu.shared import Suspect, MessageSpool, HEADER_SEPARATOR
 from fuglu.protocolbase import ProtocolHandler, BasicTCPServer
-import tempfile
 import os
 from fuglu.stringencode import force_bString, force_uString
 from email.header import Header
@@ -93,8 +93,16 @@ class MilterHandler(ProtocolHandler):
                           "headers" in self.milter_mode_options, "from" in self.milter_mode_options,
                           "to" in self.milter_mode_options))
 
+    def set_plugins(self, plugins):
+        """
+        Don't request the connect and helo stages from the MTA if no plugin uses the client
+        info, get_client_info falls back to the Received headers.
+        """
+        if not any(getattr(plugin, 'uses_clientinfo', None) is not False for plugin in plugins):
+            self.sess.skip_stages(lm.SMFIP_NOCONNECT | lm.SMFIP_NOHELO)
+
     def get_suspect(self):
-        if not self.sess.getincomingmail():
+        if not self.receive():
             self.logger.error('MILTER SESSION NOT COMPLETED')
             return None
         self.logger.debug("After getting incoming mail...")
@@ -103,18 +111,18 @@ class MilterHandler(ProtocolHandler):
         from_address = sess.get_cleaned_from_address()
         recipients = sess.get_cleaned_recipients()
 
-        # If there's no file
-        temp_filename = sess.tempfilename
-        if not temp_filename:
+        # If no message has been received
+        if sess.spool is None:
             return None
 
         # If there is a filename but no file
+        temp_filename = sess.tempfilename
         if temp_filename and not os.path.exists(temp_filename):
             self.logger.warning("File '%s' not found for suspect creation! from: %s, to: %s"
                                 % (temp_filename, str(from_address), str(recipients)))
             return None
 
-        suspect = Suspect(from_address, recipients, temp_filename, att_cachelimit=self._att_mgr_cachesize,
+        suspect = Suspect(from_address, recipients, sess.spool, att_cachelimit=self._att_mgr_cachesize,
                           sasl_login=sess.sasl_login, sasl_sender=sess.sasl_sender, sasl_method=sess.sasl_method,
                           queue_id=sess.queueid)
 
@@ -274,7 +282,8 @@ class MilterHandler(ProtocolHandler):
         # --
         if self.enable_mode_auto:
             replace_headers = False
-            replace_body = suspect.is_modified()
+            # header changes are sent as deltas below, the body only if it has been changed
+            replace_body = suspect.is_body_modified()
             replace_from = suspect.orig_from_address_changed()
             replace_to = suspect.orig_recipients_changed()
             self.logger.debug("Mode auto -> replace headers:%s, body:%s, from:%s, to:%s" %
@@ -372,9 +381,10 @@ class MilterHandler(ProtocolHandler):
 
         if replace_body:
             self.logger.debug("Replace message body")
-            msg_string = suspect.get_message_rep().as_string()
+            source = suspect.get_source_view()
             # just dump everything below the headers
-            self.replacebody(msg_string[msg_string.find("\n\n")+len("\n\n"):])
+            separator = HEADER_SEPARATOR.search(source)
+            self.replacebody(source[separator.end():].tobytes() if separator else b"")
 
         self.sess.send(lm.CONTINUE)
         self.continuesession()
@@ -428,6 +438,28 @@ class MilterHandler(ProtocolHandler):
 
         return msg
 
+    def refuse(self, reason):
+        """
+        Answer the connect of the MTA with a temporary failure (admission control)
+        Args:
+            reason (str,unicode): reason, only for internal logging
+        """
+        self.sess.admission_refused = reason
+        # the MTA expects the option negotiation before the answer to the connect
+        # command, do this in a separate thread to keep accepting connections
+        self.socket.settimeout(2)
+        refuser = threading.Thread(target=self._refuse_session, name='Milter refuse')
+        refuser.daemon = True
+        refuser.start()
+
+    def _refuse_session(self):
+        try:
+            self.sess.getincomingmail()
+        except Exception as e:
+            self.logger.debug('Could not refuse milter session: %s' % str(e))
+        finally:
+            self.sess.close()
+
     def defer(self, reason):
         """
         Defer mail.
@@ -467,6 +499,27 @@ class MilterHandler(ProtocolHandler):
         self.continuesession()
 
 
+class BufferedTransport(object):
+    """
+    Wraps the milter socket while the asyncio backend processes received data, collecting
+    the replies so they can be sent without blocking the event loop.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = []
+
+    def sendall(self, data):
+        self.buffer.append(data)
+
+    def send(self, data):
+        self.buffer.append(data)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
 class MilterSession(lm.MilterProtocol):
     def __init__(self, sock, config, options=lm.SMFIF_ALLOPTS):
         # enable options for version 2 protocol
@@ -489,8 +542,8 @@ class MilterSession(lm.MilterProtocol):
 
         self._tempfile = None
         self._exit_incomingmail = False
-        self._tempfile = None
-        self.tempfilename = None
+        # spool of the last message, kept after the tempfile is closed
+        self.spool = None
         self.original_headers = []
         self.be_verbose = False
         # postfix queue id
@@ -499,6 +552,8 @@ class MilterSession(lm.MilterProtocol):
         self.sasl_login = None
         self.sasl_sender = None
         self.sasl_method = None
+        # reason if connection is refused by admission control
+        self.admission_refused = None
 
     def reset_connection(self):
         """Reset all variables except to prepare for a second mail through the same connection.
@@ -513,7 +568,7 @@ class MilterSession(lm.MilterProtocol):
             except OSError:
                 self.logger.error("Could not remove tmp file: %s" % self.tempfilename)
                 pass
-        self.tempfilename = None
+        self.spool = None
         # postfix queue id
         self.queueid = None
         # SASL authentication
@@ -545,12 +600,17 @@ class MilterSession(lm.MilterProtocol):
     @property
     def tempfile(self):
         if self._tempfile is None:
-            (handle, tempfilename) = tempfile.mkstemp(
-                prefix='fuglu', dir=self.config.get('main', 'tempdir'))
-            self.tempfilename = tempfilename
-            self._tempfile = os.fdopen(handle, 'w+b')
+            self._tempfile = MessageSpool.from_config(self.config)
+            self.spool = self._tempfile
         return self._tempfile
 
+    @property
+    def tempfilename(self):
+        """filename of the received message, None if it is kept in memory"""
+        if self.spool is None:
+            return None
+        return self.spool.filename
+
     @tempfile.setter
     def tempfile(self, value):
         try:
@@ -563,6 +623,17 @@ class MilterSession(lm.MilterProtocol):
         # actually setReply needs all bytes
         return super(__class__, self).setReply(force_bString(rcode), force_bString(xcode), force_bString(msg))
 
+    def skip_stages(self, smfip_nocallbacks):
+        """
+        Tell the MTA not to send the stages given as SMFIP_NO* flags. Only possible
+        before the options have been negotiated.
+        """
+        if self._mtaVersion:
+            return
+        self.protos |= smfip_nocallbacks
+        self.logger.debug("Skipping stages: %s" % ", ".join(
+            smfip_string for smfip_option, smfip_string in lm.SMFIP_PROTOS.items() if smfip_option & smfip_nocallbacks))
+
     def has_option(self, smfif_option, client=None):
         """
         Checks if option is available. Fuglu or mail transfer agent can
@@ -610,6 +681,46 @@ class MilterSession(lm.MilterProtocol):
                 return False
         return self._exit_incomingmail
 
+    async def getincomingmail_async(self, loop):
+        """
+        asyncio variant of getincomingmail, socket has to be non-blocking. Replies
+        created by libmilter while processing the received data are collected and
+        sent once the chunk has been processed.
+        """
+        self._sockLock = lm.DummyLock()
+        sock = self.transport
+        while True and not self._exit_incomingmail:
+            buf = ''
+            try:
+                self.log("receive data from transport")
+                buf = await loop.sock_recv(sock, lm.MILTER_CHUNK_SIZE)
+                self.log("after receive")
+            except (AttributeError, socket.error, socket.timeout):
+                # Socket has been closed, error or timeout happened
+                pass
+            if not buf:
+                self.log("buf is empty -> return")
+                return True
+
+            replies = BufferedTransport(sock)
+            self.transport = replies
+            try:
+                self.dataReceived(buf)
+            except Exception as e:
+                self.logger.error('AN EXCEPTION OCCURED IN %s: %s' % (self.id, e))
+                self.logger.exception(e)
+                self.log("Call connectionLost")
+                self.transport = sock
+                self.connectionLost()
+                self.log("fail -> return false")
+                return False
+            finally:
+                if self.transport is replies:
+                    self.transport = sock
+            if replies.buffer and sock.fileno() >= 0:
+                await loop.sock_sendall(sock, b"".join(replies.buffer))
+        return self._exit_incomingmail
+
     def log(self, msg):
         # function will be used by libmilter as well for logging
         # this is only for development/debugging, that's why it has
@@ -652,6 +763,11 @@ class MilterSession(lm.MilterProtocol):
         self.log('Connect from %s:%d (%s) with family: %s, dict: %s' % (ip, port,
                                                               hostname, family, str(command_dict)))
         self.store_info_from_dict(command_dict)
+        if self.admission_refused:
+            self.logger.warning('Return temporary fail for connect: %s' % self.admission_refused)
+            # don't wait for the end of the SMTP session
+            self._exit_incomingmail = True
+            return lm.TEMPFAIL
         if family not in (b'4', b'6'):  # we don't handle unix socket
             self.logger.error('Return temporary fail since family is: %s' % force_uString(family))
             self.logger.error(u'command dict is: %s' % MilterSession.dict_unicode(command_dict))
@@ -701,6 +817,7 @@ class MilterSession(lm.MilterProtocol):
         self.tempfile.write(b"\n")
         return lm.CONTINUE
 
+    @lm.noReply
     def data(self, command_dict):
         self.log('DATA, dict: %s' % MilterSession.dict_unicode(command_dict))
         self.store_info_from_dict(command_dict)
@@ -15,8 +15,7 @@
 ##
 
 import logging
-import tempfile
-from fuglu.shared import Suspect
+from fuglu.shared import Suspect, MessageSpool
 from fuglu.protocolbase import ProtocolHandler, BasicTCPServer
 from fuglu.connectors.smtpconnector import buildmsgsource
 from fuglu.stringencode import force_bString, force_uString
@@ -36,7 +35,7 @@ class NCHandler(ProtocolHandler):
             self._att_mgr_cachesize = None
 
     def get_suspect(self):
-        success = self.sess.getincomingmail()
+        success = self.receive()
         if not success:
             self.logger.error('incoming smtp transfer did not finish')
             return None
@@ -51,9 +50,7 @@ class NCHandler(ProtocolHandler):
         if sess.recipients:    
             toaddr = sess.recipients
 
-        tempfilename = sess.tempfilename
-
-        suspect = Suspect(fromaddr, toaddr, tempfilename, att_cachelimit=self._att_mgr_cachesize)
+        suspect = Suspect(fromaddr, toaddr, sess.tempfile, att_cachelimit=self._att_mgr_cachesize)
         if sess.tags:
             # update suspect tags with the ones receivec
             # during ncsession
@@ -92,6 +89,13 @@ class NCSession(object):
         self.tempfile = None
         self.tags = {}
 
+    @property
+    def tempfilename(self):
+        """filename of the received message, None if it is kept in memory"""
+        if self.tempfile is None:
+            return None
+        return self.tempfile.filename
+
     def send(self, message):
         self.socket.sendall(force_bString(message))
 
@@ -112,10 +116,7 @@ class NCSession(object):
                                        "(optional) include env sender/recipient in the beginning, "
                                        "see documentation\r\n"))
         try:
-            (handle, tempfilename) = tempfile.mkstemp(
-                prefix='fuglu', dir=self.config.get('main', 'tempdir'))
-            self.tempfilename = tempfilename
-            self.tempfile = os.fdopen(handle, 'w+b')
+            self.tempfile = MessageSpool.from_config(self.config)
         except Exception as e:
             self.endsession('could not write to tempfile')
 
@@ -140,6 +141,37 @@ class NCSession(object):
             self.logger.debug('Incoming message received')
         return True
     
+    async def getincomingmail_async(self, loop):
+        """asyncio variant of getincomingmail, socket has to be non-blocking"""
+        await loop.sock_sendall(self.socket, force_bString("fuglu scanner ready - please pipe your message, "
+                                                           "(optional) include env sender/recipient in the beginning, "
+                                                           "see documentation\r\n"))
+        try:
+            self.tempfile = MessageSpool.from_config(self.config)
+        except Exception as e:
+            self.socket.setblocking(True)
+            self.endsession('could not write to tempfile')
+            return False
+
+        collect_lumps = []
+        while True:
+            data = await loop.sock_recv(self.socket, 1024)
+            if len(data) < 1:
+                break
+            else:
+                collect_lumps.append(data)
+
+        data = self.parse_remove_env_data(b"".join(collect_lumps))
+
+        self.tempfile.write(data)
+        self.tempfile.close()
+        if not data:
+            self.logger.debug('Problem receiving or parsing message')
+            return False
+        else:
+            self.logger.debug('Incoming message received')
+        return True
+
     def parse_remove_env_data(self, data):
         """
         Check if there is envelop data prepend to the message. If yes, parse it and store sender, receivers, ...
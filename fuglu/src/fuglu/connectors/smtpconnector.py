@@ -17,24 +17,23 @@
 import smtplib
 import logging
 import socket
-import tempfile
 import os
 import re
+import time
+import threading
 
-from fuglu.shared import Suspect, apply_template
+from fuglu.shared import Suspect, MessageSpool, apply_template, HEADER_SEPARATOR
 from fuglu.protocolbase import ProtocolHandler, BasicTCPServer
+from fuglu.stats import Statskeeper, StatDelta
 from email.header import Header
 from fuglu.stringencode import force_bString, force_uString
 
 
-def buildmsgsource(suspect):
-    """Build the message source with fuglu headers prepended"""
+def buildmsgheaders(suspect):
+    """Build the fuglu headers to prepend to the message source"""
 
     # we must prepend headers manually as we can't set a header order in email
     # objects
-
-    # -> the original message source is bytes
-    origmsgtxt = suspect.get_source()
     newheaders = ""
 
     for key in suspect.addheaders:
@@ -43,13 +42,81 @@ def buildmsgsource(suspect):
         #self.logger.debug('Adding header %s : %s'%(key,val))
         hdr = Header(val, header_name=key, continuation_ws=' ')
         newheaders += "%s: %s\r\n" % (key, hdr.encode())
+    return force_bString(newheaders)
+
+
+def buildmsgsource(suspect):
+    """Build the message source with fuglu headers prepended"""
+
+    # -> the original message source is bytes
+    origmsgtxt = suspect.get_source()
 
     # the original message should be in bytes, make sure the header added
     # is an encoded string as well
-    modifiedtext = force_bString(newheaders) + force_bString(origmsgtxt)
+    modifiedtext = buildmsgheaders(suspect) + force_bString(origmsgtxt)
     return modifiedtext
 
 
+class StreamedMessage(object):
+    """
+    Message for re-injection with FUSMTPClient. The headers to prepend and the message
+    source are sent in chunks without building the complete message in memory.
+
+    Args:
+        headers (bytes): headers to prepend
+        source (bytes-like): message source, for example Suspect.get_source_view()
+
+    Keyword Args:
+        chunksize (int): size of the chunks sent
+        filename (str): file containing the source at offset, allows sending it with sendfile
+        offset (int): position of the source in filename
+    """
+
+    def __init__(self, headers, source, chunksize=65536, filename=None, offset=0):
+        self.headers = headers
+        self.source = memoryview(source)
+        self.chunksize = chunksize
+        self.filename = filename
+        self.offset = offset
+
+    @classmethod
+    def from_suspect(cls, suspect, headers=b"", original=False):
+        """
+        Create the message for the current (or original) source of a suspect. If only the
+        headers have been modified the new headers are sent with the original body. The
+        tempfile is only referenced if it contains the body to send and has been written anyway.
+        """
+        if original or not suspect.is_modified():
+            source = suspect.get_original_source_view()
+            offset = 0
+        elif not suspect.is_body_modified():
+            # the body is still the same as in the tempfile
+            current = suspect.get_source_view()
+            source = suspect.get_original_source_view()
+            newseparator = HEADER_SEPARATOR.search(current)
+            oldseparator = HEADER_SEPARATOR.search(source)
+            offset = oldseparator.end() if oldseparator else len(source)
+            headers = headers + current[:newseparator.end() if newseparator else len(current)].tobytes()
+            source = source[offset:]
+        else:
+            return cls(headers, suspect.get_source_view())
+        filename = None if suspect.source_in_memory else suspect.tempfile
+        return cls(headers, source, filename=filename, offset=offset)
+
+    def __len__(self):
+        return len(self.headers) + len(self.source)
+
+    def __iter__(self):
+        if self.headers:
+            yield self.headers
+        for chunk in self.source_chunks():
+            yield chunk
+
+    def source_chunks(self):
+        for start in range(0, len(self.source), self.chunksize):
+            yield self.source[start:start + self.chunksize]
+
+
 class SMTPHandler(ProtocolHandler):
     protoname = 'SMTP (after queue)'
 
@@ -69,14 +136,19 @@ class SMTPHandler(ProtocolHandler):
 
         if suspect.get_tag('reinjectoriginal'):
             self.logger.info('%s: Injecting original message source without modifications' % suspect.id)
-            msgcontent = suspect.get_original_source()
+            msgcontent = StreamedMessage.from_suspect(suspect, original=True)
         else:
-            msgcontent = buildmsgsource(suspect)
+            msgcontent = StreamedMessage.from_suspect(suspect, headers=buildmsgheaders(suspect))
 
         targethost = self.config.get('main', 'outgoinghost')
         if targethost == '${injecthost}':
             targethost = self.socket.getpeername()[0]
-        client = FUSMTPClient(targethost, self.config.getint('main', 'outgoingport'))
+        use_bdat = self.config.get('main', 'outgoingtransport').strip().upper() == 'BDAT'
+        try:
+            maxage = self.config.getint('performance', 'reinject_pool_maxage')
+            maxmessages = self.config.getint('performance', 'reinject_pool_maxmessages')
+        except Exception:
+            maxage = maxmessages = 0
         helo = self.config.get('main', 'outgoinghelo')
         if helo.strip() == '':
             helo = socket.gethostname()
@@ -108,23 +180,31 @@ class SMTPHandler(ProtocolHandler):
 
         serveranswer = None
         responsecode = None
+        client = None
+        reusable = False
         try:
-            if mail_options:
-                client.ehlo(helo)
-            else:
-                client.helo(helo)
-
-            # for sending, make sure the string to sent is byte string
+            # CHUNKING is an ESMTP extension as well
+            client, reused = reinject_pool.get(targethost, self.config.getint('main', 'outgoingport'), helo,
+                                               esmtp=bool(mail_options) or use_bdat,
+                                               maxage=maxage, maxmessages=maxmessages)
+            Statskeeper().increase_counter_values(StatDelta(reinject_reused=int(reused),
+                                                            reinject_new=int(not reused)))
+            client.use_bdat = use_bdat
+
+            # the message is streamed from the source, see FUSMTPClient.data
             client.sendmail(force_uString(suspect.from_address),
                             force_uString(suspect.recipients),
-                            force_bString(msgcontent),
+                            msgcontent,
                             mail_options=mail_options)
             # if we did not get an exception so far, we can grab the server answer using the patched client
             # servercode=client.lastservercode
             responsecode = 250
             serveranswer = client.lastserveranswer
+            reusable = True
         except (smtplib.SMTPHeloError, smtplib.SMTPRecipientsRefused,
                 smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            # smtplib resets the transaction if the server refuses it
+            reusable = not isinstance(e, smtplib.SMTPHeloError)
             if isinstance(e, smtplib.SMTPResponseException):
                 responsecode = e.smtp_code
                 serveranswer = e.smtp_error
@@ -132,10 +212,9 @@ class SMTPHandler(ProtocolHandler):
                 responsecode = 451
                 serveranswer = str(e)
         finally:
-            try:
-                client.quit()
-            except Exception as e:
-                self.logger.warning('Exception while quitting re-inject session: %s' % str(e))
+            if client is not None:
+                reinject_pool.release(client, reusable=reusable,
+                                      maxage=maxage, maxmessages=maxmessages)
 
         if responsecode is None:
             self.logger.warning('Re-inject: could not get server response code.')
@@ -148,17 +227,16 @@ class SMTPHandler(ProtocolHandler):
         return responsecode, force_uString(serveranswer)
 
     def get_suspect(self):
-        success = self.sess.getincomingmail()
+        success = self.receive()
         if not success:
             self.logger.error('incoming smtp transfer did not finish')
             return None
 
         sess = self.sess
         fromaddr = sess.from_address
-        tempfilename = sess.tempfilename
 
         try:
-            suspect = Suspect(fromaddr, sess.recipients, tempfilename,
+            suspect = Suspect(fromaddr, sess.recipients, sess.tempfile,
                               att_cachelimit=self._att_mgr_cachesize, smtp_options=sess.smtpoptions)
         except ValueError as e:
             if len(sess.recipients) > 0:
@@ -183,6 +261,11 @@ class SMTPHandler(ProtocolHandler):
         self.sess.endsession(injectcode, message)
         self.sess = None
 
+    def refuse(self, reason):
+        # 421 greeting, the client has to close the connection (RFC 5321, 3.8)
+        self.sess.socket.sendall(force_bString("421 4.3.2 %s\r\n" % reason))
+        self.sess.closeconn()
+
     def defer(self, reason):
         self.sess.endsession(451, reason)
 
@@ -200,12 +283,72 @@ class FUSMTPClient(smtplib.SMTP):
     after we have successfully re-injected. We need this so we can find out the new Queue-ID
     """
 
+    LINESTART_PERIOD = re.compile(b"\n\\.")
+
+    use_bdat = False
+    """send StreamedMessages using BDAT if the server supports CHUNKING"""
+
     def getreply(self):
         code, response = smtplib.SMTP.getreply(self)
         self.lastserveranswer = response
         self.lastservercode = code
         return code, response
 
+    def data(self, msg):
+        """
+        SMTP 'DATA' command, msg can be a StreamedMessage which is sent chunk
+        by chunk, leading periods are quoted on the fly. Like for bytes in
+        smtplib line endings are not changed.
+        """
+        if not isinstance(msg, StreamedMessage):
+            return smtplib.SMTP.data(self, msg)
+        if self.use_bdat and self.has_extn('chunking'):
+            return self.bdat(msg)
+
+        self.putcmd("data")
+        code, repl = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+
+        linestart = True
+        ending = b""
+        for chunk in msg:
+            if not len(chunk):
+                continue
+            if linestart and chunk[:1] == b".":
+                self.send(b".")
+            if FUSMTPClient.LINESTART_PERIOD.search(chunk) is not None:
+                chunk = FUSMTPClient.LINESTART_PERIOD.sub(b"\n..", chunk)
+            self.send(chunk)
+            ending = (ending + bytes(chunk[-2:]))[-2:]
+            linestart = ending[-1:] == b"\n"
+
+        if ending != b"\r\n":
+            self.send(b"\r\n")
+        self.send(b".\r\n")
+        return self.getreply()
+
+    def bdat(self, msg):
+        """
+        Send a StreamedMessage as one chunk using 'BDAT <size> LAST' (RFC 3030),
+        the message is sent as it is without dot-stuffing. If the StreamedMessage
+        references a file the source is sent with sendfile.
+        """
+        self.putcmd("bdat", "%u LAST" % len(msg))
+        if msg.headers:
+            self.send(msg.headers)
+        if msg.filename is not None:
+            with open(msg.filename, 'rb') as fh:
+                try:
+                    self.sock.sendfile(fh, msg.offset, len(msg.source))
+                except OSError:
+                    self.close()
+                    raise smtplib.SMTPServerDisconnected('Server not connected')
+        else:
+            for chunk in msg.source_chunks():
+                self.send(chunk)
+        return self.getreply()
+
 
 class SMTPServer(BasicTCPServer):
 
@@ -220,6 +363,11 @@ class SMTPSession(object):
     ST_RCPT = 3
     ST_DATA = 4
     ST_QUIT = 5
+
+    RECV_BUFSIZE = 262144
+
+    blocking_commands = False
+    """doCommand blocks, the asyncio variant runs it in the default executor of the loop"""
     
     
     def __init__(self, socket, config):
@@ -227,15 +375,28 @@ class SMTPSession(object):
         self.from_address = None
         self.recipients = []
         self.helo = None
-        self.dataAccum = None
+        # received bytes not processed yet (incomplete command line, end of a data chunk)
+        self._inbuf = b""
+        # message data: the next byte starts a new line
+        self._data_linestart = True
+        # BDAT: octets of the current chunk not received yet, None if not in a chunk
+        self._bdat_remaining = None
+        self._bdat_size = 0
+        self._bdat_last = False
+        self._bdat_error = None
+        # BDAT: a message is transferred in chunks, only the last chunk completes it
+        self._bdat_transfer = False
 
         self.socket = socket
         self.state = SMTPSession.ST_INIT
         self.logger = logging.getLogger("fuglu.smtpsession")
-        self.tempfilename = None
         self.tempfile = None
         self.smtpoptions = set()
         self.ehlo_options = ["SMTPUTF8", "8BITMIME"]
+        if config.getboolean('main', 'incomingpipelining', fallback=False):
+            self.ehlo_options.append("PIPELINING")
+        if config.getboolean('main', 'incomingchunking', fallback=False):
+            self.ehlo_options.append("CHUNKING")
 
     
     def endsession(self, code, message):
@@ -243,7 +404,10 @@ class SMTPSession(object):
 
         rawdata = b''
         while True:
-            lump = self.socket.recv(1024)
+            if self._inbuf:
+                lump, self._inbuf = self._inbuf, b""
+            else:
+                lump = self.socket.recv(1024)
 
             if len(lump):
 
@@ -273,86 +437,206 @@ class SMTPSession(object):
             self.socket.close()
     
     
+    @property
+    def tempfilename(self):
+        """filename of the received message, None if it is kept in memory"""
+        if self.tempfile is None:
+            return None
+        return self.tempfile.filename
+
     def _close_tempfile(self):
         if self.tempfile and not self.tempfile.closed:
             self.tempfile.close()
+
+    def _discard_tempfile(self):
+        """drop a partially received message"""
+        self._close_tempfile()
+        if self.tempfile is not None and self.tempfile.filename is not None:
+            try:
+                os.remove(self.tempfile.filename)
+            except OSError:
+                pass
+        self.tempfile = None
     
 
     def getincomingmail(self):
         """return true if mail got in, false on error Session will be kept open"""
         self.socket.send(force_bString("220 fuglu scanner ready \r\n"))
 
+        buf = bytearray(self.RECV_BUFSIZE)
         while True:
-            completeLine = 0
-            collect_lumps = []
-            while not completeLine:
+            size = self.socket.recv_into(buf)
+            if not size:
+                # EOF
+                self.logger.error("EOF, something went wrong!")
+                return False
 
-                lump = self.socket.recv(1024)
+            try:
+                replies, complete = self.receive(buf, size)
+            except IOError:
+                self.endsession(421, "Could not write to temp file")
+                self._close_tempfile()
+                return False
 
-                if len(lump):
-                    # collect the lumps into a list
-                    collect_lumps.append(lump)
-
-                    # check for \r\n in the last two characters sent...
-                    if len(lump) > 1:
-                        if lump[-2:] == b'\r\n':
-                            completeLine = 1
-                    elif (len(collect_lumps) > 1 and (lump[-1:] == b'\n' and collect_lumps[-2][-1:] == b'\r')):
-                        # we reach here if the \r\n has been split:
-                        # collect_lumps[-2] = b"....\r"
-                        # lump = b"\n"
-                        #
-                        # Note the "-2" in collect_lumps because the current lump has been added already
-                        completeLine = 1
-
-                    if completeLine == 1:
-
-                        # if line is complete, concatenate the bytes string
-                        # this is MUCH FASTER than doing something like
-                        # rawdata += lump
-                        # outside the completeLine if-condition for every lump
-                        rawdata = b"".join(collect_lumps)
-
-                        if self.state != SMTPSession.ST_DATA:
-
-                            # convert data to unicode if needed
-                            data = force_uString(rawdata)
-                            rsp, keep = self.doCommand(data)
-
-                        else:
-                            try:
-                                #directly use raw bytes-string data
-                                rsp = self.doData(rawdata)
-                            except IOError:
-
-                                self.endsession(
-                                    421, "Could not write to temp file")
-                                self._close_tempfile()
-                                return False
-
-                            if rsp is None:
-                                continue
-                            else:
-                                # data finished.. keep connection open though
-                                return True
-
-                        self.socket.send(force_bString(rsp + "\r\n"))
-
-                        if keep == 0:
-                            self.closeconn()
-                            return False
-                else:
-                    # EOF
-                    self.logger.error("EOF, something went wrong!")
+            if replies:
+                self.socket.sendall(force_bString("".join(rsp + "\r\n" for rsp, keep in replies)))
+                if not replies[-1][1]:
+                    self.closeconn()
                     return False
+            if complete:
+                # data finished.. keep connection open though
+                return True
     
     
+    async def getincomingmail_async(self, loop):
+        """asyncio variant of getincomingmail, socket has to be non-blocking"""
+        await loop.sock_sendall(self.socket, force_bString("220 fuglu scanner ready \r\n"))
+
+        buf = bytearray(self.RECV_BUFSIZE)
+        while True:
+            size = await loop.sock_recv_into(self.socket, buf)
+            if not size:
+                # EOF
+                self.logger.error("EOF, something went wrong!")
+                return False
+
+            try:
+                if self.blocking_commands:
+                    replies, complete = await loop.run_in_executor(None, self.receive, buf, size)
+                else:
+                    replies, complete = self.receive(buf, size)
+            except IOError:
+                self.socket.setblocking(True)
+                self.endsession(421, "Could not write to temp file")
+                self._close_tempfile()
+                return False
+
+            if replies:
+                await loop.sock_sendall(self.socket, force_bString("".join(rsp + "\r\n" for rsp, keep in replies)))
+                if not replies[-1][1]:
+                    self.closeconn()
+                    return False
+            if complete:
+                # data finished.. keep connection open though
+                return True
+
+
+    def receive(self, buf, size):
+        """
+        Process received bytes: complete command lines are passed to doCommand,
+        message data is unstuffed and written to the spool as it arrives, BDAT
+        chunks are written as they are. All commands received are processed, the
+        replies are sent together (PIPELINING, RFC 2920).
+
+        Args:
+            buf (bytearray): receive buffer, it can be reused as soon as this returns
+            size (int): number of bytes received into buf
+
+        Returns:
+            (list, bool): replies (response, keep) to send and whether the message
+            has been received completely
+        """
+        if self._inbuf:
+            buf = self._inbuf + bytes(buf[:size])
+            size = len(buf)
+            self._inbuf = b""
+
+        replies = []
+        pos = 0
+        while pos < size or self._bdat_remaining == 0:
+            if self._bdat_remaining is not None:
+                count = min(self._bdat_remaining, size - pos)
+                if count and self._bdat_error is None:
+                    self.tempfile.write(memoryview(buf)[pos:pos + count])
+                pos += count
+                self._bdat_remaining -= count
+                if self._bdat_remaining:
+                    break
+                self._bdat_remaining = None
+                if self._bdat_error is not None:
+                    replies.append((self._bdat_error, 1))
+                elif self._bdat_last:
+                    self._bdat_transfer = False
+                    self._inbuf = bytes(buf[pos:size])
+                    self._close_tempfile()
+                    self.state = SMTPSession.ST_HELO
+                    return replies, True
+                else:
+                    replies.append(("250 %s octets received" % self._bdat_size, 1))
+                continue
+
+            if self.state == SMTPSession.ST_DATA:
+                pos = self._receive_data(buf, pos, size)
+                if pos is None:
+                    break
+                self._inbuf = bytes(buf[pos:size])
+                self._close_tempfile()
+                self.state = SMTPSession.ST_HELO
+                return replies, True
+
+            end = buf.find(b"\r\n", pos, size)
+            if end < 0:
+                self._inbuf = bytes(buf[pos:size])
+                break
+            rsp, keep = self.doCommand(force_uString(bytes(buf[pos:end + 2])))
+            if rsp is not None:
+                replies.append((rsp, keep))
+            pos = end + 2
+            if keep == 0:
+                break
+        return replies, False
+
+
+    def _receive_data(self, buf, pos, size):
+        """
+        Write message data to the spool, a period at the beginning of a line is removed
+        (dot-stuffing, RFC 5321 section 4.5.2). Returns the position after the terminating
+        '.\\r\\n' line or None if the message continues.
+        """
+        if self._data_linestart and pos < size:
+            if buf[pos] == 0x2e:  # "."
+                if buf.startswith(b".\r\n", pos, size):
+                    return pos + 3
+                if size - pos < 3 and b".\r\n".startswith(buf[pos:size]):
+                    # can't tell yet if this is the end of the message
+                    self._inbuf = bytes(buf[pos:size])
+                    return None
+                pos += 1
+            self._data_linestart = False
+
+        terminator = buf.find(b"\n.\r\n", pos, size)
+        if terminator >= 0:
+            stop = terminator + 1
+        elif buf.endswith(b"\n.", pos, size):
+            stop = size - 1
+        elif buf.endswith(b"\n.\r", pos, size):
+            stop = size - 2
+        else:
+            stop = size
+
+        if pos < stop:
+            if buf.find(b"\n.", pos, stop) < 0:
+                self.tempfile.write(memoryview(buf)[pos:stop])
+            else:
+                self.tempfile.write(bytes(buf[pos:stop]).replace(b"\n.", b"\n"))
+            self._data_linestart = buf[stop - 1] == 0x0a  # "\n"
+
+        if terminator >= 0:
+            return terminator + 4
+        if stop < size:
+            # the next line starts with a dot, the message may end there
+            self._inbuf = bytes(buf[stop:size])
+        return None
+
+
     def doCommand(self, data):
         """Process a single SMTP Command"""
         cmd = data[0:4]
         cmd = cmd.upper()
         keep = 1
         rv = "250 OK"
+        if self._bdat_transfer and cmd not in ("BDAT", "RSET", "NOOP", "QUIT"):
+            return "503 Bad command sequence", 1
         if cmd == "HELO":
             self.state = SMTPSession.ST_HELO
             self.helo = data
@@ -365,15 +649,17 @@ class SMTPSession(object):
                 helo = socket.gethostname()
             if len(self.ehlo_options) > 0:
                 answer = [helo] + self.ehlo_options
-                rv = "250-"+"250-".join(a+"\n" for a in answer[:-1])+"250 %s" % answer[-1]
+                rv = "250-"+"250-".join(a+"\r\n" for a in answer[:-1])+"250 %s" % answer[-1]
             else:
                 rv = '250 %s' % helo
         elif cmd == "RSET":
             self.from_address = None
             self.recipients = []
             self.helo = None
-            self.dataAccum = ""
             self.state = SMTPSession.ST_INIT
+            if self._bdat_transfer:
+                self._bdat_transfer = False
+                self._discard_tempfile()
         elif cmd == "NOOP":
             pass
         elif cmd == "QUIT":
@@ -393,54 +679,48 @@ class SMTPSession(object):
             if self.state != SMTPSession.ST_RCPT:
                 return "503 Bad command sequence", 1
             self.state = SMTPSession.ST_DATA
-            self.dataAccum = b""
+            self._data_linestart = True
             try:
-                (handle, tempfilename) = tempfile.mkstemp(
-                    prefix='fuglu', dir=self.config.get('main', 'tempdir'))
-                self.tempfilename = tempfilename
-                self.tempfile = os.fdopen(handle, 'w+b')
+                self.tempfile = MessageSpool.from_config(self.config)
             except Exception as e:
                 self.endsession(421, "could not create file: %s" % str(e))
                 self._close_tempfile()
             return "354 OK, Enter data, terminated with a \\r\\n.\\r\\n", 1
+        elif cmd == "BDAT":
+            return self.doBdat(data)
         else:
             return "505 Bad SMTP command", 1
 
         return rv, keep
-    
-    
-    def doData(self, data):
-        """Store data in temporary file
-
-        Args:
-            data (str or bytes): data as byte-string
 
+    def doBdat(self, data):
         """
-        data = self.unquoteData(data)
-        # store the last few bytes in memory to keep track when the msg is
-        # finished
-        self.dataAccum = self.dataAccum + data
-
-        if len(self.dataAccum) > 4:
-            self.dataAccum = self.dataAccum[-5:]
-
-        if len(self.dataAccum) > 4 and self.dataAccum[-5:] == force_bString('\r\n.\r\n'):
-            # check if there is more data to write to the file
-            if len(data) > 4:
-                self.tempfile.write(data[0:-5])
-
-            self._close_tempfile()
-
-            self.state = SMTPSession.ST_HELO
-            return "250 OK - Data and terminator. found"
-        else:
-            self.tempfile.write(data)
-            return None
-    
-    
-    def unquoteData(self, data):
-        """two leading dots at the beginning of a line must be unquoted to a single dot"""
-        return re.sub(b'(?m)^\.\.', b'.', force_bString(data))
+        Start a BDAT chunk (CHUNKING, RFC 3030), the octets are read by receive. The
+        reply is sent when the chunk has been received, so None is returned.
+        """
+        args = data.split()
+        try:
+            size = int(args[1])
+            if size < 0 or len(args) > 3 or (len(args) == 3 and args[2].upper() != "LAST"):
+                raise ValueError()
+        except (IndexError, ValueError):
+            return "501 Syntax: BDAT <size> [LAST]", 1
+
+        self._bdat_remaining = self._bdat_size = size
+        self._bdat_last = len(args) == 3
+        self._bdat_error = None
+        if "CHUNKING" not in self.ehlo_options:
+            # the octets still have to be read
+            self._bdat_error = "505 Bad SMTP command"
+        elif self.state != SMTPSession.ST_RCPT:
+            self._bdat_error = "503 Bad command sequence"
+        elif not self._bdat_transfer:
+            try:
+                self.tempfile = MessageSpool.from_config(self.config)
+                self._bdat_transfer = True
+            except Exception as e:
+                self._bdat_error = "451 could not create file: %s" % str(e)
+        return None, 1
     
     
     def stripAddress(self, address):
@@ -480,3 +760,121 @@ class SMTPSession(object):
                 self.logger.debug("mail contains 8bit-MIME")
                 self.smtpoptions.add("BODY=8BITMIME")
         return retaddr
+
+
+class SMTPConnectionPool(object):
+    """
+    Keeps re-inject connections open between messages. Idle connections are shared by
+    all threads, a connection taken from the pool belongs to the thread until it's
+    released, so it's only used for one message at a time. Before a connection is used
+    again it is reset with RSET, which also checks it's still alive.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}  # key -> idle connections, most recently used last
+        self.generation = 0
+        self.logger = logging.getLogger('fuglu.smtpconnectionpool')
+
+    def get(self, host, port, helo, esmtp=False, maxage=0, maxmessages=0):
+        """
+        Get a connection which already greeted the server
+
+        Args:
+            host (str): target host
+            port (int): target port
+            helo (str): name sent with HELO/EHLO
+
+        Keyword Args:
+            esmtp (bool): use EHLO, falls back to HELO if the server doesn't support it
+            maxage (int): maximum age of a reused connection in seconds, 0: don't keep connections
+            maxmessages (int): maximum number of messages sent over a connection, 0: no limit
+
+        Returns:
+            (FUSMTPClient, bool): the connection and whether it has been reused
+        """
+        key = (host, port, helo, esmtp)
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                client = idle.pop() if idle else None
+            if client is None:
+                break
+            if self._usable(client, maxage, maxmessages):
+                return client, True
+            self._close(client)
+
+        with self.lock:
+            generation = self.generation
+        client = FUSMTPClient(host, port)
+        client.pool_key = key
+        client.pool_created = time.time()
+        client.pool_messages = 0
+        client.pool_generation = generation
+        if esmtp:
+            code, _ = client.ehlo(helo)
+            if not 200 <= code <= 299:
+                client.helo(helo)
+        else:
+            client.helo(helo)
+        return client, False
+
+    def release(self, client, reusable=True, maxage=0, maxmessages=0):
+        """
+        Give back a connection after a transaction, it is closed unless it's reusable
+        and within the limits (see get)
+        """
+        client.pool_messages += 1
+        client.command_encoding = 'ascii'
+        expired = []
+        with self.lock:
+            idle = self.idle.setdefault(client.pool_key, [])
+            # connections nobody asked for anymore
+            while idle and not self._within_limits(idle[0], maxage, maxmessages):
+                expired.append(idle.pop(0))
+            if reusable and client.sock is not None and client.pool_generation == self.generation \
+                    and self._within_limits(client, maxage, maxmessages):
+                idle.append(client)
+            else:
+                expired.append(client)
+        for connection in expired:
+            self._close(connection)
+
+    def close_all(self):
+        """
+        close all idle connections, connections in use are closed when they are released
+        """
+        with self.lock:
+            self.generation += 1
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for client in connections:
+                self._close(client)
+
+    @staticmethod
+    def _within_limits(client, maxage, maxmessages):
+        if maxage <= 0 or time.time() - client.pool_created >= maxage:
+            return False
+        return maxmessages <= 0 or client.pool_messages < maxmessages
+
+    def _usable(self, client, maxage, maxmessages):
+        if not self._within_limits(client, maxage, maxmessages):
+            return False
+        try:
+            code, _ = client.rset()
+        except (smtplib.SMTPException, OSError) as e:
+            self.logger.debug('re-inject connection to %s:%s is not usable anymore: %s'
+                              % (client.pool_key[0], client.pool_key[1], str(e)))
+            return False
+        return code == 250
+
+    def _close(self, client):
+        try:
+            client.quit()
+        except Exception as e:
+            self.logger.warning('Exception while quitting re-inject session: %s' % str(e))
+            client.close()
+
+
+reinject_pool = SMTPConnectionPool()
@@ -32,13 +32,14 @@ from fuglu import __version__ as FUGLU_VERSION
 from fuglu.connectors.esmtpconnector import ESMTPServer
 from fuglu.connectors.milterconnector import MilterServer
 from fuglu.connectors.ncconnector import NCServer
-from fuglu.connectors.smtpconnector import SMTPServer
+from fuglu.connectors.smtpconnector import SMTPServer, reinject_pool
 from fuglu.debug import ControlServer, CrashStore
 from fuglu.funkyconsole import FunkyConsole
 from fuglu.shared import (HAVE_BEAUTIFULSOUP, Suspect, default_template_values)
 from fuglu.stats import StatsThread
 from fuglu.stringencode import force_bString, force_uString
 from fuglu.threadpool import ThreadPool
+from fuglu.asyncpool import AsyncioPool
 from fuglu.mixins import DefConfigMixin
 
 
@@ -227,6 +228,18 @@ class MainController(DefConfigMixin):
                 'default': "10025,10099,10888",
             },
 
+            'incomingpipelining': {
+                'section': 'main',
+                'description': "advertise PIPELINING (RFC 2920) to clients of the smtp and esmtp connectors, pipelined commands are answered together",
+                'default': "False",
+            },
+
+            'incomingchunking': {
+                'section': 'main',
+                'description': "advertise CHUNKING (RFC 3030) to clients of the smtp and esmtp connectors, messages sent with BDAT are stored without dot-unstuffing",
+                'default': "False",
+            },
+
             'outgoinghost': {
                 'section': 'main',
                 'description': "outgoing hostname/ip where postfix is listening for re-injects.\nuse ${injecthost} to connect back to the IP where the incoming connection came from",
@@ -245,6 +258,12 @@ class MainController(DefConfigMixin):
                 'default': "",
             },
 
+            'outgoingtransport': {
+                'section': 'main',
+                'description': "command to re-inject messages with the SMTP connector: DATA or BDAT.\nBDAT sends the message without dot-stuffing if the MTA advertises CHUNKING (RFC 3030), unmodified messages are sent straight from the tempfile using sendfile. Falls back to DATA if CHUNKING is not supported",
+                'default': "DATA",
+            },
+
             'tempdir': {
                 'section': 'main',
                 'description': "temp dir where fuglu can store messages while scanning",
@@ -360,17 +379,152 @@ class MainController(DefConfigMixin):
                 'section': 'performance',
                 'description': 'minimum free scanner threads',
             },
+            'target_latency': {
+                'default': "0",
+                'section': 'performance',
+                'description': "backend='thread' or 'hybrid': target time in seconds a message waits in the queue for a scanner thread. If > 0, threads are added as soon as messages wait without idle thread and idle threads are removed based on the averaged busy ratio. 0 (the default) checks the pool size every 10 seconds",
+            },
+            'min_busy_ratio': {
+                'default': "0.5",
+                'section': 'performance',
+                'description': "with target_latency: remove idle threads while the averaged ratio of busy threads is below this value",
+            },
             'backend': {
                 'default': "thread",
                 'section': 'performance',
-                'description': "Method for parallelism, either 'thread' or 'process' ",
+                'description': "Method for parallelism, either 'thread', 'process', 'hybrid' (processes running a threadpool each) or 'asyncio' (connections handled in an event loop, scanning in maxthreads threads)",
+            },
+            'reuseport': {
+                'default': "0",
+                'section': 'performance',
+                'description': "backend='process' or 'hybrid' only: every worker process binds the incoming ports itself using SO_REUSEPORT, the kernel distributes the connections instead of the main process passing sockets to the workers",
+            },
+            'plugin_concurrency': {
+                'default': "1",
+                'section': 'performance',
+                'description': "maximum number of scanner plugins running concurrently for a message. Only plugins declaring the tags they use and not depending on each other are run concurrently. 1: run plugins sequentially",
+            },
+            'message_deadline': {
+                'default': "0",
+                'section': 'performance',
+                'description': "maximum time in seconds for running the scanner plugins of a message, plugins still running are abandoned, their changes to the message are discarded, and the remaining plugins are skipped. Individual plugins can get a time budget with the option scan_budget in the plugin section. 0: no deadline",
+            },
+            'deadline_action': {
+                'default': "DEFER",
+                'section': 'performance',
+                'description': "action if the message_deadline expires before a plugin made a final decision",
+            },
+            'deadline_message': {
+                'default': "Message could not be scanned in time, try again later",
+                'section': 'performance',
+                'description': "message returned with deadline_action",
+            },
+            'plugin_abandoned_max': {
+                'default': "10",
+                'section': 'performance',
+                'description': "maximum number of abandoned threads of a scanner plugin still running in the background. Once reached the plugin is not started anymore and handled like a plugin which timed out until some of them finished. 0: no limit",
+            },
+            'admission_max_queue': {
+                'default': "0",
+                'section': 'performance',
+                'description': "admission control: refuse new connections with a temporary failure (421 / milter tempfail) while this many connections wait in the work queue. 0 to disable",
+            },
+            'admission_max_wait': {
+                'default': "0",
+                'section': 'performance',
+                'description': "admission control: refuse new connections while the estimated queue waiting time is above this value in seconds (backend='thread' and 'asyncio' only). 0 to disable",
+            },
+            'admission_message': {
+                'default': "Service temporarily unavailable, try again later",
+                'section': 'performance',
+                'description': "message sent to the client if the connection is refused by admission control",
             },
             'initialprocs': {
                 'default': "0",
                 'section': 'performance',
-                'description': "Initial number of processes when backend='process'. If 0 (the default), automatically selects twice the number of available virtual cores. Despite its 'initial'-name, this number currently is not adapted automatically.",
+                'description': "Initial number of processes when backend='process'. If 0 (the default), automatically selects twice the number of available virtual cores (for backend='hybrid' the number of virtual cores). Despite its 'initial'-name, this number currently is not adapted automatically.",
+            },
+            'preload_plugins': {
+                'default': "0",
+                'section': 'performance',
+                'description': "backend='process' or 'hybrid' only: worker processes use the plugins loaded by the main process instead of loading them again after the fork. Saves memory and makes starting workers fast, but plugins must not open connections to backends in their constructor",
+            },
+            'reload_batchsize': {
+                'default': "0",
+                'section': 'performance',
+                'description': "backend='process' or 'hybrid' only: on reload replace this many worker processes at a time by workers with the new configuration, the old workers finish their sessions first. 0: start a new process pool and shut down the old one. A new pool is always started if the number of processes or threads changes",
+            },
+            'max_messages_per_worker': {
+                'default': "0",
+                'section': 'performance',
+                'description': "backend='process' or 'hybrid' only: replace a worker process by a new one after processing this many messages. 0: no limit",
+            },
+            'max_rss_per_worker': {
+                'default': "0",
+                'section': 'performance',
+                'description': "backend='process' or 'hybrid' only: replace a worker process by a new one once its resident memory exceeds this many megabytes. 0: no limit",
+            },
+            'hybrid_minthreads': {
+                'default': "2",
+                'section': 'performance',
+                'description': "minimum scanner threads per process when backend='hybrid'",
+            },
+            'hybrid_maxthreads': {
+                'default': "10",
+                'section': 'performance',
+                'description': "maximum scanner threads per process when backend='hybrid'",
             },
 
+            'memory_spool_maxsize': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Messages up to this size (in bytes) are received in memory instead of a tempfile in main.tempdir. The message is written to disk only if it grows larger or a plugin needs a file (for example ArchivePlugin with storeoriginal). 0: always use a tempfile"
+            },
+            'reinject_pool_maxage': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Keep SMTP connections used to re-inject messages open for this many seconds and reuse them for the following messages (idle connections are shared by the scanner threads and reset with RSET before reuse). 0: open a new connection for every message"
+            },
+            'reinject_pool_maxmessages': {
+                'default': "100",
+                'section': 'performance',
+                'description': "Maximum number of messages re-injected over one pooled connection. 0: no limit"
+            },
+            'avcache_ttl': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Cache the verdicts of the AV scanner plugins for this many seconds, messages with the same content are not sent to the scanner again. The key contains the signature version if the engine reports it (ClamAV, DrWeb). 0: disabled"
+            },
+            'avcache_maxsize': {
+                'default': "10000",
+                'section': 'performance',
+                'description': "Maximum number of verdicts kept in memory by the AV verdict cache (per process)"
+            },
+            'avcache_redis': {
+                'default': "",
+                'section': 'performance',
+                'description': "Store the AV verdicts in redis instead of memory to share them between processes and hosts (host:port:db). Leave empty to cache in memory"
+            },
+            'avcache_redispw': {
+                'default': "",
+                'section': 'performance',
+                'description': "password to connect to the AV verdict cache redis database. leave empty for no password"
+            },
+            'backendpool_maxsize': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Maximum number of connections open at the same time to one scanner backend (clamd, spamd, SSSP, DrWeb, F-Prot, ICAP) per process, scanner threads wait for a free connection. 0: no limit"
+            },
+            'backendpool_maxidle': {
+                'default': "20",
+                'section': 'performance',
+                'description': "Keep backend connections which can be reused (clamd with pipelining) open for this many seconds without use. Should be below the idle timeout of the backend (clamd: IdleTimeout)"
+            },
+            'backendpool_waittimeout': {
+                'default': "30",
+                'section': 'performance',
+                'description': "Maximum time in seconds a scanner thread waits for a free backend connection if backendpool_maxsize is reached"
+            },
             'att_mgr_cachesize': {
                 'default': "50000000",
                 'section': 'performance',
@@ -542,6 +696,9 @@ class MainController(DefConfigMixin):
         self.stayalive = True
         self.threadpool = None
         self.procpool = None
+        self.asyncpool = None
+        # set in worker processes binding their own listening sockets
+        self.reuseport = False
         self.controlserver = None
         self.started = datetime.datetime.now()
         self.statsthread = None
@@ -590,7 +747,16 @@ class MainController(DefConfigMixin):
             raise ValueError("Error in bind definition: %s"%portspec)
         return protocol, bindaddress, port
 
-    def start_connector(self, portspec):
+    def start_connector(self, portspec, serve=True):
+        """
+        Start server for given port specification
+
+        Args:
+            portspec (str): port specification, see get_connectorinfo
+
+        Keyword Args:
+            serve (bool): start a thread accepting connections, if False the caller has to accept
+        """
         protocol = 'smtp'
         bindaddress = self.config.get('main', 'bindaddress')
 
@@ -600,36 +766,22 @@ class MainController(DefConfigMixin):
         try:
             port = int(port)
             if protocol == 'smtp':
-                smtpserver = SMTPServer(
-                    self, port=port, address=bindaddress)
-                tr = threading.Thread(target=smtpserver.serve, args=())
-                tr.daemon = True
-                tr.start()
-                self.servers.append(smtpserver)
+                server = SMTPServer(self, port=port, address=bindaddress)
             elif protocol == 'esmtp':
-                esmtpserver = ESMTPServer(
-                    self, port=port, address=bindaddress)
-                tr = threading.Thread(target=esmtpserver.serve, args=())
-                tr.daemon = True
-                tr.start()
-                self.servers.append(esmtpserver)
+                server = ESMTPServer(self, port=port, address=bindaddress)
             elif protocol == 'milter':
-                milterserver = MilterServer(
-                    self, port=port, address=bindaddress)
-                tr = threading.Thread(target=milterserver.serve, args=())
-                tr.daemon = True
-                tr.start()
-                self.servers.append(milterserver)
+                server = MilterServer(self, port=port, address=bindaddress)
             elif protocol == 'netcat':
-                ncserver = NCServer(
-                    self, port=port, address=bindaddress)
-                tr = threading.Thread(target=ncserver.serve, args=())
-                tr.daemon = True
-                tr.start()
-                self.servers.append(ncserver)
+                server = NCServer(self, port=port, address=bindaddress)
             else:
                 self.logger.error(
                     'Unknown Interface Protocol: %s, ignoring server on port %s' % (protocol, port))
+                return
+            if serve:
+                tr = threading.Thread(target=server.serve, args=())
+                tr.daemon = True
+                tr.start()
+            self.servers.append(server)
         except Exception as e:
             self.logger.error(
                 "could not start connector %s/%s : %s" % (protocol, port, str(e)))
@@ -654,24 +806,131 @@ class MainController(DefConfigMixin):
             maxthreads = 3
             minfreethreads = 0
 
+        try:
+            target_latency = self.config.getfloat('performance', 'target_latency')
+            min_busy_ratio = self.config.getfloat('performance', 'min_busy_ratio')
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            target_latency = 0.0
+            min_busy_ratio = 0.5
+
         queuesize = maxthreads * 10
         return ThreadPool(self,
                           minthreads=minthreads, maxthreads=maxthreads,
-                          queuesize=queuesize, freeworkers=minfreethreads)
+                          queuesize=queuesize, freeworkers=minfreethreads,
+                          target_latency=target_latency, min_busy_ratio=min_busy_ratio)
 
-    def _start_processpool(self):
+    def _procpool_settings(self, backend):
+        """number of processes, min and max threads per process for backend 'process' or 'hybrid'"""
         numprocs = self.config.getint('performance','initialprocs')
+        if backend != 'hybrid':
+            if numprocs < 1:
+                numprocs = multiprocessing.cpu_count() *2
+            return numprocs, 0, 0
+
         if numprocs < 1:
-            numprocs = multiprocessing.cpu_count() *2
+            # threads handle waiting for backends, one process per core is enough
+            numprocs = multiprocessing.cpu_count()
+        minthreads = self.config.getint('performance', 'hybrid_minthreads')
+        maxthreads = self.config.getint('performance', 'hybrid_maxthreads')
+        if minthreads > maxthreads:
+            self.logger.warning('hybrid_minthreads %u > hybrid_maxthreads %u, using %u threads per process'
+                                % (minthreads, maxthreads, maxthreads))
+            minthreads = maxthreads
+        return numprocs, minthreads, maxthreads
+
+    def _start_processpool(self):
+        numprocs, _, _ = self._procpool_settings('process')
         self.logger.info("Init process pool with %s worker processes"%(numprocs))
-        pool = fuglu.procpool.ProcManager(self._logQueue, numprocs = numprocs, config = self.config)
+        pool = fuglu.procpool.ProcManager(self._logQueue, numprocs = numprocs, config = self.config,
+                                          reuseport=self._listen_in_workers(), plugins=self._preloaded_plugins())
+        return pool
+
+    def _start_hybridpool(self):
+        numprocs, minthreads, maxthreads = self._procpool_settings('hybrid')
+        self.logger.info("Init hybrid pool with %s worker processes, %s-%s threads each" % (numprocs, minthreads, maxthreads))
+        pool = fuglu.procpool.ProcManager(self._logQueue, numprocs = numprocs, config = self.config,
+                                          minthreads=minthreads, maxthreads=maxthreads,
+                                          reuseport=self._listen_in_workers(), plugins=self._preloaded_plugins())
         return pool
 
-    def _start_connectors(self):
+    def _rolling_reload_possible(self, backend):
+        """True if reload_batchsize is set and the running procpool can be reloaded by replacing the workers"""
+        try:
+            batchsize = self.config.getint('performance', 'reload_batchsize')
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            batchsize = 0
+        if batchsize < 1 or self.procpool is None or self.threadpool is not None or self.asyncpool is not None:
+            return False
+        numprocs, minthreads, maxthreads = self._procpool_settings(backend)
+        if self.procpool.restart_required(numprocs, minthreads, maxthreads, self._listen_in_workers()):
+            self.logger.info('Number of processes/threads or reuseport changed, rolling reload not possible')
+            return False
+        return True
+
+    def _preloaded_plugins(self):
+        """plugins loaded by this process for the worker processes if preload_plugins is enabled"""
+        try:
+            preload = self.config.getboolean('performance', 'preload_plugins')
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            preload = False
+        if not preload:
+            return None
+        return self.prependers, self.plugins, self.appenders
+
+    def _start_asyncpool(self):
+        self.logger.info("Init Asynciopool")
+        try:
+            maxthreads = self.config.getint('performance', 'maxthreads')
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            self.logger.warning('Performance section not configured, using default thread numbers')
+            maxthreads = 3
+        return AsyncioPool(self, maxthreads=maxthreads)
+
+    def _start_connectors(self, serve=True):
         self.logger.info("Starting interface sockets...")
         ports = self.config.get('main', 'incomingport')
         for port in ports.split(','):
-            self.start_connector(port)
+            self.start_connector(port, serve=serve)
+
+    def _listen_in_workers(self):
+        """True if the worker processes bind the incoming ports themselves (SO_REUSEPORT)"""
+        backend = self.config.get('performance', 'backend')
+        try:
+            reuseport = self.config.getboolean('performance', 'reuseport')
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            reuseport = False
+        return reuseport and backend in ('process', 'hybrid') and hasattr(socket, 'SO_REUSEPORT')
+
+    def admission_check(self):
+        """
+        Check if a new connection can be accepted by the active pool (admission control).
+
+        Returns:
+            (str) reason if the connection has to be refused, None otherwise
+        """
+        pool = self.threadpool or self.procpool or self.asyncpool
+        if pool is None:
+            return None
+        try:
+            max_queue = self.config.getint('performance', 'admission_max_queue')
+            max_wait = self.config.getfloat('performance', 'admission_max_wait')
+        except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
+            return None
+        if max_queue <= 0 and max_wait <= 0:
+            return None
+
+        tasks = getattr(pool, 'tasks', None)
+        if tasks is not None and tasks.full():
+            return 'work queue full'
+        if max_queue > 0:
+            depth = pool.queue_depth()
+            if depth >= max_queue:
+                return 'queue depth %u >= %u' % (depth, max_queue)
+        if max_wait > 0:
+            wait = pool.estimated_wait()
+            if wait > max_wait:
+                return 'estimated wait %.2fs > %.2fs' % (wait, max_wait)
+        return None
 
     def _start_control_server(self):
         control = ControlServer(self, address=self.config.get(
@@ -715,10 +974,17 @@ class MainController(DefConfigMixin):
         backend = self.config.get('performance','backend')
         if backend == 'process':
             self.procpool = self._start_processpool()
+        elif backend == 'hybrid':
+            self.procpool = self._start_hybridpool()
+        elif backend == 'asyncio':
+            self.asyncpool = self._start_asyncpool()
         else: # default backend is 'thread'
             self.threadpool = self._start_threadpool()
 
-        self._start_connectors()
+        if self._listen_in_workers():
+            self.logger.info("Incoming ports are bound by the worker processes (reuseport)")
+        else:
+            self._start_connectors()
         self.controlserver = self._start_control_server()
 
         self.logger.info('Startup complete')
@@ -798,6 +1064,14 @@ class MainController(DefConfigMixin):
 
         backend = self.config.get('performance','backend')
 
+        listen_in_workers = self._listen_in_workers()
+        if listen_in_workers:
+            # the new worker processes can only bind the ports once the main process closed them
+            for serv in self.servers:
+                self.logger.info('Closing server socket on port %s, port will be bound by worker processes' % serv.port)
+                serv.shutdown()
+            self.servers = []
+
         if backend == 'thread':
             if self.threadpool is not None:
                 minthreads = self.config.getint('performance', 'minthreads')
@@ -810,6 +1084,8 @@ class MainController(DefConfigMixin):
                 self.threadpool.minthreads = minthreads
                 self.threadpool.maxthreads = maxthreads
                 self.threadpool.minfreethreads = minfreethreads
+                self.threadpool.target_latency = self.config.getfloat('performance', 'target_latency')
+                self.threadpool.min_busy_ratio = self.config.getfloat('performance', 'min_busy_ratio')
                 self.logger.info('Keep existing threadpool')
             else:
                 self.logger.info('Create new threadpool')
@@ -821,16 +1097,35 @@ class MainController(DefConfigMixin):
                 self.procpool.shutdown(self.threadpool)
                 self.procpool = None
 
-        elif backend == 'process':
+            # stop existing asyncpool
+            if self.asyncpool is not None:
+                self.logger.info('Delete old asyncpool')
+                self.asyncpool.shutdown(self.threadpool)
+                self.asyncpool = None
+
+        elif backend in ('process', 'hybrid') and self._rolling_reload_possible(backend):
+            # replace the workers of the existing procpool step by step
+            batchsize = self.config.getint('performance', 'reload_batchsize')
+            self.logger.info('Rolling reload of processpool, replacing %u workers at a time' % batchsize)
+            self.procpool.rolling_reload(self.config, self._preloaded_plugins(), batchsize)
+
+        elif backend in ('process', 'hybrid'):
             # start new procpool
             currentProcPool = self.procpool
             self.logger.info('Create new processpool')
-            self.procpool = self._start_processpool()
+            if backend == 'hybrid':
+                self.procpool = self._start_hybridpool()
+            else:
+                self.procpool = self._start_processpool()
 
             # stop existing procpool
             # -> the procpool has to be recreated to take configuration changes
             #    into account (each worker process has its own controller unlike using threadpool)
             if currentProcPool is not None:
+                if listen_in_workers:
+                    # the old workers hand over the connections in their accept queues before closing
+                    # their listeners, new connections have to go to the new workers meanwhile
+                    self.procpool.wait_listening()
                 self.logger.info('Delete old processpool')
                 currentProcPool.shutdown(self.procpool)
 
@@ -839,9 +1134,44 @@ class MainController(DefConfigMixin):
                 self.logger.info('Delete old threadpool')
                 self.threadpool.shutdown(self.procpool)
                 self.threadpool = None
+
+            # stop existing asyncpool
+            if self.asyncpool is not None:
+                self.logger.info('Delete old asyncpool')
+                self.asyncpool.shutdown(self.procpool)
+                self.asyncpool = None
+
+        elif backend == 'asyncio':
+            # start new asyncpool, running scans are finished by the old pool
+            currentAsyncPool = self.asyncpool
+            self.logger.info('Create new asyncpool')
+            self.asyncpool = self._start_asyncpool()
+
+            if currentAsyncPool is not None:
+                self.logger.info('Delete old asyncpool')
+                currentAsyncPool.shutdown(self.asyncpool)
+
+            # stop existing threadpool
+            if self.threadpool is not None:
+                self.logger.info('Delete old threadpool')
+                self.threadpool.shutdown(self.asyncpool)
+                self.threadpool = None
+
+            # stop existing procpool
+            if self.procpool is not None:
+                self.logger.info('Delete old procpool')
+                self.procpool.shutdown(self.asyncpool)
+                self.procpool = None
         else:
             self.logger.error('backend not detected -> ignoring input!')
 
+        # re-inject connections are opened again with the new configuration
+        reinject_pool.close_all()
+
+        if listen_in_workers:
+            self.logger.info('Config changes applied')
+            return
+
         # smtp engine changes?
         ports = self.config.get('main', 'incomingport')
         portspeclist = ports.split(',')
@@ -899,6 +1229,13 @@ class MainController(DefConfigMixin):
             self.logger.info('Delete threadpool')
             self.threadpool.shutdown()
             self.threadpool = None
+        # stop existing asyncpool
+        if self.asyncpool is not None:
+            self.logger.info('Delete asyncpool')
+            self.asyncpool.shutdown()
+            self.asyncpool = None
+
+        reinject_pool.close_all()
 
         self.stayalive = False
         self.logger.info('Shutdown complete')
@@ -1028,7 +1365,7 @@ class MainController(DefConfigMixin):
         print("%s plugins reported errors." % perrors)
 
         if "milter" in self.config.get('main', 'incomingport') \
-                and self.config.get('performance', 'backend') != 'process':
+                and self.config.get('performance', 'backend') == 'thread':
 
             try:
                 minfreethreads = self.config.getint('performance', 'minfreethreads')
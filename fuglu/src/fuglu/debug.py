@@ -130,6 +130,8 @@ class ControlSession(object):
         self.socket = socket
         self.commands = {
             'workerlist': weakref.WeakMethod(self.workerlist),
+            'poolstats': weakref.WeakMethod(self.poolstats),
+            'backendstats': weakref.WeakMethod(self.backendstats),
             'threadlist': weakref.WeakMethod(self.threadlist),
             'uptime': weakref.WeakMethod(self.uptime),
             'stats': weakref.WeakMethod(self.stats),
@@ -209,7 +211,67 @@ class ControlSession(object):
             childstate_dict = procpool.shared_state
             workerlist = "\n%s" % '\n*******\n'.join(["%s: %s"%(procname,procstate) for procname,procstate in childstate_dict.items()])
             res += "Total %s worker processes\n%s" % (len(procpool.workers), workerlist)
+            if procpool.reload_status is not None:
+                res += "\nRolling reload: %s" % procpool.reload_status
 
+        asyncpool = self.controller.asyncpool
+        if asyncpool is not None:
+            workerlist = "\n%s" % '\n*******\n'.join(map(repr, asyncpool.workers))
+            res += "Total %s asyncio sessions (max %s scanner threads)\n%s" % (len(asyncpool.workers), asyncpool.maxthreads, workerlist)
+
+        return res
+
+    def poolstats(self, args):
+        """threadpool sizing: averaged queue wait time, busy ratio and last scaling decisions"""
+        threadpool = self.controller.threadpool
+        if threadpool is None:
+            return "No threadpool running"
+
+        numthreads = len(threadpool.workers)
+        res = "Threads: %u (min: %u, max: %u, free: %u)\n" % (numthreads, threadpool.minthreads,
+                                                              threadpool.maxthreads, threadpool.freeworkers)
+        res += "Queue: %u (max: %u)\n" % (threadpool.tasks.qsize(), threadpool.queuesize)
+        res += "Target latency: %.3fs, min busy ratio: %.2f\n" % (threadpool.target_latency, threadpool.min_busy_ratio)
+        res += "Queue wait (ewma): %.3fs\n" % threadpool.queue_wait_average()
+        res += "Busy ratio (ewma): %.2f\n" % threadpool.busy_ratio_ewma
+
+        decisions = list(threadpool.decisions)
+        res += "Last %u scaling decisions:\n" % len(decisions)
+        for decision in decisions:
+            res += "%s %s %u -> %u threads (queue: %u, wait: %.3fs, busy: %.2f): %s\n" % (
+                datetime.datetime.fromtimestamp(decision['time']).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                decision['action'], decision['num'], decision['threads'], decision['queuesize'],
+                decision['queue_wait'], decision['busy_ratio'], decision['reason'])
+        return res
+
+    def backendstats(self, args):
+        """
+        scanner backends: load and health of balanced backends, size, reuse and time waited for a
+        free connection of the connection pools
+        """
+        from fuglu.shared import get_backend_pools, get_backend_balancers
+        pools = get_backend_pools()
+        balancers = get_backend_balancers()
+        if not pools and not balancers:
+            return "No backend connection pools in this process"
+
+        res = ""
+        for balancer in balancers:
+            res += "%s balancer (%s, maxfails: %u, ejecttime: %ss)\n" % (
+                balancer.name, balancer.method, balancer.maxfails, balancer.ejecttime)
+            for stats in balancer.stats():
+                latency = "%.3fs" % stats['latency'] if stats['latency'] is not None else "-"
+                res += "  %s (weight %u): %s, outstanding: %u, requests: %u, errors: %u, ejected: %u, latency: %s\n" % (
+                    stats['name'], stats['weight'], stats['state'], stats['outstanding'], stats['requests'],
+                    stats['errors'], stats['ejections'], latency)
+        for pool in pools:
+            stats = pool.stats()
+            res += "%s\n" % stats['name']
+            res += "  Connections: %u (max: %s, in use: %u, idle: %u)\n" % (
+                stats['size'], stats['maxsize'] or 'unlimited', stats['inuse'], stats['idle'])
+            res += "  Created: %u, reused: %u, evicted: %u\n" % (stats['created'], stats['reused'], stats['evicted'])
+            res += "  Waits: %u (timeouts: %u, total: %.3fs, max: %.3fs)\n" % (
+                stats['waits'], stats['timeouts'], stats['waittime'], stats['maxwaittime'])
         return res
 
     def threadlist(self, args):
@@ -251,6 +313,9 @@ Ham:\t\t${hamcount}
 Spam:\t\t${spamcount}
 Virus:\t\t${viruscount}
 Block:\t\t${blockedcount}
+Refused:\t${refusedcount}
+Re-inject:\tnew:${reinjectnewcount} reused:${reinjectreusedcount} (${reinjectreuse}%)
+AV cache:\thit:${avcachehitcount} miss:${avcachemisscount} (${avcachehit}%)
         """
         renderer = string.Template(template)
         vrs = dict(
@@ -263,6 +328,13 @@ Block:\t\t${blockedcount}
             incount=stats.incount,
             outcount=stats.outcount,
             blockedcount=stats.blockedcount,
+            refusedcount=stats.refusedcount,
+            reinjectnewcount=stats.reinjectnewcount,
+            reinjectreusedcount=stats.reinjectreusedcount,
+            reinjectreuse=stats.reinject_reuse_ratio(),
+            avcachehitcount=stats.avcachehitcount,
+            avcachemisscount=stats.avcachemisscount,
+            avcachehit=stats.avcache_hit_ratio(),
         )
         res = renderer.safe_substitute(vrs)
         return res
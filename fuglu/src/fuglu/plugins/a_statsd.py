@@ -24,6 +24,8 @@ class PluginTime(AppenderPlugin):
 
     """EXPERIMENTAL: Send Plugin execution time to a statsd server"""
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         AppenderPlugin.__init__(self, config, section)
         self.logger = self._logger()
@@ -69,6 +71,8 @@ class MessageStatus(AppenderPlugin):
 
     """EXPERIMENTAL: Send message status to a statsd server"""
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         AppenderPlugin.__init__(self, config, section)
         self.logger = self._logger()
@@ -118,6 +122,8 @@ class MessageStatusPerRecipient(AppenderPlugin):
 
     """EXPERIMENTAL: Send per recipient stats to a statsd server"""
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         AppenderPlugin.__init__(self, config, section)
         self.logger = self._logger()
@@ -201,12 +201,16 @@ Note: The first rule to match in a message is the only rule that will be applied
         if not os.path.isdir(finaldir):
             os.makedirs(finaldir, 0o755)
 
-        if self.config.getboolean(self.section, 'storeoriginal'):
+        if self.config.getboolean(self.section, 'storeoriginal') and not suspect.source_in_memory:
             shutil.copy(suspect.tempfile, requested_path)
+        elif self.config.getboolean(self.section, 'storeoriginal'):
+            # message received in memory, no need to write a tempfile for the copy
+            with open(requested_path, 'wb') as fp:
+                fp.write(suspect.get_original_source_view())
         else:
             with open(requested_path, 'wb') as fp:
                 # write bytes
-                fp.write(suspect.get_source())
+                fp.write(suspect.get_source_view())
 
         chmod = self.config.get(self.section, 'chmod')
         chgrp = self.config.get(self.section, 'chgrp')
@@ -329,6 +329,8 @@ The other common template variables are available as well.
 
 """
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.requiredvars = {
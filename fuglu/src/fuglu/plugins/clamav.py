@@ -13,7 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from fuglu.shared import AVScannerPlugin, string_to_actioncode, DUNNO, actioncode_to_string
+from fuglu.shared import AVScannerPlugin, string_to_actioncode, DUNNO, actioncode_to_string, get_backend_pool, \
+    get_backend_balancer, BACKEND_BALANCER_VARS, BackendReplyError
 from fuglu.stringencode import force_bString, force_uString
 import socket
 import os
@@ -23,10 +24,14 @@ import errno
 import subprocess
 import time
 import math
+import array
+import tempfile
+import functools
 
-threadLocal = threading.local()
 # it's probably a good idea to re-establish the connection every now and then
 MAX_SCANS_PER_SOCKET = 5000
+# seconds to use the signature version of clamd before asking again
+SIGNATURE_REFRESH = 60
 
 
 class ClamavPlugin(AVScannerPlugin):
@@ -66,7 +71,7 @@ Tags:
 
             'pipelining': {
                 'default': 'False',
-                'description': "*EXPERIMENTAL*: Perform multiple scans over the same connection. May improve performance on busy systems.",
+                'description': "*EXPERIMENTAL*: Perform multiple scans over the same connection (clamd IDSESSION). Idle connections are kept in the backend pool, see performance.backendpool_maxidle. May improve performance on busy systems.",
             },
 
             'maxsize': {
@@ -111,14 +116,37 @@ Tags:
                 'default': 'none',
                 'description': 'define AVScanner engine names causing current plugin to skip if they found already a virus',
             },
+            'scanmode': {
+                'default': 'message',
+                'description': "message: send the message source to clamd, attachments: send the decoded MIME parts one by one, parts already scanned (in the same message or by the AV verdict cache, see performance.avcache_ttl) are not sent again",
+            },
+            'scanmethod': {
+                'default': 'INSTREAM',
+                'description': "how messages are passed to clamd in scanmode message. INSTREAM: stream the message source, FILDES: pass the open tempfile over the unix socket (port must be the path to clamd.sock), SCAN or MULTISCAN: let clamd read the tempfile by path (clamd needs read access to main.tempdir). INSTREAM is still used for messages only in memory or modified by previous plugins and if the scan by file fails",
+            },
+            'archivelevel': {
+                'default': '0',
+                'description': "scanmode attachments only: extract archives up to this level and send the members instead of the archive. 0: send archives as they are (clamd extracts them)",
+            },
         }
+        self.requiredvars.update(BACKEND_BALANCER_VARS)
         self.logger = self._logger()
         self.enginename = 'ClamAV'
+        # signature version reported by clamd and time of the query
+        self._signature = (None, 0)
     
     
     def __str__(self):
         return "Clam AV"
 
+    @property
+    def reads_tags(self):
+        return self._virus_tags()[0]
+
+    @property
+    def writes_tags(self):
+        return self._virus_tags()[1]
+
     def examine(self, suspect):
         if self._check_too_big(suspect):
             return DUNNO
@@ -128,16 +156,25 @@ Tags:
             self.logger.info("%s %s" % (suspect.id, skip))
             return DUNNO
 
-        content = suspect.get_source()
+        content = suspect.get_source_view()
+        attachments = self.config.get(self.section, 'scanmode').lower() == 'attachments'
+        scanfile = None
+        if self._scanmethod() != 'INSTREAM' and not suspect.source_in_memory and not suspect.is_modified():
+            scanfile = suspect.tempfile
 
         for i in range(0, self.config.getint(self.section, 'retries')):
             try:
-                viruses = self.scan_stream(content, suspect.id)
+                if attachments:
+                    viruses = self.scan_attachments_cached(
+                        suspect, archivelevel=self.config.getint(self.section, 'archivelevel'))
+                elif scanfile is not None:
+                    viruses = self.scan_stream_cached(content, suspect.id,
+                                                      scan=lambda c, sid: self.scan_file(scanfile, c, sid))
+                else:
+                    viruses = self.scan_stream_cached(content, suspect.id)
                 actioncode, message = self._virusreport(suspect, viruses)
                 return actioncode, message
             except socket.error as e:
-                self.__invalidate_socket()
-
                 # don't warn the first time if it's just a broken pipe which
                 # can happen with the new pipelining protocol
                 if not (i == 0 and e.errno == errno.EPIPE):
@@ -147,7 +184,6 @@ Tags:
                     self.logger.exception(e)
             except Exception as e:
                 self.logger.exception(e)
-                self.__invalidate_socket()
 
         self.logger.error("%s Clamdscan failed after %s retries" %
                           (suspect.id, self.config.getint(self.section, 'retries')))
@@ -203,50 +239,127 @@ Tags:
             return dr
     
 
-    def scan_stream(self, content, suspectid ="(NA)"):
+    def _scanmethod(self):
         """
-        Scan byte buffer
+        Configured scanmethod, INSTREAM if the method needs a unix socket but clamd is
+        reached over tcp
+        """
+        scanmethod = self.config.get(self.section, 'scanmethod').upper()
+        if scanmethod not in ('FILDES', 'SCAN', 'MULTISCAN'):
+            return 'INSTREAM'
+        if scanmethod == 'FILDES' and not self._unixsocket():
+            return 'INSTREAM'
+        return scanmethod
+
+    def _unixsocket(self):
+        """True if all clamd backends are reached by unix socket"""
+        return all(backend.path is not None for backend in self._balancer().backends)
+
+    def scan_file(self, filename, content=None, suspectid="(NA)"):
+        """
+        Scan a file without streaming its content, using the configured scanmethod (FILDES,
+        SCAN or MULTISCAN). If clamd can't scan the file, content is scanned using INSTREAM.
 
         return either :
           - (dict) : {filename1: "virusname"}
           - None if no virus found
           - raises Exception if something went wrong
         """
-        pipelining = self.config.getboolean(self.section, 'pipelining')
-        s = self.__init_socket__(oneshot=not pipelining)
-        s.sendall(b'zINSTREAM\0')
-        default_chunk_size = 2048
-        remainingbytes = force_bString(content)
-
-        numChunksToSend = math.ceil(len(remainingbytes)/default_chunk_size)
-        iChunk = 0
-        chunklength = 0
-        self.logger.debug('%s: sending message in %u chunks of size %u bytes' % (suspectid, numChunksToSend, default_chunk_size))
-
-        while len(remainingbytes) > 0:
-            iChunk = iChunk + 1
-            chunklength = min(default_chunk_size, len(remainingbytes))
-            #self.logger.debug('sending chunk %u/%u' % (iChunk,numChunksToSend))
-            #self.logger.debug('sending %s byte chunk' % chunklength)
-            chunkdata = remainingbytes[:chunklength]
-            remainingbytes = remainingbytes[chunklength:]
-            s.sendall(struct.pack(b'!L', chunklength))
-            s.sendall(chunkdata)
-        self.logger.debug('%s: sent chunk %u/%u, last number of bytes sent was %u' % (suspectid, iChunk, numChunksToSend, chunklength))
-        self.logger.debug('%s: All chunks send, send 0 - size to tell ClamAV the whole message has been sent' % suspectid)
-        s.sendall(struct.pack(b'!L', 0))
-        dr = {}
+        scanmethod = self._scanmethod()
+        try:
+            with self._balancer().connection(self._backend_pool) as conn:
+                s = conn.sock
+                if scanmethod == 'FILDES':
+                    with open(filename, 'rb') as fh:
+                        s.sendall(b'zFILDES\0')
+                        # the descriptor is passed as ancillary data of a packet with a dummy byte
+                        s.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fh.fileno()]))])
+                        result = self._read_until_delimiter(s, suspectid)
+                elif scanmethod in ('SCAN', 'MULTISCAN'):
+                    s.sendall(force_bString('z%s %s\0' % (scanmethod, os.path.abspath(filename))))
+                    result = self._read_until_delimiter(s, suspectid)
+                else:
+                    raise Exception("scanmethod %s can't scan files" % scanmethod)
+            return self._parse_result(force_uString(result), suspectid)
+        except Exception as e:
+            if content is None:
+                raise
+            self.logger.warning("%s %s scan failed, falling back to INSTREAM: %s" % (suspectid, scanmethod, str(e)))
+        return self.scan_stream(content, suspectid)
 
+    def _parse_result(self, result, suspectid="(NA)"):
+        """parse a clamd reply (without session id) to the virus dict returned by scan_stream"""
+        dr = {}
+        for line in result.strip().splitlines():
+            try:
+                filename, virusinfo = line.split(':', 1)
+            except ValueError:
+                raise Exception("%s: Protocol error, could not parse result: %s" % (suspectid, line))
+            filename = force_uString(filename.strip())  # use unicode for filename
+            virusinfo = force_uString(virusinfo.strip())  # use unicode for virus info
+            if virusinfo[-5:] == 'ERROR':
+                raise BackendReplyError("%s: %s" % (suspectid, virusinfo))
+            elif virusinfo != 'OK':
+                dr[filename] = virusinfo.replace(" FOUND", '')
+        if dr == {}:
+            return None
+        return dr
 
-        result = force_uString(self._read_until_delimiter(s, suspectid)).strip()
+    def scan_stream(self, content, suspectid ="(NA)"):
+        """
+        Scan byte buffer
 
-        if result.startswith('INSTREAM size limit exceeded'):
-            raise Exception(
-                "%s: Clamd size limit exeeded. Make sure fuglu's clamd maxsize config is not larger than clamd's StreamMaxLength" % suspectid)
-        if result.startswith('UNKNOWN'):
-            raise Exception("%s: Clamd doesn't understand INSTREAM command. very old version?" % suspectid)
+        return either :
+          - (dict) : {filename1: "virusname"}
+          - None if no virus found
+          - raises Exception if something went wrong
+        """
+        pipelining = self.config.getboolean(self.section, 'pipelining')
+        # with pipelining the connection stays in an IDSESSION and is reused for the next scan
+        with self._balancer().connection(self._backend_pool, reuse=pipelining) as conn:
+            s = conn.sock
+            s.settimeout(self.config.getint(self.section, 'timeout'))
+            if pipelining and 'expectedID' not in conn.state:
+                s.sendall(b'zIDSESSION\0')
+                conn.state['expectedID'] = 0
+            s.sendall(b'zINSTREAM\0')
+            default_chunk_size = 2048
+            if isinstance(content, memoryview):
+                remainingbytes = content
+            else:
+                remainingbytes = memoryview(force_bString(content))
+
+            numChunksToSend = math.ceil(len(remainingbytes)/default_chunk_size)
+            iChunk = 0
+            chunklength = 0
+            self.logger.debug('%s: sending message in %u chunks of size %u bytes' % (suspectid, numChunksToSend, default_chunk_size))
+
+            while len(remainingbytes) > 0:
+                iChunk = iChunk + 1
+                chunklength = min(default_chunk_size, len(remainingbytes))
+                #self.logger.debug('sending chunk %u/%u' % (iChunk,numChunksToSend))
+                #self.logger.debug('sending %s byte chunk' % chunklength)
+                chunkdata = remainingbytes[:chunklength]
+                remainingbytes = remainingbytes[chunklength:]
+                s.sendall(struct.pack(b'!L', chunklength))
+                s.sendall(chunkdata)
+            self.logger.debug('%s: sent chunk %u/%u, last number of bytes sent was %u' % (suspectid, iChunk, numChunksToSend, chunklength))
+            self.logger.debug('%s: All chunks send, send 0 - size to tell ClamAV the whole message has been sent' % suspectid)
+            s.sendall(struct.pack(b'!L', 0))
+            dr = {}
+
+
+            result = force_uString(self._read_until_delimiter(s, suspectid)).strip()
+
+            if result.startswith('INSTREAM size limit exceeded'):
+                raise BackendReplyError(
+                    "%s: Clamd size limit exeeded. Make sure fuglu's clamd maxsize config is not larger than clamd's StreamMaxLength" % suspectid)
+            if result.startswith('UNKNOWN'):
+                raise Exception("%s: Clamd doesn't understand INSTREAM command. very old version?" % suspectid)
+
+            if not pipelining:
+                return self._parse_result(result, suspectid)
 
-        if pipelining:
             try:
                 ans_id, filename, virusinfo = result.split(':', 2)
                 filename = force_uString(filename.strip())  # use unicode for filename
@@ -254,30 +367,18 @@ Tags:
             except Exception:
                 raise Exception("%s: Protocol error, could not parse result: %s" % (suspectid, result))
 
-            threadLocal.expectedID += 1
-            if threadLocal.expectedID != int(ans_id):
-                raise Exception("Commands out of sync - expected ID %s - got %s" % (threadLocal.expectedID, ans_id))
+            conn.state['expectedID'] += 1
+            if conn.state['expectedID'] != int(ans_id):
+                raise Exception("Commands out of sync - expected ID %s - got %s" % (conn.state['expectedID'], ans_id))
 
             if virusinfo[-5:] == 'ERROR':
-                raise Exception(virusinfo)
+                raise BackendReplyError("%s: %s" % (suspectid, virusinfo))
             elif virusinfo != 'OK':
                 dr[filename] = virusinfo.replace(" FOUND", '')
 
-            if threadLocal.expectedID >= MAX_SCANS_PER_SOCKET:
-                try:
-                    s.sendall(b'zEND\0')
-                    s.close()
-                finally:
-                    self.__invalidate_socket()
-        else:
-            filename, virusinfo = result.split(':', 1)
-            filename = force_uString(filename.strip())  # use unicode for filename
-            virusinfo = force_uString(virusinfo.strip())  # use unicode for virus info
-            if virusinfo[-5:] == 'ERROR':
-                raise Exception(virusinfo)
-            elif virusinfo != 'OK':
-                dr[filename] = virusinfo.replace(" FOUND", '')
-            s.close()
+            if conn.state['expectedID'] >= MAX_SCANS_PER_SOCKET:
+                conn.discard()
+                s.sendall(b'zEND\0')
 
         if dr == {}:
             return None
@@ -285,6 +386,28 @@ Tags:
             return dr
     
     
+    def _engine_signature(self):
+        """
+        Signature database version of clamd (VERSION command), refreshed every minute
+        :return: version string, None if clamd can't tell
+        """
+        signature, querytime = self._signature
+        if time.time() - querytime < SIGNATURE_REFRESH:
+            return signature
+        signature = None
+        try:
+            with self._balancer().connection(self._backend_pool) as conn:
+                conn.sock.sendall(b'zVERSION\0')
+                result = force_uString(self._read_until_delimiter(conn.sock))
+            # ClamAV 0.103.8/26902/Mon May  8 07:24:40 2023
+            parts = result.strip().split('/')
+            if len(parts) > 1:
+                signature = parts[1]
+        except Exception as e:
+            self.logger.warning("Could not get clamd signature version: %s" % str(e))
+        self._signature = (signature, time.time())
+        return signature
+
     def _read_until_delimiter(self, sock, suspectID = "(NA)"):
         data = b''
         maxFailedAttempts = 40
@@ -327,46 +450,36 @@ Tags:
         return data[:-1]  # remove \0 at the end
     
     
-    def __invalidate_socket(self):
-        threadLocal.clamdsocket = None
-        threadLocal.expectedID = 0
+    def _balancer(self):
+        """balancer over the configured clamd backends"""
+        return get_backend_balancer(self.config, self.section, 'clamd', defaultport=3310)
     
     
-    def __init_socket__(self, oneshot=False):
-        """initialize a socket connection to clamd using host/port/file defined in the configuration
-        this connection is initialized with clamd's "IDSESSION" and cached per thread
-
-         set oneshot=True to get a socket without caching it and without initializing it with an IDSESSION
-         """
-
-        existing_socket = getattr(threadLocal, 'clamdsocket', None)
+    def _backend_pool(self, backend):
+        """connection pool to one clamd, shared with other sections using the same clamd"""
+        return get_backend_pool(self.config, 'clamd:%s' % backend.name,
+                                functools.partial(self.__init_socket__, backend.sockaddr))
+    
+    
+    def __init_socket__(self, sockaddr=None):
+        """initialize a socket connection to clamd using the unix socket path or (host, port),
+        by default the first configured backend"""
 
         socktimeout = self.config.getint(self.section, 'timeout')
+        if sockaddr is None:
+            sockaddr = self._balancer().backends[0].sockaddr
 
-        if existing_socket is not None and not oneshot:
-            existing_socket.settimeout(socktimeout)
-            return existing_socket
-
-        clamd_HOST = self.config.get(self.section, 'host')
-        unixsocket = False
-
-        try:
-            self.config.getint(self.section, 'port')
-        except ValueError:
-            unixsocket = True
-
-        if unixsocket:
-            sock = self.config.get(self.section, 'port')
-            if not os.path.exists(sock):
-                raise Exception("unix socket %s not found" % sock)
+        if isinstance(sockaddr, str):
+            if not os.path.exists(sockaddr):
+                raise Exception("unix socket %s not found" % sockaddr)
             s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             s.settimeout(socktimeout)
             try:
-                s.connect(sock)
+                s.connect(sockaddr)
             except socket.error:
-                raise Exception('Could not reach clamd using unix socket %s' % sock)
+                raise Exception('Could not reach clamd using unix socket %s' % sockaddr)
         else:
-            clamd_PORT = self.config.getint(self.section, 'port')
+            clamd_HOST, clamd_PORT = sockaddr
             proto = socket.AF_INET
             if ':' in clamd_HOST:
                 proto = socket.AF_INET6
@@ -376,12 +489,6 @@ Tags:
                 s.connect((clamd_HOST, clamd_PORT))
             except socket.error:
                 raise Exception('Could not reach clamd using network (%s, %s)' % (clamd_HOST, clamd_PORT))
-
-        # initialize an IDSESSION
-        if not oneshot:
-            s.sendall('zIDSESSION\0')
-            threadLocal.clamdsocket = s
-            threadLocal.expectedID = 0
         return s
     
     
@@ -399,14 +506,34 @@ Tags:
                 runtime = time.time()-starttime
                 print('clamscan scan time: %.2fs' % runtime)
 
+        scanmethod = self.config.get(self.section, 'scanmethod').upper()
+        if scanmethod != self._scanmethod():
+            print('WARNING: scanmethod %s not possible, using INSTREAM' % scanmethod)
+        elif scanmethod != 'INSTREAM':
+            allok = allok and self.lint_eicar('lint_scanfile')
+
         # print lint info for skip
         self.lintinfo_skip()
         return allok
+
+    def lint_scanfile(self, content):
+        """scan content written to a file in main.tempdir using the configured scanmethod"""
+        tempdir = self.config.get('main', 'tempdir', fallback=None)
+        handle, filename = tempfile.mkstemp(prefix='fuglu-lint-clamav', dir=tempdir)
+        try:
+            with os.fdopen(handle, 'wb') as fh:
+                fh.write(content)
+            return self.scan_file(filename)
+        except Exception as e:
+            print("%s scan failed: %s" % (self._scanmethod(), str(e)))
+            return None
+        finally:
+            os.remove(filename)
     
     
     def lint_ping(self):
         try:
-            s = self.__init_socket__(oneshot=True)
+            s = self.__init_socket__()
         except Exception as e:
             print("Could not contact clamd: %s" % (str(e)))
             return False
@@ -420,7 +547,7 @@ Tags:
     
     def lint_version(self):
         try:
-            s = self.__init_socket__(oneshot=True)
+            s = self.__init_socket__()
         except Exception:
             return False
         s.sendall(b'VERSION')
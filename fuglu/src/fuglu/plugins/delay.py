@@ -28,6 +28,8 @@ class DelayPlugin(ScannerPlugin):
     min_logfrequency = 1e-4
     min_delay        = 1e-6
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.requiredvars = {
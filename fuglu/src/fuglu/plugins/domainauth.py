@@ -140,6 +140,8 @@ in combination with other factors to take action (for example a "DMARC" plugin c
 It is currently recommended to leave both header and body canonicalization as 'relaxed'. Using 'simple' can cause the signature to fail.
     """
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.logger = self._logger()
@@ -238,6 +240,8 @@ If fuglu handles both incoming and outgoing mails you should make sure that this
 
     """
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.logger = self._logger()
@@ -356,6 +360,8 @@ The plugin does not take any action based on the SPF test result since. Other pl
 in combination with other factors to take action (for example a "DMARC" plugin could use this information)
     """
     
+    uses_clientinfo = True
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.logger = self._logger()
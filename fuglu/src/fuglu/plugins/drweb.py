@@ -14,10 +14,13 @@
 # limitations under the License.
 #
 #
-from fuglu.shared import AVScannerPlugin, DUNNO
+from fuglu.shared import AVScannerPlugin, DUNNO, get_backend_pool
+from fuglu.stringencode import force_bString
 import socket
 import struct
 import re
+import time
+import hashlib
 # from : https://github.com/AlexeyDemidov/avsmtpd/blob/master/drweb.h
 # Dr. Web daemon commands
 DRWEBD_SCAN_CMD = 0x0001
@@ -49,6 +52,8 @@ DERR_BAD_CAL = 0x08000
 DERR_EVAL_VERSION = 0x10000
 DERR_SPAM_MESSAGE = 0x20000
 DERR_VIRUS = DERR_KNOWN_VIRUS | DERR_UNKNOWN_VIRUS | DERR_VIRUS_MODIFICATION
+DERR_ERROR = DERR_READ_ERR | DERR_WRITE_ERR | DERR_NOMEMORY | DERR_CRC_ERROR | DERR_READSOCKET | DERR_TIMEOUT \
+    | DERR_BAD_CAL
 
 
 class DrWebPlugin(AVScannerPlugin):
@@ -108,6 +113,8 @@ Tags:
         self.logger = self._logger()
         self.pattern = re.compile(r'(?:DATA\[\d+\])(.+) infected with (.+)$')
         self.enginename = 'drweb'
+        # signature of the virus bases and time of the query
+        self._signature = (None, 0)
         
 
     def examine(self, suspect):
@@ -118,7 +125,7 @@ Tags:
 
         for i in range(0, self.config.getint(self.section, 'retries')):
             try:
-                viruses = self.scan_stream(content)
+                viruses = self.scan_stream_cached(content, suspect.id)
                 actioncode, message = self._virusreport(suspect, viruses)
                 return actioncode, message
             except Exception as e:
@@ -160,35 +167,44 @@ Tags:
           - None if no virus found
         """
 
-        s = self.__init_socket__()
-        buflen = len(content)
+        with self._backend_pool().connection() as conn:
+            s = conn.sock
+            buflen = len(content)
 
-        self._sendint(s, DRWEBD_SCAN_CMD)
+            self._sendint(s, DRWEBD_SCAN_CMD)
 
-        # flags:
-        # self._sendint(s, 0) # "flags" # use this to get only the code
-        # self._sendint(s, DRWEBD_RETURN_VIRUSES) # use this to get the virus
-        # infection name
-        # use this to get the full report
-        self._sendint(s, DRWEBD_RETURN_REPORT)
-        self._sendint(s, 0)  # not sure what this is for - but it's required.
-        self._sendint(s, buflen)  # send the buffer length
-        s.sendall(content)  # send the buffer
-        retcode = self._readint(s)  # get return code
-        # print "result=%s"%retcode
-        numlines = self._readint(s)
-        lines = []
-        for _ in range(numlines):
-            line = self._readstr(s)
-            lines.append(line)
-        s.close()
+            # flags:
+            # self._sendint(s, 0) # "flags" # use this to get only the code
+            # self._sendint(s, DRWEBD_RETURN_VIRUSES) # use this to get the virus
+            # infection name
+            # use this to get the full report
+            self._sendint(s, DRWEBD_RETURN_REPORT)
+            self._sendint(s, 0)  # not sure what this is for - but it's required.
+            self._sendint(s, buflen)  # send the buffer length
+            s.sendall(content)  # send the buffer
+            retcode = self._readint(s)  # get return code
+            # print "result=%s"%retcode
+            numlines = self._readint(s)
+            lines = []
+            for _ in range(numlines):
+                line = self._readstr(s)
+                lines.append(line)
 
         if retcode & DERR_VIRUS == retcode:
             return self._parse_result(lines)
+        elif retcode & DERR_ERROR:
+            # not a verdict, must not end up in the AV verdict cache
+            raise Exception('%s: drweb scan error, return code 0x%x' % (suspectid, retcode))
         else:
             return None
     
     
+    def _backend_pool(self):
+        """connection pool to the configured drwebd, drwebd answers one command per connection"""
+        backend = '%s:%s' % (self.config.get(self.section, 'host'), self.config.get(self.section, 'port'))
+        return get_backend_pool(self.config, 'drweb:%s' % backend, self.__init_socket__)
+    
+    
     def __init_socket__(self):
         host = self.config.get(self.section, 'host')
         port = self.config.getint(self.section, 'port')
@@ -225,26 +241,41 @@ Tags:
     def get_version(self):
         """Return numeric version of the DrWeb daemon"""
         try:
-            s = self.__init_socket__()
-            self._sendint(s, DRWEBD_VERSION_CMD)
-            version = self._readint(s)
+            with self._backend_pool().connection() as conn:
+                self._sendint(conn.sock, DRWEBD_VERSION_CMD)
+                version = self._readint(conn.sock)
             return version
         except Exception as e:
             self.logger.error("Could not get DrWeb Version: %s" % str(e))
         return None
     
     
+    def _engine_signature(self):
+        """
+        Digest of the virus bases loaded by the DrWeb daemon and their number of
+        definitions, refreshed every minute
+        :return: version string, None if drwebd can't tell
+        """
+        signature, querytime = self._signature
+        if time.time() - querytime < 60:
+            return signature
+        bases = self.get_baseinfo()
+        signature = hashlib.sha1(force_bString(repr(bases))).hexdigest() if bases else None
+        self._signature = (signature, time.time())
+        return signature
+
     def get_baseinfo(self):
         """return list of tuples (basename,number of virus definitions)"""
         ret = []
         try:
-            s = self.__init_socket__()
-            self._sendint(s, DRWEBD_BASEINFO_CMD)
-            numbases = self._readint(s)
-            for _ in range(numbases):
-                idstr = self._readstr(s)
-                numviruses = self._readint(s)
-                ret.append((idstr, numviruses))
+            with self._backend_pool().connection() as conn:
+                s = conn.sock
+                self._sendint(s, DRWEBD_BASEINFO_CMD)
+                numbases = self._readint(s)
+                for _ in range(numbases):
+                    idstr = self._readstr(s)
+                    numviruses = self._readint(s)
+                    ret.append((idstr, numviruses))
         except Exception as e:
             self.logger.error(
                 "Could not get DrWeb Base Information: %s" % str(e))
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from fuglu.shared import AVScannerPlugin, DUNNO
+from fuglu.shared import AVScannerPlugin, DUNNO, get_backend_pool
 from fuglu.stringencode import force_bString, force_uString
 import socket
 import re
@@ -110,7 +110,7 @@ Tags:
         for i in range(0, self.config.getint(self.section, 'retries')):
             try:
                 if networkmode:
-                    viruses = self.scan_stream(content, suspect.id)
+                    viruses = self.scan_stream_cached(content, suspect.id)
                 else:
                     viruses = self.scan_file(suspect.tempfile)
                 actioncode, message = self._virusreport(suspect, viruses)
@@ -164,14 +164,14 @@ Tags:
     
     def scan_file(self, filename):
         filename = os.path.abspath(filename)
-        s = self.__init_socket__()
-        s.sendall(force_bString('SCAN %s FILE %s' % (self.config.get(self.section, 'scanoptions'), filename)))
-        s.sendall(b'\n')
+        with self._backend_pool().connection() as conn:
+            s = conn.sock
+            s.sendall(force_bString('SCAN %s FILE %s' % (self.config.get(self.section, 'scanoptions'), filename)))
+            s.sendall(b'\n')
 
-        result = s.recv(20000)
-        if len(result) < 1:
-            self.logger.error('Got no reply from fpscand')
-        s.close()
+            result = s.recv(20000)
+            if len(result) < 1:
+                self.logger.error('Got no reply from fpscand')
 
         return self._parse_result(result)
     
@@ -187,23 +187,29 @@ Tags:
           - None if no virus found
         """
 
-        s = self.__init_socket__()
         content = force_bString(content)
         buflen = len(content)
-        s.sendall(force_bString('SCAN %s STREAM fu_stream SIZE %s' % (self.config.get(self.section, 'scanoptions'), buflen)))
-        s.sendall(b'\n')
-        self.logger.debug('%s Sending buffer (length=%s) to fpscand...' % (suspectid, buflen))
-        s.sendall(content)
-        self.logger.debug('%s Sent %s bytes to fpscand, waiting for scan result' % (suspectid, buflen))
-
-        result = force_uString(s.recv(20000))
-        if len(result) < 1:
-            self.logger.error('Got no reply from fpscand')
-        s.close()
+        with self._backend_pool().connection() as conn:
+            s = conn.sock
+            s.sendall(force_bString('SCAN %s STREAM fu_stream SIZE %s' % (self.config.get(self.section, 'scanoptions'), buflen)))
+            s.sendall(b'\n')
+            self.logger.debug('%s Sending buffer (length=%s) to fpscand...' % (suspectid, buflen))
+            s.sendall(content)
+            self.logger.debug('%s Sent %s bytes to fpscand, waiting for scan result' % (suspectid, buflen))
+
+            result = force_uString(s.recv(20000))
+            if len(result) < 1:
+                self.logger.error('Got no reply from fpscand')
 
         return self._parse_result(result)
     
     
+    def _backend_pool(self):
+        """connection pool to the configured fpscand, fpscand answers one scan per connection"""
+        backend = '%s:%s' % (self.config.get(self.section, 'host'), self.config.get(self.section, 'port'))
+        return get_backend_pool(self.config, 'fprot:%s' % backend, self.__init_socket__)
+    
+    
     def __init_socket__(self):
         host = self.config.get(self.section, 'host')
         port = self.config.getint(self.section, 'port')
@@ -227,6 +227,8 @@ class FuzorReportAppender(AppenderPlugin, FuzorMixin):
 
 class FuzorCheck(ScannerPlugin, FuzorMixin):
     """Check messages against the redis database and write spamassassin pseudo-headers"""
+    reads_tags = ('SAPlugin.tempheader', )
+    writes_tags = ('FuZor', 'SAPlugin.tempheader')
     
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
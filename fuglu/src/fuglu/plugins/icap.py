@@ -17,7 +17,8 @@
 
 # http://vaibhavkulkarni.wordpress.com/2007/11/19/a-icap-client-code-in-c-to-virus-scan-a-file-using-symantec-scan-server/
 
-from fuglu.shared import AVScannerPlugin, string_to_actioncode, DUNNO, actioncode_to_string
+from fuglu.shared import AVScannerPlugin, string_to_actioncode, DUNNO, actioncode_to_string, get_backend_pool
+from fuglu.stringencode import force_uString
 import socket
 import os
 
@@ -101,7 +102,7 @@ Prerequisites: requires an ICAP capable antivirus engine somewhere in your netwo
 
         for i in range(0, self.config.getint(self.section, 'retries')):
             try:
-                viruses = self.scan_stream(content, suspect.id)
+                viruses = self.scan_stream_cached(content, suspect.id)
                 actioncode, message = self._virusreport(suspect, viruses)
                 return actioncode, message
             except Exception as e:
@@ -123,7 +124,6 @@ Prerequisites: requires an ICAP capable antivirus engine somewhere in your netwo
           - None if no virus found
         """
 
-        s = self.__init_socket__()
         dr = {}
 
         CRLF = "\r\n"
@@ -169,9 +169,15 @@ Prerequisites: requires an ICAP capable antivirus engine somewhere in your netwo
 
         everything = icapheader + fakerequestheader + \
             fakeresponseheader + bodypart + CRLF
-        s.sendall(everything)
-        result = s.recv(20000)
-        s.close()
+        with self._backend_pool().connection() as conn:
+            conn.sock.sendall(everything)
+            result = conn.sock.recv(20000)
+
+        # 200 with the violations found or 204 if unmodified, anything else is not a verdict
+        # and must not end up in the AV verdict cache
+        status = force_uString(result).split('\n', 1)[0].split()
+        if len(status) < 2 or not status[0].startswith('ICAP/') or status[1] not in ('200', '204'):
+            raise Exception('%s: unexpected ICAP reply: %s' % (suspectid, ' '.join(status) or 'empty'))
 
         sheader = "X-Violations-Found:"
         if sheader.lower() in result.lower():
@@ -196,6 +202,16 @@ Prerequisites: requires an ICAP capable antivirus engine somewhere in your netwo
             return dr
     
     
+    def _backend_pool(self):
+        """connection pool to the configured ICAP server, one RESPMOD per connection"""
+        try:
+            self.config.getint(self.section, 'port')
+            backend = '%s:%s' % (self.config.get(self.section, 'host'), self.config.get(self.section, 'port'))
+        except ValueError:
+            backend = self.config.get(self.section, 'port')
+        return get_backend_pool(self.config, 'icap:%s' % backend, self.__init_socket__)
+    
+    
     def __init_socket__(self):
         unixsocket = False
 
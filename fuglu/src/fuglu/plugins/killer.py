@@ -21,6 +21,8 @@ class KillerPlugin(ScannerPlugin):
 
     """DELETE all mails (for special mail setups like spam traps etc)"""
 
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.logger = self._logger()
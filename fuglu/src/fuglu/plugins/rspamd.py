@@ -16,7 +16,8 @@
 #
 
 
-from fuglu.shared import ScannerPlugin, DUNNO, DEFER, Suspect, string_to_actioncode, apply_template
+from fuglu.shared import ScannerPlugin, DUNNO, DEFER, Suspect, string_to_actioncode, apply_template, \
+    get_backend_balancer, BACKEND_BALANCER_VARS
 from fuglu.stringencode import force_uString
 from fuglu.extensions.sql import DBConfig
 import json
@@ -44,6 +45,11 @@ class RSpamdPlugin(ScannerPlugin):
     """
     
     
+    reads_tags = ('RSpamd.skip', )
+    writes_tags = ('RSpamd.skipreason', 'RSpamd.report', 'RSpamd.spamscore', 'spam:RSpamd', 'highspam:RSpamd')
+
+    uses_clientinfo = True
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.logger = self._logger()
@@ -104,6 +110,7 @@ class RSpamdPlugin(ScannerPlugin):
             },
         
         }
+        self.requiredvars.update(BACKEND_BALANCER_VARS)
     
     
     
@@ -139,8 +146,6 @@ class RSpamdPlugin(ScannerPlugin):
     def rspamd_json(self, suspect):
         # https://rspamd.com/doc/architecture/protocol.html
         
-        host = self.config.get(self.section, 'host')
-        port = self.config.getint(self.section, 'port')
         timeout = self.config.getint(self.section, 'timeout')
 
         if self.config.getboolean(self.section, 'scanoriginal'):
@@ -178,16 +183,25 @@ class RSpamdPlugin(ScannerPlugin):
         }
         headers.update(clientinfoheaders)
         
-        try:
-            conn = HTTPConnection(host, port, timeout=timeout)
-            conn.request("POST", "/symbols", content, {})
-            response = conn.getresponse()
-            #response.status, response.reason
-            jsondata = force_uString(response.read())
-            reply = json.loads(jsondata)
-        except Exception as e:
-            reply = None
-            self.logger.error('Failed to get rspamd response for %s: %s' % (suspect.id, str(e)))
+        # try every backend once at most, the balancer selects another one after an error
+        balancer = get_backend_balancer(self.config, self.section, 'rspamd', defaultport=11333)
+        reply = None
+        for _ in range(len(balancer.backends)):
+            try:
+                with balancer.request() as backend:
+                    if backend.path is not None:
+                        raise Exception('rspamd backend %s: only tcp is supported' % backend.name)
+                    conn = HTTPConnection(backend.host, backend.port, timeout=timeout)
+                    conn.request("POST", "/symbols", content, {})
+                    response = conn.getresponse()
+                    jsondata = force_uString(response.read())
+                    conn.close()
+                    if response.status != 200:
+                        raise Exception('HTTP %s %s from %s' % (response.status, response.reason, backend.name))
+                    reply = json.loads(jsondata)
+                break
+            except Exception as e:
+                self.logger.error('Failed to get rspamd response for %s: %s' % (suspect.id, str(e)))
         
         if reply and 'default' in reply: # rspamd 1.6
             replydata = reply['default']
@@ -14,7 +14,8 @@
 # limitations under the License.
 #
 #
-from fuglu.shared import ScannerPlugin, DUNNO, DEFER, Suspect, string_to_actioncode, apply_template
+from fuglu.shared import ScannerPlugin, DUNNO, DEFER, Suspect, string_to_actioncode, apply_template, get_backend_pool, \
+    get_backend_balancer, BACKEND_BALANCER_VARS
 from fuglu.extensions.sql import DBConfig, get_session, SQL_EXTENSION_ENABLED
 from fuglu.stringencode import force_bString, force_uString
 from string import Template
@@ -23,6 +24,7 @@ import socket
 import email
 import re
 import os
+import functools
 from fuglu.lib.patchedemail import PatchedMessage
 
 
@@ -56,6 +58,12 @@ Tags:
  * sets ``SAPlugin.report``, (string) report from spamd or spamheader (where score was found) depending on forwardoriginal setting
 """
 
+    reads_tags = ('SAPlugin.skip', 'SAPlugin.tempheader')
+    writes_tags = ('SAPlugin.skipreason', 'SAPlugin.report', 'SAPlugin.spamscore',
+                   'spam:SpamAssassin', 'highspam:SpamAssassin')
+
+    uses_clientinfo = False
+
     def __init__(self, config, section=None):
         ScannerPlugin.__init__(self, config, section)
         self.requiredvars = {
@@ -156,6 +164,7 @@ Tags:
             },
 
         }
+        self.requiredvars.update(BACKEND_BALANCER_VARS)
         self.logger = self._logger()
 
 
@@ -163,6 +172,15 @@ Tags:
         return "SpamAssassin"
 
 
+    @property
+    def modifies_source(self):
+        # the message source is replaced with the answer from spamd
+        try:
+            return not self.config.getboolean(self.section, 'forwardoriginal')
+        except Exception:
+            return True
+
+
     def lint(self):
         allok = self.check_config() and self.lint_ping() and self.lint_spam() and self.lint_blacklist()
         return allok
@@ -195,23 +213,24 @@ Tags:
         for i in range(0, retries):
             try:
                 self.logger.debug('Contacting spamd (Try %s of %s)' % (i + 1, retries))
-                s = self.__init_socket()
-                s.sendall(b'PING SPAMC/1.2')
-                s.sendall(b"\r\n")
-                s.shutdown(socket.SHUT_WR)
-                socketfile = s.makefile("rb")
-                line = force_uString(socketfile.readline())
-                line = line.strip()
-                answer = line.split()
-                if len(answer) != 3:
-                    print("Invalid SPAMD PONG: %s" % line)
-                    return False
-
-                if answer[2] != "PONG":
-                    print("Invalid SPAMD Pong: %s" % line)
-                    return False
-                print("Got: %s" % line)
-                return True
+                with self._balancer().connection(self._backend_pool) as conn:
+                    s = conn.sock
+                    s.sendall(b'PING SPAMC/1.2')
+                    s.sendall(b"\r\n")
+                    s.shutdown(socket.SHUT_WR)
+                    socketfile = s.makefile("rb")
+                    line = force_uString(socketfile.readline())
+                    line = line.strip()
+                    answer = line.split()
+                    if len(answer) != 3:
+                        print("Invalid SPAMD PONG: %s" % line)
+                        return False
+
+                    if answer[2] != "PONG":
+                        print("Invalid SPAMD Pong: %s" % line)
+                        return False
+                    print("Got: %s" % line)
+                    return True
             except socket.timeout:
                 print('SPAMD Socket timed out.')
             except socket.herror as h:
@@ -492,27 +511,29 @@ Tags:
         return action, message
 
 
-    def __init_socket(self):
-        unixsocket = False
+    def _balancer(self):
+        """balancer over the configured spamd backends"""
+        return get_backend_balancer(self.config, self.section, 'spamd', defaultport=783)
 
-        try:
-            self.config.getint(self.section, 'port')
-        except ValueError:
-            unixsocket = True
-
-        if unixsocket:
-            sock = self.config.get(self.section, 'port')
-            if not os.path.exists(sock):
-                raise Exception("unix socket %s not found" % sock)
+
+    def _backend_pool(self, backend):
+        """connection pool to one spamd, spamd closes the connection after every request"""
+        return get_backend_pool(self.config, 'spamd:%s' % backend.name,
+                                functools.partial(self.__init_socket, backend.sockaddr))
+
+
+    def __init_socket(self, sockaddr):
+        if isinstance(sockaddr, str):
+            if not os.path.exists(sockaddr):
+                raise Exception("unix socket %s not found" % sockaddr)
             s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             s.settimeout(self.config.getint(self.section, 'timeout'))
             try:
-                s.connect(sock)
+                s.connect(sockaddr)
             except socket.error:
-                raise Exception('Could not reach spamd using unix socket %s' % sock)
+                raise Exception('Could not reach spamd using unix socket %s' % sockaddr)
         else:
-            host = self.config.get(self.section, 'host')
-            port = self.config.getint(self.section, 'port')
+            host, port = sockaddr
             timeout = self.config.getfloat(self.section, 'timeout')
             try:
                 s = socket.create_connection((host, port), timeout)
@@ -530,37 +551,38 @@ Tags:
         for i in range(0, retries):
             try:
                 self.logger.debug('Contacting spamd (Try %s of %s)' % (i + 1, retries))
-                s = self.__init_socket()
-                s.sendall(force_bString('PROCESS SPAMC/1.2'))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("Content-length: %s" % spamsize))
-                s.sendall(force_bString("\r\n"))
-                if peruserconfig:
-                    s.sendall(force_bString("User: %s" % user))
+                with self._balancer().connection(self._backend_pool) as conn:
+                    s = conn.sock
+                    s.sendall(force_bString('PROCESS SPAMC/1.2'))
                     s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString(messagecontent))
-                self.logger.debug('Sent %s bytes to spamd' % spamsize)
-                s.shutdown(socket.SHUT_WR)
-                socketfile = s.makefile("rb")
-                line1_info = socketfile.readline()
-                line1_info = force_uString(line1_info)  # convert to unicode string
-                self.logger.debug(line1_info)
-                line2_contentlength = socketfile.readline()
-                line3_empty = socketfile.readline()
-                content = socketfile.read()
-                self.logger.debug('Got %s message bytes from back from spamd' % len(content))
-                answer = line1_info.strip().split()
-                if len(answer) != 3:
-                    self.logger.error("Got invalid status line from spamd: %s" % line1_info)
-                    continue
-
-                version, number, status = answer
-                if status != 'EX_OK':
-                    self.logger.error("Got bad status from spamd: %s" % status)
-                    continue
-
-                return content
+                    s.sendall(force_bString("Content-length: %s" % spamsize))
+                    s.sendall(force_bString("\r\n"))
+                    if peruserconfig:
+                        s.sendall(force_bString("User: %s" % user))
+                        s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString(messagecontent))
+                    self.logger.debug('Sent %s bytes to spamd' % spamsize)
+                    s.shutdown(socket.SHUT_WR)
+                    socketfile = s.makefile("rb")
+                    line1_info = socketfile.readline()
+                    line1_info = force_uString(line1_info)  # convert to unicode string
+                    self.logger.debug(line1_info)
+                    line2_contentlength = socketfile.readline()
+                    line3_empty = socketfile.readline()
+                    content = socketfile.read()
+                    self.logger.debug('Got %s message bytes from back from spamd' % len(content))
+                    answer = line1_info.strip().split()
+                    if len(answer) != 3:
+                        self.logger.error("Got invalid status line from spamd: %s" % line1_info)
+                        continue
+
+                    version, number, status = answer
+                    if status != 'EX_OK':
+                        self.logger.error("Got bad status from spamd: %s" % status)
+                        continue
+
+                    return content
             except socket.timeout:
                 self.logger.error('SPAMD Socket timed out.')
             except socket.herror as h:
@@ -602,45 +624,46 @@ Tags:
         for i in range(0, retries):
             try:
                 self.logger.debug('Contacting spamd  (Try %s of %s)' % (i + 1, retries))
-                s = self.__init_socket()
-                s.sendall(force_bString('%s SPAMC/1.2' % command))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("Content-length: %s" % spamsize))
-                s.sendall(force_bString("\r\n"))
-                if peruserconfig:
-                    s.sendall(force_bString("User: %s" % user))
+                with self._balancer().connection(self._backend_pool) as conn:
+                    s = conn.sock
+                    s.sendall(force_bString('%s SPAMC/1.2' % command))
+                    s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString("Content-length: %s" % spamsize))
                     s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString(messagecontent))
-                self.logger.debug('Sent %s bytes to spamd' % spamsize)
-                s.shutdown(socket.SHUT_WR)
-                socketfile = s.makefile("rb")
-                line1_info = force_uString(socketfile.readline())
-                self.logger.debug(line1_info)
-                line2_spaminfo = force_uString(socketfile.readline())
-
-                line3 = force_uString(socketfile.readline())
-                content = socketfile.read()
-                content = content.strip()
-
-                self.logger.debug('Got %s message bytes from back from spamd' % len(content))
-                answer = line1_info.strip().split()
-                if len(answer) != 3:
-                    self.logger.error("Got invalid status line from spamd: %s" % line1_info)
-                    continue
-
-                version, number, status = answer
-                if status != 'EX_OK':
-                    self.logger.error("Got bad status from spamd: %s" % status)
-                    continue
-
-                self.logger.debug('Spamd said: %s' % line2_spaminfo)
-                spamword, spamstatusword, colon, score, slash, required = line2_spaminfo.split()
-                spstatus = False
-                if spamstatusword == 'True':
-                    spstatus = True
-
-                return spstatus, float(score), content
+                    if peruserconfig:
+                        s.sendall(force_bString("User: %s" % user))
+                        s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString(messagecontent))
+                    self.logger.debug('Sent %s bytes to spamd' % spamsize)
+                    s.shutdown(socket.SHUT_WR)
+                    socketfile = s.makefile("rb")
+                    line1_info = force_uString(socketfile.readline())
+                    self.logger.debug(line1_info)
+                    line2_spaminfo = force_uString(socketfile.readline())
+
+                    line3 = force_uString(socketfile.readline())
+                    content = socketfile.read()
+                    content = content.strip()
+
+                    self.logger.debug('Got %s message bytes from back from spamd' % len(content))
+                    answer = line1_info.strip().split()
+                    if len(answer) != 3:
+                        self.logger.error("Got invalid status line from spamd: %s" % line1_info)
+                        continue
+
+                    version, number, status = answer
+                    if status != 'EX_OK':
+                        self.logger.error("Got bad status from spamd: %s" % status)
+                        continue
+
+                    self.logger.debug('Spamd said: %s' % line2_spaminfo)
+                    spamword, spamstatusword, colon, score, slash, required = line2_spaminfo.split()
+                    spstatus = False
+                    if spamstatusword == 'True':
+                        spstatus = True
+
+                    return spstatus, float(score), content
             except socket.timeout:
                 self.logger.error('SPAMD Socket timed out.')
             except socket.herror as h:
@@ -741,6 +764,7 @@ class SALearn(SAPlugin):
             },
         
         }
+        self.requiredvars.update(BACKEND_BALANCER_VARS)
         
     
     def _get_databases(self):
@@ -786,46 +810,47 @@ class SALearn(SAPlugin):
         for i in range(0, retries):
             try:
                 self.logger.debug('Contacting spamd  (Try %s of %s)' % (i + 1, retries))
-                s = self.__init_socket()
-                s.sendall(force_bString('TELL SPAMC/1.2'))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("Content-length: %s" % spamsize))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("Message-class: %s" % messageclass))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("%s: %s" % (learnaction, ', '.join(databases))))
-                s.sendall(force_bString("\r\n"))
-                if peruserconfig:
-                    s.sendall(force_bString("User: %s" % user))
+                with self._balancer().connection(self._backend_pool) as conn:
+                    s = conn.sock
+                    s.sendall(force_bString('TELL SPAMC/1.2'))
+                    s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString("Content-length: %s" % spamsize))
                     s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString("\r\n"))
-                s.sendall(force_bString(messagecontent))
-                self.logger.debug('Sent %s bytes to spamd' % spamsize)
-                s.shutdown(socket.SHUT_WR)
-                socketfile = s.makefile("rb")
-                line1_info = force_uString(socketfile.readline())
-                self.logger.debug(line1_info)
-                line2_spaminfo = force_uString(socketfile.readline())
+                    s.sendall(force_bString("Message-class: %s" % messageclass))
+                    s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString("%s: %s" % (learnaction, ', '.join(databases))))
+                    s.sendall(force_bString("\r\n"))
+                    if peruserconfig:
+                        s.sendall(force_bString("User: %s" % user))
+                        s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString("\r\n"))
+                    s.sendall(force_bString(messagecontent))
+                    self.logger.debug('Sent %s bytes to spamd' % spamsize)
+                    s.shutdown(socket.SHUT_WR)
+                    socketfile = s.makefile("rb")
+                    line1_info = force_uString(socketfile.readline())
+                    self.logger.debug(line1_info)
+                    line2_spaminfo = force_uString(socketfile.readline())
                 
-                answer = line1_info.strip().split()
-                if len(answer) != 3:
-                    self.logger.error("Got invalid status line from spamd: %s" % line1_info)
-                    continue
+                    answer = line1_info.strip().split()
+                    if len(answer) != 3:
+                        self.logger.error("Got invalid status line from spamd: %s" % line1_info)
+                        continue
                 
-                version, number, status = answer
-                if status != 'EX_OK':
-                    self.logger.error("Got bad status from spamd: %s" % status)
-                    continue
+                    version, number, status = answer
+                    if status != 'EX_OK':
+                        self.logger.error("Got bad status from spamd: %s" % status)
+                        continue
                 
-                self.logger.debug('Spamd said: %s' % line2_spaminfo)
-                hdr, status = line2_spaminfo.split(':')
-                if (learnaction==SALEARN_SET and hdr=='DidSet') \
-                    or (learnaction==SALEARN_REMOVE and hdr=='DidRemove'):
-                    success = True
-                else:
-                    success = False
+                    self.logger.debug('Spamd said: %s' % line2_spaminfo)
+                    hdr, status = line2_spaminfo.split(':')
+                    if (learnaction==SALEARN_SET and hdr=='DidSet') \
+                        or (learnaction==SALEARN_REMOVE and hdr=='DidRemove'):
+                        success = True
+                    else:
+                        success = False
                 
-                return success
+                    return success
             except socket.timeout:
                 self.logger.error('SPAMD Socket timed out.')
             except socket.herror as h:
@@ -20,7 +20,7 @@
 # Copyright (c) 2006 Sophos Plc, www.sophos.com.
 #
 
-from fuglu.shared import AVScannerPlugin, string_to_actioncode, DEFER, DUNNO, actioncode_to_string, apply_template
+from fuglu.shared import AVScannerPlugin, string_to_actioncode, DEFER, DUNNO, actioncode_to_string, apply_template, get_backend_pool
 from fuglu.stringencode import force_bString, force_uString
 import socket
 import os
@@ -105,7 +105,7 @@ Prerequisites: Requires a running sophos daemon with dynamic interface (SAVDI)
 
         for i in range(0, self.config.getint(self.section, 'retries')):
             try:
-                viruses = self.scan_stream(content)
+                viruses = self.scan_stream_cached(content, suspect.id)
                 actioncode, message = self._virusreport(suspect, viruses)
                 return actioncode, message
             except Exception as e:
@@ -129,94 +129,93 @@ Prerequisites: Requires a running sophos daemon with dynamic interface (SAVDI)
           - None if no virus found
         """
 
-        s = self.__init_socket__()
         dr = {}
+        with self._backend_pool().connection() as conn:
+            s = conn.sock
 
-        # Read the welcome message
+            # Read the welcome message
 
-        if not self._exchange_greetings(s):
-            raise Exception("SSSP Greeting failed: %s" % self._last_line)
+            if not self._exchange_greetings(s):
+                raise Exception("SSSP Greeting failed: %s" % self._last_line)
 
-        # QUERY to discover the maxclassificationsize
-        s.send(b'SSSP/1.0 QUERY\n')
+            # QUERY to discover the maxclassificationsize
+            s.send(b'SSSP/1.0 QUERY\n')
 
-        if not self._accepted(s):
-            raise Exception("SSSP Query rejected: %s" % self._last_line)
+            if not self._accepted(s):
+                raise Exception("SSSP Query rejected: %s" % self._last_line)
 
-        options = self._read_options(s)
+            options = self._read_options(s)
 
-        # Set the options for classification
-        enableoptions = [
-            b"TnefAttachmentHandling",
-            b"ActiveMimeHandling",
-            b"Mime",
-            b"ZipDecompression",
-            b"DynamicDecompression",
-        ]
+            # Set the options for classification
+            enableoptions = [
+                b"TnefAttachmentHandling",
+                b"ActiveMimeHandling",
+                b"Mime",
+                b"ZipDecompression",
+                b"DynamicDecompression",
+            ]
 
-        enablegroups = [
-            b'GrpExecutable',
-            b'GrpArchiveUnpack',
-            b'GrpSelfExtract',
-            b'GrpInternet',
-            b'GrpSuper',
-            b'GrpMisc',
-        ]
+            enablegroups = [
+                b'GrpExecutable',
+                b'GrpArchiveUnpack',
+                b'GrpSelfExtract',
+                b'GrpInternet',
+                b'GrpSuper',
+                b'GrpMisc',
+            ]
 
-        sendbuf = "OPTIONS\nreport:all\n"
-        for opt in enableoptions:
-            sendbuf += "savists: %s 1\n" % force_uString(opt)
+            sendbuf = "OPTIONS\nreport:all\n"
+            for opt in enableoptions:
+                sendbuf += "savists: %s 1\n" % force_uString(opt)
 
 
-        for grp in enablegroups:
-            sendbuf += "savigrp: %s 1\n" % force_uString(grp)
+            for grp in enablegroups:
+                sendbuf += "savigrp: %s 1\n" % force_uString(grp)
 
-        # all sent, add aditional newline
-        sendbuf += "\n"
+            # all sent, add aditional newline
+            sendbuf += "\n"
 
-        s.send(force_bString(sendbuf))
+            s.send(force_bString(sendbuf))
 
-        if not self._accepted(s):
-            raise Exception("SSSP Options not accepted: %s" % self._last_line)
+            if not self._accepted(s):
+                raise Exception("SSSP Options not accepted: %s" % self._last_line)
 
-        resp = self._receive_msg(s)
+            resp = self._receive_msg(s)
 
-        for l in resp:
-            if donesyntax.match(l):
-                parts = donesyntax.findall(l)
-                if parts[0][0] != b'OK':
-                    raise Exception("SSSP Options failed")
-                break
+            for l in resp:
+                if donesyntax.match(l):
+                    parts = donesyntax.findall(l)
+                    if parts[0][0] != b'OK':
+                        raise Exception("SSSP Options failed")
+                    break
 
-        # Send the SCAN request
+            # Send the SCAN request
 
-        s.send(force_bString('SCANDATA ' + str(len(content)) + '\n'))
-        if not self._accepted(s):
-            raise Exception("SSSP Scan rejected: %s" % self._last_line)
+            s.send(force_bString('SCANDATA ' + str(len(content)) + '\n'))
+            if not self._accepted(s):
+                raise Exception("SSSP Scan rejected: %s" % self._last_line)
 
-        s.sendall(force_bString(content))
+            s.sendall(force_bString(content))
 
-        # and read the result
-        events = self._receive_msg(s)
+            # and read the result
+            events = self._receive_msg(s)
 
-        for l in events:
-            if virussyntax.match(l):
-                parts = virussyntax.findall(l)
-                virus = force_uString(parts[0][0])
-                filename = force_uString(parts[0][1])
-                try:
-                    filename = tmpdirsyntax.findall(filename)[0][1]
-                except IndexError:
-                    pass
-                dr[filename] = virus
+            for l in events:
+                if virussyntax.match(l):
+                    parts = virussyntax.findall(l)
+                    virus = force_uString(parts[0][0])
+                    filename = force_uString(parts[0][1])
+                    try:
+                        filename = tmpdirsyntax.findall(filename)[0][1]
+                    except IndexError:
+                        pass
+                    dr[filename] = virus
 
-        try:
-            self._say_goodbye(s)
-            s.shutdown(socket.SHUT_RDWR)
-        except socket.error as e:
-            self.logger.warning('%s Error terminating connection: %s', (suspectid, str(e)))
-        finally:
-            s.close()
+            try:
+                self._say_goodbye(s)
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error as e:
+                self.logger.warning('%s Error terminating connection: %s', (suspectid, str(e)))
 
         if dr == {}:
             return None
@@ -224,6 +223,16 @@ Prerequisites: Requires a running sophos daemon with dynamic interface (SAVDI)
             return dr
     
     
+    def _backend_pool(self):
+        """connection pool to the configured SSSP server, connections end with BYE and are not reused"""
+        try:
+            self.config.getint(self.section, 'port')
+            backend = '%s:%s' % (self.config.get(self.section, 'host'), self.config.get(self.section, 'port'))
+        except ValueError:
+            backend = self.config.get(self.section, 'port')
+        return get_backend_pool(self.config, 'sssp:%s' % backend, self.__init_socket__)
+    
+    
     def __init_socket__(self):
         unixsocket = False
 
@@ -21,9 +21,14 @@ from fuglu.protocolbase import compress_task, uncompress_task
 from fuglu.scansession import SessionHandler
 from fuglu.stats import Statskeeper, StatDelta
 from fuglu.addrcheck import Addrcheck
+from fuglu.threadpool import ThreadPool
 from queue import Empty as EmptyQueue
+import gc
 import multiprocessing
+import multiprocessing.connection
 import multiprocessing.queues
+import queue as localqueue
+import selectors
 import signal
 import time
 import logging
@@ -38,17 +43,34 @@ try:
     OBJGRAPH_EXTENSION_ENABLED = True
 except ImportError:
     OBJGRAPH_EXTENSION_ENABLED = False
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 
 class ProcManager(object):
-    def __init__(self, logQueue, numprocs = None, queuesize=100, config = None):
+    def __init__(self, logQueue, numprocs = None, queuesize=100, config = None, minthreads=0, maxthreads=0,
+                 reuseport=False, plugins=None):
+        """
+        Process pool, if maxthreads is set each worker process runs its own
+        threadpool (hybrid backend) handling several sessions at the same time.
+        With reuseport the worker processes bind the incoming ports themselves, the
+        task queue is then only used for poison pills and tasks moved from another pool.
+        If plugins (tuple of prependers, plugins, appenders loaded in this process) are
+        given the workers use them instead of loading their own.
+        """
         self._child_id_counter=0
         self._logQueue = logQueue
         self.manager = multiprocessing.Manager()
         self.shared_state = self._init_shared_state()
         self.config = config
         self.numprocs = numprocs
+        self.minthreads = minthreads
+        self.maxthreads = maxthreads
+        self.reuseport = reuseport
+        self.plugins = plugins
         self.workers = []
         self.queuesize = queuesize
         self.tasks = multiprocessing.Queue(queuesize)
@@ -57,7 +79,15 @@ class ProcManager(object):
         self.logger = logging.getLogger('%s.procpool' % __package__)
         self._stayalive = True
         self.name = 'ProcessPool'
-        self.message_listener = MessageListener(self.child_to_server_messages)
+        self.message_listener = MessageListener(self.child_to_server_messages, recycle_callback=self._replace_worker)
+        self._supervise = True
+        self._workers_lock = threading.Lock()
+        self._retire_events = {}
+        self._listening_events = {}
+        self.retiring = []
+        self.reload_status = None
+        self.supervisor = threading.Thread(target=self._supervise_workers, name='Process supervisor')
+        self.supervisor.daemon = True
         self.start()
 
     def _init_shared_state(self):
@@ -105,23 +135,208 @@ class ProcManager(object):
             self.logger.error("Exception happened trying to add task to queue: %s" % str(e))
             self.logger.exception(e)
 
+    def queue_depth(self):
+        """number of tasks waiting for a worker process"""
+        try:
+            return self.tasks.qsize()
+        except NotImplementedError:
+            # not available on all platforms (macOS)
+            return 0
+
+    def estimated_wait(self):
+        """waiting times are not tracked for the process pool"""
+        return 0.0
+
     def _create_worker(self):
         self._child_id_counter +=1
         worker_name = "Worker-%s"%self._child_id_counter
+        # set to tell the worker to finish (rolling reload)
+        self._retire_events[worker_name] = multiprocessing.Event()
+        # set by the worker once it's accepting connections (reuseport)
+        self._listening_events[worker_name] = multiprocessing.Event()
         worker = multiprocessing.Process(target=fuglu_process_worker, name=worker_name,
-                                         args=(self.tasks, self.config, self.shared_state, self.child_to_server_messages, self._logQueue))
+                                         args=(self.tasks, self.config, self.shared_state, self.child_to_server_messages, self._logQueue,
+                                               self.minthreads, self.maxthreads, self.reuseport, self.plugins,
+                                               self._retire_events[worker_name], self._listening_events[worker_name]))
+        return worker
+
+    def wait_listening(self, workers=None, timeout=60.0):
+        """
+        With reuseport, wait until the worker processes bound the incoming ports, so the
+        listeners of the workers they replace can be closed without refusing connections.
+
+        Keyword Args:
+            workers (list): worker processes, default: all workers
+            timeout (float): maximum time to wait in seconds
+
+        Returns:
+            bool: False if a worker is not listening within timeout
+        """
+        if not self.reuseport:
+            return True
+        if workers is None:
+            with self._workers_lock:
+                workers = self.workers[:]
+        endtime = time.time() + timeout
+        for worker in workers:
+            event = self._listening_events.get(worker.name)
+            while event is not None and not event.wait(0.1):
+                if not worker.is_alive() or time.time() > endtime:
+                    self.logger.warning("Worker %s is not accepting connections" % worker.name)
+                    return False
+        return True
+
+    def _start_worker(self):
+        """create and start a worker process"""
+        worker = self._create_worker()
+        if self.plugins is None:
+            worker.start()
+            return worker
+        # keep the objects existing now out of the garbage collector in the child,
+        # collecting would touch them and copy the shared memory pages. The parent
+        # keeps collecting them, otherwise every fork would add to the frozen objects
+        gc.collect()
+        gc.freeze()
+        try:
+            worker.start()
+        finally:
+            gc.unfreeze()
         return worker
 
     def start(self):
         for i in range(self.numprocs):
-            worker = self._create_worker()
-            worker.start()
+            worker = self._start_worker()
             self.workers.append(worker)
 
         # Start the child-to-parent message listener
         self.message_listener.start()
+        self.supervisor.start()
+
+    def _replace_worker(self, name):
+        """
+        Start a new worker for a worker process announcing it exits because it
+        reached max_messages_per_worker or max_rss_per_worker. The old worker
+        finishes its sessions meanwhile.
+        """
+        with self._workers_lock:
+            if not self._supervise:
+                return
+            for index, worker in enumerate(self.workers):
+                if worker.name == name:
+                    newworker = self._start_worker()
+                    self.workers[index] = newworker
+                    self.retiring.append(worker)
+                    self.logger.info("Worker %s (pid: %s) is recycled, started %s" % (name, worker.pid, newworker.name))
+                    break
+
+    def _supervise_workers(self):
+        """
+        Replace worker processes which exited unexpectedly (crashed) while the pool is running
+        and clean up recycled workers. Tasks stay in the queue until the replacement or another
+        worker picks them up.
+        """
+        while self._supervise:
+            sentinels = [worker.sentinel for worker in self.workers + self.retiring]
+            multiprocessing.connection.wait(sentinels, timeout=0.5)
+            with self._workers_lock:
+                if not self._supervise:
+                    break
+                for worker in self.retiring[:]:
+                    if not worker.is_alive():
+                        worker.join()
+                        self.retiring.remove(worker)
+                        self._remove_state(worker)
+
+                for index, worker in enumerate(self.workers[:]):
+                    if worker.is_alive():
+                        continue
+                    worker.join()
+                    state = self._remove_state(worker)
+                    # exit code 0: recycled worker which exited before the announcement was processed
+                    log = self.logger.info if worker.exitcode == 0 else self.logger.error
+                    log("Worker %s (pid: %s) exited with code %s (%s), starting a new worker"
+                        % (worker.name, worker.pid, worker.exitcode, state))
+                    newworker = self._start_worker()
+                    self.workers[index] = newworker
+
+    def rolling_reload(self, config, plugins=None, batchsize=1):
+        """
+        Replace the worker processes by workers using the new configuration in batches of
+        batchsize workers, running in a background thread. The new workers of a batch are started
+        before the old ones are told to finish their sessions, the next batch starts once the
+        old workers exited. The number of workers is not changed (see restart_required).
+
+        Args:
+            config (RawConfigParser): new configuration
+            plugins (tuple): preloaded plugins (see constructor)
+            batchsize (int): number of workers replaced at the same time
+        """
+        with self._workers_lock:
+            self.config = config
+            self.plugins = plugins
+            oldworkers = self.workers[:]
+        reloader = threading.Thread(target=self._rolling_reload, args=(oldworkers, max(1, batchsize)),
+                                    name='Rolling reload')
+        reloader.daemon = True
+        reloader.start()
+
+    def restart_required(self, numprocs, minthreads, maxthreads, reuseport):
+        """True if the pool can't be reloaded by replacing the workers (rolling_reload)"""
+        return (numprocs, minthreads, maxthreads, reuseport) != \
+               (len(self.workers), self.minthreads, self.maxthreads, self.reuseport)
+
+    def _rolling_reload(self, oldworkers, batchsize):
+        starttime = time.time()
+        replaced = 0
+        for start in range(0, len(oldworkers), batchsize):
+            batch = []
+            with self._workers_lock:
+                if not self._supervise:
+                    self.reload_status = "aborted, pool shut down"
+                    return
+                newworkers = []
+                for worker in oldworkers[start:start + batchsize]:
+                    if worker not in self.workers:
+                        # recycled or crashed meanwhile, the replacement has the new config
+                        continue
+                    newworker = self._start_worker()
+                    self.workers[self.workers.index(worker)] = newworker
+                    self.retiring.append(worker)
+                    newworkers.append(newworker)
+                    batch.append(worker)
+
+            # the new workers accept the connections before the old ones close their listeners
+            self.wait_listening(newworkers)
+            for worker in batch:
+                retire = self._retire_events.get(worker.name)
+                if retire is not None:
+                    retire.set()
+
+            # let the old workers finish their sessions before the next batch
+            while batch and self._supervise:
+                multiprocessing.connection.wait([worker.sentinel for worker in batch], timeout=1.0)
+                batch = [worker for worker in batch if worker.is_alive()]
+            replaced = min(start + batchsize, len(oldworkers))
+            self.reload_status = "%u/%u workers replaced" % (replaced, len(oldworkers))
+            self.logger.info("Rolling reload: %s" % self.reload_status)
+
+        self.reload_status = "complete, %u workers replaced in %.1fs" % (replaced, time.time() - starttime)
+        self.logger.info("Rolling reload %s" % self.reload_status)
+
+    def _remove_state(self, worker):
+        self._retire_events.pop(worker.name, None)
+        self._listening_events.pop(worker.name, None)
+        try:
+            return self.shared_state.pop(worker.name, '')
+        except Exception:
+            return ''
 
     def shutdown(self, newmanager=None):
+        # stop replacing exited workers, so there's a poison pill for every worker
+        with self._workers_lock:
+            self._supervise = False
+        self.supervisor.join()
+
         # setting stayalive equal to False
         # will send poison pills to all processors
         self.logger.debug("Shutdown procpool -> send poison pills")
@@ -180,7 +395,7 @@ class ProcManager(object):
         self.logger.debug("Join workers")
         tstart = time.time()
         remaining_timeout = join_timeout
-        for worker in self.workers:
+        for worker in self.workers + self.retiring:
             tpassed = time.time()-tstart
             remaining_timeout = max(join_timeout - tpassed, 0.05)
             worker.join(remaining_timeout)
@@ -208,10 +423,11 @@ class ProcManager(object):
         self.logger.debug("done...")
 
 class MessageListener(threading.Thread):
-    def __init__(self, message_queue):
+    def __init__(self, message_queue, recycle_callback=None):
         threading.Thread.__init__(self)
         self.name = "Process Message Listener"
         self.message_queue = message_queue
+        self.recycle_callback = recycle_callback
         self.stayalive = True
         self.statskeeper = Statskeeper()
         self.daemon = True
@@ -229,9 +445,15 @@ class MessageListener(threading.Thread):
                     self.statskeeper.increase_counter_values(delta)
                 except Exception:
                     print(traceback.format_exc())
+            elif event_type == 'recycle' and self.recycle_callback is not None: # worker process is exiting
+                try:
+                    self.recycle_callback(message['name'])
+                except Exception:
+                    print(traceback.format_exc())
 
 
-def fuglu_process_worker(queue, config, shared_state, child_to_server_messages, logQueue):
+def fuglu_process_worker(queue, config, shared_state, child_to_server_messages, logQueue, minthreads=0, maxthreads=0,
+                         reuseport=False, plugins=None, retire=None, listening=None):
 
 
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
@@ -258,7 +480,13 @@ def fuglu_process_worker(queue, config, shared_state, child_to_server_messages,
     logger.debug("Create MainController")
     controller = fuglu.core.MainController(config, logQueue=logQueue, nolog=True)
     controller.load_extensions()
-    controller.load_plugins()
+    if plugins is not None:
+        # plugins loaded by the parent process, shared copy-on-write
+        logger.debug("Use plugins loaded by parent process")
+        controller.prependers, controller.plugins, controller.appenders = plugins
+    else:
+        controller.load_plugins()
+    controller.reuseport = reuseport
 
     prependers = controller.prependers
     plugins = controller.plugins
@@ -267,6 +495,16 @@ def fuglu_process_worker(queue, config, shared_state, child_to_server_messages,
     # forward statistics counters to parent process
     stats = Statskeeper()
     stats.stat_listener_callback.append(lambda event: child_to_server_messages.put(event.as_message()))
+    recycler = WorkerRecycler(config, child_to_server_messages, retire)
+
+    if maxthreads > 0:
+        fuglu_process_worker_threads(queue, config, controller, workerstate, logger, minthreads, maxthreads, recycler,
+                                     listening)
+        return
+
+    if reuseport:
+        fuglu_process_worker_listen(queue, config, controller, workerstate, logger, recycler, listening)
+        return
 
     logger.debug("%s: Enter service loop..." % logtools.createPIDinfo())
 
@@ -274,7 +512,11 @@ def fuglu_process_worker(queue, config, shared_state, child_to_server_messages,
         while True:
             workerstate.workerstate = 'waiting for task'
             logger.debug("%s: Child process waiting for task" % logtools.createPIDinfo())
-            task = queue.get()
+            task = _wait_for_task(queue, recycler)
+            if task is False:
+                logger.info("%s: Child process replaced by rolling reload" % logtools.createPIDinfo())
+                workerstate.workerstate = 'ended (recycled)'
+                return
             if task is None: # poison pill
                 logger.debug("%s: Child process received poison pill - shut down" % logtools.createPIDinfo())
                 try:
@@ -308,6 +550,14 @@ def fuglu_process_worker(queue, config, shared_state, child_to_server_messages,
             if OBJGRAPH_EXTENSION_ENABLED and False:
                 debug_procpoolworkermemory(logger, config)
 
+            reason = recycler.reason()
+            if reason:
+                # the remaining tasks are picked up by the other workers and the replacement
+                logger.info("%s: Child process recycled: %s" % (logtools.createPIDinfo(), reason))
+                recycler.announce()
+                workerstate.workerstate = 'ended (recycled)'
+                return
+
     except KeyboardInterrupt:
         workerstate.workerstate = 'ended (keyboard interrupt)'
         logger.debug("Keyboard interrupt")
@@ -319,6 +569,268 @@ def fuglu_process_worker(queue, config, shared_state, child_to_server_messages,
         queue.close()
         controller.shutdown()
 
+def fuglu_process_worker_threads(queue, config, controller, workerstate, logger, minthreads, maxthreads, recycler=None,
+                                 listening=None):
+    """
+    Service loop of a worker process with its own threadpool (hybrid backend). Tasks
+    are taken from the shared queue and passed to the local threadpool. The local queue
+    is limited to maxthreads tasks so other processes can still pick up waiting tasks.
+    """
+    # never run more threads than configured, a pool with minthreads == maxthreads has a fixed size
+    maxthreads = max(maxthreads, 1)
+    minthreads = min(max(minthreads, 1), maxthreads)
+
+    try:
+        target_latency = config.getfloat('performance', 'target_latency')
+        min_busy_ratio = config.getfloat('performance', 'min_busy_ratio')
+    except Exception:
+        target_latency = 0.0
+        min_busy_ratio = 0.5
+
+    # the local queue needs room for the poison pills sent on shutdown
+    threadpool = ThreadPool(controller, minthreads=minthreads, maxthreads=maxthreads, queuesize=maxthreads + 1,
+                            target_latency=target_latency, min_busy_ratio=min_busy_ratio)
+    controller.threadpool = threadpool
+    if controller.reuseport:
+        # accepted connections are passed to the threadpool by the server threads
+        controller._start_connectors()
+        if listening is not None:
+            listening.set()
+
+    logger.debug("%s: Enter service loop with %u-%u threads..." % (logtools.createPIDinfo(), minthreads, maxthreads))
+
+    try:
+        while True:
+            # tasks stay in the shared queue for other processes until a local thread is free
+            if not threadpool.wait_for_room(threadpool.maxthreads, timeout=1.0):
+                continue
+
+            reason = recycler.reason() if recycler is not None else None
+            if reason:
+                logger.info("%s: Child process recycled: %s" % (logtools.createPIDinfo(), reason))
+                recycler.announce()
+                break
+
+            workerstate.workerstate = _threadpool_state(threadpool, 'waiting for task')
+            try:
+                task = queue.get(timeout=1.0)
+            except EmptyQueue:
+                continue
+            if task is None: # poison pill
+                logger.debug("%s: Child process received poison pill - shut down" % logtools.createPIDinfo())
+                break
+            threadpool.add_task(task)
+            workerstate.workerstate = _threadpool_state(threadpool, 'task received')
+
+        if controller.reuseport:
+            # stop accepting connections before the remaining sessions are finished, connections
+            # waiting in the accept queue of this process would be lost when closing
+            for server in controller.servers:
+                server.drain()
+
+        # let the threads handle the tasks already received
+        threadpool.wait_for_room(1)
+        try:
+            workerstate.workerstate = 'ended (recycled)' if reason else 'ended (poison pill)'
+        except Exception as e:
+            logger.debug("Exception setting workstate while getting poison pill")
+            logger.exception(e)
+    except KeyboardInterrupt:
+        workerstate.workerstate = 'ended (keyboard interrupt)'
+        logger.debug("Keyboard interrupt")
+    except Exception as e:
+        logger.error("Exception in worker process: %s" % str(e))
+        workerstate.workerstate = 'crashed'
+    finally:
+        queue.close()
+        # shuts down the threadpool as well, running sessions are finished
+        controller.shutdown()
+
+
+def fuglu_process_worker_listen(queue, config, controller, workerstate, logger, recycler=None, listening=None):
+    """
+    Service loop of a worker process binding the incoming ports itself (SO_REUSEPORT). One
+    session is handled at a time, the task queue is read by a helper thread for poison pills
+    and tasks transferred from another pool.
+    """
+    controller._start_connectors(serve=False)
+    if listening is not None:
+        listening.set()
+    selector = selectors.DefaultSelector()
+    for server in controller.servers:
+        if server.stayalive:
+            # another process might accept the connection first
+            server._socket.setblocking(False)
+            selector.register(server._socket, selectors.EVENT_READ, server)
+
+    tasks = localqueue.Queue()
+    reading = threading.Event()
+    reading.set()
+
+    def read_queue():
+        # don't block forever, a process exiting while waiting keeps the lock of the queue
+        while reading.is_set():
+            try:
+                task = queue.get(timeout=1.0)
+            except EmptyQueue:
+                continue
+            tasks.put(task)
+            if task is None:
+                break
+
+    def handle_task(task):
+        workerstate.workerstate = 'starting scan session'
+        sock, handler_modulename, handler_classname, port = uncompress_task(task)
+        handler_class = getattr(importlib.import_module(handler_modulename), handler_classname)
+        handler = SessionHandler(handler_class(sock, config), config, controller.prependers,
+                                 controller.plugins, controller.appenders, port)
+        handler.handlesession(workerstate)
+
+    reader = threading.Thread(target=read_queue, name='Task queue reader')
+    reader.daemon = True
+    reader.start()
+
+    logger.debug("%s: Enter service loop listening on %u ports..." % (logtools.createPIDinfo(), len(controller.servers)))
+    try:
+        while True:
+            workerstate.workerstate = 'waiting for connection'
+            for key, _ in selector.select(timeout=1.0):
+                server = key.data
+                try:
+                    sock, _ = server._socket.accept()
+                except (BlockingIOError, OSError):
+                    # another process was faster
+                    continue
+                workerstate.workerstate = 'starting scan session'
+                server.handle_connection(sock)
+                del sock
+
+            reason = recycler.reason() if recycler is not None else None
+            if reason:
+                logger.info("%s: Child process recycled: %s" % (logtools.createPIDinfo(), reason))
+                recycler.announce()
+                reading.clear()
+                reader.join()
+                # connections waiting in the accept queue of this process would be lost when closing
+                for server in controller.servers:
+                    server.drain()
+                # tasks already taken from the shared queue
+                while not tasks.empty():
+                    task = tasks.get_nowait()
+                    if task is not None:
+                        handle_task(task)
+                workerstate.workerstate = 'ended (recycled)'
+                break
+
+            try:
+                task = tasks.get_nowait()
+            except localqueue.Empty:
+                continue
+            if task is None:  # poison pill
+                logger.debug("%s: Child process received poison pill - shut down" % logtools.createPIDinfo())
+                # the workers of a new pool are listening already (see ProcManager.wait_listening)
+                for server in controller.servers:
+                    server.drain()
+                workerstate.workerstate = 'ended (poison pill)'
+                break
+            handle_task(task)
+    except KeyboardInterrupt:
+        workerstate.workerstate = 'ended (keyboard interrupt)'
+        logger.debug("Keyboard interrupt")
+    except Exception as e:
+        logger.error("Exception in worker process: %s" % str(e))
+        workerstate.workerstate = 'crashed'
+    finally:
+        selector.close()
+        queue.close()
+        # closes the listening sockets
+        controller.shutdown()
+
+
+class WorkerRecycler(object):
+    """
+    Checks if a worker process should be replaced by a fresh one because it
+    reached max_messages_per_worker or max_rss_per_worker
+    """
+
+    def __init__(self, config, messages=None, retire=None):
+        self.messages = messages
+        self.retire = retire
+        try:
+            self.max_messages = config.getint('performance', 'max_messages_per_worker')
+            self.max_rss = config.getint('performance', 'max_rss_per_worker')
+        except Exception:
+            self.max_messages = 0
+            self.max_rss = 0
+        # the counters of the parent are copied when forking
+        self.startcount = Statskeeper().totalcount
+
+    def reason(self):
+        """
+        Returns:
+            str: reason to recycle the worker, None if the limits are not reached
+        """
+        if self.retired():
+            return "replaced by rolling reload"
+        if self.max_messages > 0:
+            count = Statskeeper().totalcount - self.startcount
+            if count >= self.max_messages:
+                return "%u messages processed" % count
+        if self.max_rss > 0:
+            rss = current_rss()
+            if rss is not None and rss >= self.max_rss * 1024 * 1024:
+                return "rss %.1fMB" % (rss / 1024.0 / 1024.0)
+        return None
+
+    def retired(self):
+        """True if the parent already started a replacement for this worker (rolling reload)"""
+        return self.retire is not None and self.retire.is_set()
+
+    def announce(self):
+        """tell the parent to start the replacement while this worker finishes"""
+        if self.messages is not None and not self.retired():
+            self.messages.put(dict(event_type='recycle', name=multiprocessing.current_process().name))
+
+
+def _wait_for_task(queue, recycler):
+    """
+    Get the next task from the shared queue, regularly checking if the
+    worker has been replaced by a rolling reload meanwhile
+
+    Returns:
+        the task, None for a poison pill or False if the worker is retired
+    """
+    while True:
+        try:
+            return queue.get(timeout=1.0)
+        except EmptyQueue:
+            if recycler.retired():
+                return False
+
+
+def current_rss():
+    """
+    Resident set size of the current process in bytes, None if not available. Uses /proc,
+    otherwise falls back to the peak rss
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes otherwise
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _threadpool_state(threadpool, state):
+    workers = threadpool.workers[:]
+    busy = len([w for w in workers if w.workerstate not in ('waiting for task', 'created')])
+    return "%s (threads: %u, busy: %u, queued: %u)" % (state, len(workers), busy, threadpool.tasks.qsize())
+
+
 def debug_procpoolworkermemory(logger, config):
     """
     Debug memory usage using the objgraph library, eventually
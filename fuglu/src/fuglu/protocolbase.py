@@ -19,6 +19,7 @@ import pickle
 import socket
 import threading
 from fuglu.scansession import SessionHandler
+from fuglu.stats import Statskeeper, StatDelta
 import traceback
 from multiprocessing.reduction import ForkingPickler
 import os
@@ -34,6 +35,65 @@ class ProtocolHandler(object):
         self.config = config
         self.logger = logging.getLogger('fuglu.%s' % self.__class__.__name__)
         self.sess = None
+        self._received = None
+
+    def receive(self):
+        """
+        Receive the next message from the socket. If the message has already been
+        received by receive_async (asyncio backend) the stored result is returned.
+
+        Returns:
+            bool: True if a message has been received
+        """
+        if self._received is not None:
+            received, self._received = self._received, None
+            return received
+        return self.sess.getincomingmail()
+
+    async def receive_async(self, loop):
+        """
+        Receive the next message without blocking the event loop (asyncio backend).
+        The socket is switched to non-blocking mode while receiving, the following
+        call to get_suspect will use the message received here.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): event loop running the session
+
+        Returns:
+            bool: True if a message has been received
+        """
+        timeout = self.socket.gettimeout()
+        self.socket.setblocking(False)
+        try:
+            self._received = await self.sess.getincomingmail_async(loop)
+        finally:
+            try:
+                self.socket.settimeout(timeout)
+            except OSError:
+                # socket has been closed by the session
+                pass
+        return self._received
+
+    def set_plugins(self, plugins):
+        """
+        Called with all the plugins which will process the messages before the first
+        message is received, so the handler can adapt the protocol. The default does nothing.
+
+        Args:
+            plugins (list): prepender, scanner and appender plugins
+        """
+        pass
+
+    def refuse(self, reason):
+        """
+        Refuse a new connection with a temporary failure before the message is received
+        (admission control). This is called in the thread accepting connections, so it
+        must not wait for the client. The default is to defer.
+
+        Args:
+            reason (str): reason for the temporary failure
+        """
+        self.defer(reason)
 
     def remove_tmpfile(self):
         tmpfile = self.get_tmpfile()
@@ -87,8 +147,12 @@ class BasicTCPServer(object):
         try:
             self._socket = socket.socket(addr_f, socket.SOCK_STREAM)
             self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if controller.reuseport:
+                # every worker process binds its own listener, the kernel distributes the connections
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._socket.bind((address, port))
-            self._socket.listen(5)
+            # with reuseport every process has its own accept queue which has to take the bursts
+            self._socket.listen(socket.SOMAXCONN if controller.reuseport else 5)
         except Exception as e:
             self.logger.error('Could not start incoming Server on port %s: %s' % (port, e))
             self.stayalive = False
@@ -102,12 +166,31 @@ class BasicTCPServer(object):
         except Exception:
             pass
 
+    def drain(self):
+        """
+        Stop accepting, handle the connections still waiting in the accept queue
+        and close the listening socket. With reuseport the connections in the
+        queue of a closed socket are reset, the other processes don't get them.
+        """
+        self.stayalive = False
+        try:
+            self._socket.setblocking(False)
+            while True:
+                try:
+                    sock, _ = self._socket.accept()
+                except OSError:
+                    break
+                self.handle_connection(sock)
+        finally:
+            self.shutdown()
+
     def serve(self):
         # Important:
         # -> do NOT create local variables which are copies of member variables like
         # controller = self.controller
         # threadpool = self.controller.threadpool
         # procpool = self.controller.procpool
+        # asyncpool = self.controller.asyncpool
         # Since thes variables might change while in the stayalive loop the process would get stuck,
         # example: when sending SIGHUP which might recreate the processor pool or threads pool
         #          which would then still point to the wrong (old) memory location and is therefore not served anymore
@@ -123,25 +206,54 @@ class BasicTCPServer(object):
                 self.logger.debug('Waiting for connection...')
                 nsd = self._socket.accept()
                 sock,addr = nsd
-                if not self.stayalive:
+                if not self.stayalive and not self.controller.reuseport:
                     break
-                handler_classname = self.protohandlerclass.__name__
-                handler_modulename = self.protohandlerclass.__module__
-                self.logger.debug('(%s) Incoming connection  [incoming server port: %s, prot: %s]' % (createPIDinfo(),self.port,self.protohandlerclass.protoname))
-                if self.controller.threadpool:
-                    # this will block if queue is full
-                    self.controller.threadpool.add_task_from_socket(sock, handler_modulename, handler_classname, self.port)
-                elif self.controller.procpool:
-                    self.controller.procpool.add_task_from_socket(sock, handler_modulename, handler_classname, self.port)
-                else:
-                    ph = self.protohandlerclass(sock, self.controller.config)
-                    engine = SessionHandler(ph, self.controller.config, self.controller.prependers,
-                                            self.controller.plugins, self.controller.appenders, self.port)
-                    engine.handlesession()
+                # with reuseport a connection accepted while draining is still handled (see drain)
+                self.handle_connection(sock)
             except Exception as e:
                 exc = traceback.format_exc()
                 self.logger.error('Exception in serve(): %s - %s' % (str(e), exc))
 
+    def handle_connection(self, sock):
+        """
+        Pass an accepted connection to the backend or handle the session directly
+        if there is no backend (worker process with its own listener)
+
+        Args:
+            sock (socket): accepted connection
+        """
+        handler_classname = self.protohandlerclass.__name__
+        handler_modulename = self.protohandlerclass.__module__
+        self.logger.debug('(%s) Incoming connection  [incoming server port: %s, prot: %s]' % (createPIDinfo(),self.port,self.protohandlerclass.protoname))
+
+        reason = self.controller.admission_check()
+        if reason:
+            self.logger.warning('Refusing connection on port %s: %s' % (self.port, reason))
+            Statskeeper().increase_counter_values(StatDelta(refused=1))
+            try:
+                ph = self.protohandlerclass(sock, self.controller.config)
+                ph.refuse(self.controller.config.get('performance', 'admission_message'))
+            except Exception as e:
+                self.logger.error('Could not refuse connection: %s' % str(e))
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+            return
+
+        if self.controller.threadpool:
+            # this will block if queue is full
+            self.controller.threadpool.add_task_from_socket(sock, handler_modulename, handler_classname, self.port)
+        elif self.controller.procpool:
+            self.controller.procpool.add_task_from_socket(sock, handler_modulename, handler_classname, self.port)
+        elif self.controller.asyncpool:
+            self.controller.asyncpool.add_task_from_socket(sock, handler_modulename, handler_classname, self.port)
+        else:
+            ph = self.protohandlerclass(sock, self.controller.config)
+            engine = SessionHandler(ph, self.controller.config, self.controller.prependers,
+                                    self.controller.plugins, self.controller.appenders, self.port)
+            engine.handlesession()
+
 
 def compress_task(sock, handler_modulename, handler_classname, port):
     """
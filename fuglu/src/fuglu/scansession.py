@@ -15,7 +15,7 @@
 #
 #
 
-from fuglu.shared import DUNNO, ACCEPT, REJECT, DEFER, DELETE, Suspect
+from fuglu.shared import DUNNO, ACCEPT, REJECT, DEFER, DELETE, Suspect, string_to_actioncode, actioncode_to_string
 from fuglu.debug import CrashStore
 from fuglu.stringencode import force_uString
 import logging
@@ -26,7 +26,59 @@ import tempfile
 import time
 import os
 import datetime
+import threading
+import collections
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# plugin section -> number of abandoned plugin threads still running
+_abandoned_plugins = collections.Counter()
+_abandoned_lock = threading.Lock()
+
+# executor running the scannerplugins for each worker thread, see SessionHandler._plugin_executor
+_plugin_executors = threading.local()
+
+
+def _tags_overlap(tags, othertags):
+    """True if tags and othertags refer to the same data, 'tag:key' is a part of 'tag'"""
+    for tag in tags:
+        for othertag in othertags:
+            if tag == othertag or tag.startswith(othertag + ':') or othertag.startswith(tag + ':'):
+                return True
+    return False
+
+
+def plugins_conflict(plugin, otherplugin):
+    """
+    Check if two scannerplugins can't run concurrently based on the tags they
+    declare (see ScannerPlugin.reads_tags/writes_tags/modifies_source).
+    Plugins without declaration conflict with all other plugins.
+    """
+    reads = getattr(plugin, 'reads_tags', None)
+    otherreads = getattr(otherplugin, 'reads_tags', None)
+    if reads is None or otherreads is None:
+        return True
+    if getattr(plugin, 'modifies_source', True) or getattr(otherplugin, 'modifies_source', True):
+        return True
+    writes = getattr(plugin, 'writes_tags', None) or ()
+    otherwrites = getattr(otherplugin, 'writes_tags', None) or ()
+    return _tags_overlap(writes, otherreads) or _tags_overlap(reads, otherwrites) \
+        or _tags_overlap(writes, otherwrites)
+
+
+def plugin_dependencies(pluglist):
+    """
+    Dependency graph for a list of scannerplugins
+
+    Returns:
+        list: for every plugin the set of indices of previous plugins it has to wait for
+    """
+    dependencies = []
+    for index, plugin in enumerate(pluglist):
+        dependencies.append(set([previous for previous in range(index)
+                                 if plugins_conflict(pluglist[previous], plugin)]))
+    return dependencies
 
 
 class TrackTimings(object):
@@ -211,6 +263,8 @@ class SessionHandler(TrackTimings):
         self.worker = None
         self.message = None
         self.protohandler = protohandler
+        if protohandler is not None:
+            protohandler.set_plugins(list(prependers) + list(plugins) + list(appenders))
 
         try:
             self.enabletimetracker = config.getboolean('main', 'scantimelogger')
@@ -257,7 +311,8 @@ class SessionHandler(TrackTimings):
                     self.logger.warning(message_prefix+u'Notice: Message from %s has %s recipients. Plugins supporting only one recipient will see: %s' % (
                         suspect.from_address, len(suspect.recipients), suspect.to_address))
                 self.logger.debug(message_prefix+u"Message from %s to %s: %s bytes stored to %s" % (
-                    suspect.from_address, suspect.to_address, suspect.size, suspect.tempfile))
+                    suspect.from_address, suspect.to_address, suspect.size,
+                    "memory" if suspect.source_in_memory else suspect.tempfile))
                 self.set_workerstate(message_prefix+u"Handling message %s" % suspect)
                 # store incoming port to tag, could be used to disable plugins
                 # based on port
@@ -353,13 +408,16 @@ class SessionHandler(TrackTimings):
                     self.logger.warning("DEFERRED %s" % suspect.id)
 
                 # clean up
-                try:
-                    os.remove(suspect.tempfile)
-                    self.logger.debug(message_prefix+u'Removed tempfile %s' % (suspect.tempfile if suspect.tempfile else "(not available)"))
-                    suspect.tempfile = None
-                    self.tracktime("Remove-tempfile")
-                except OSError:
-                    self.logger.warning(message_prefix+u'Could not remove tempfile %s' % suspect.tempfile)
+                suspect.release_original_source()
+                # if no plugin needed a file the message has never been written to disk
+                if not suspect.discard_source_in_memory():
+                    try:
+                        os.remove(suspect.tempfile)
+                        self.logger.debug(message_prefix+u'Removed tempfile %s' % (suspect.tempfile if suspect.tempfile else "(not available)"))
+                        suspect.tempfile = None
+                        self.tracktime("Remove-tempfile")
+                    except OSError:
+                        self.logger.warning(message_prefix+u'Could not remove tempfile %s' % suspect.tempfile)
             except KeyboardInterrupt:
                 sys.exit(0)
             except ValueError as e:
@@ -420,6 +478,9 @@ class SessionHandler(TrackTimings):
                         else:
                             self.logger.warning(message_prefix+u'No tmpfile to keep for failed message')
 
+                elif remove_tmpfiles_on_error and suspect.discard_source_in_memory():
+                    # message received in memory, there is no tempfile to remove
+                    pass
                 elif suspect.tempfile is not None:
                     # suspect was created but not stopped cleanly
                     if remove_tmpfiles_on_error:
@@ -512,7 +573,7 @@ class SessionHandler(TrackTimings):
             handle, trashfilename = tempfile.mkstemp(
                 prefix=suspect.id, dir=self.config.get('main', 'trashdir'))
             with os.fdopen(handle, 'w+b') as trashfile:
-                trashfile.write(suspect.get_source())
+                trashfile.write(suspect.get_source_view())
             self.logger.debug('Message stored to trash: %s' % trashfilename)
         except Exception as e:
             self.logger.error(
@@ -530,79 +591,316 @@ class SessionHandler(TrackTimings):
             except Exception as e:
                 self.logger.error("Could not update trash log: %s" % e)
 
+    def _plugin_concurrency(self):
+        try:
+            return max(1, self.config.getint('performance', 'plugin_concurrency'))
+        except Exception:
+            return 1
+
+    def _message_deadline(self):
+        try:
+            return max(0.0, self.config.getfloat('performance', 'message_deadline'))
+        except Exception:
+            return 0.0
+
+    def _plugin_abandoned_max(self):
+        try:
+            return max(0, self.config.getint('performance', 'plugin_abandoned_max'))
+        except Exception:
+            return 10
+
+    def _plugin_budget(self, plugin):
+        """optional time budget of a plugin (option 'scan_budget' in the plugin section), 0 if not set"""
+        try:
+            if self.config.has_option(plugin.section, 'scan_budget'):
+                return max(0.0, self.config.getfloat(plugin.section, 'scan_budget'))
+        except Exception as e:
+            self.logger.error('Invalid scan_budget for plugin %s: %s' % (str(plugin), str(e)))
+        return 0.0
+
     def run_plugins(self, suspect, pluglist):
         """Run scannerplugins on suspect"""
         suspect.debug('Will run plugins: %s' % pluglist)
         self.tracktime("Before-Plugins")
+        concurrency = self._plugin_concurrency()
+        deadline = self._message_deadline()
+        budgets = [self._plugin_budget(plugin) for plugin in pluglist]
+        if (concurrency > 1 and len(pluglist) > 1) or deadline > 0 or any(budgets):
+            self.run_plugins_concurrent(suspect, pluglist, concurrency, deadline, budgets)
+            return
+
         for plugin in pluglist:
             try:
                 self.logger.debug('Running plugin %s' % plugin)
                 self.set_workerstate(
                     "%s : Running Plugin %s" % (suspect, plugin))
-                suspect.debug('Running plugin %s' % str(plugin))
-                starttime = time.time()
-                ans = plugin.examine(suspect)
-                plugintime = time.time() - starttime
-                suspect.tags['scantimes'].append((plugin.section, plugintime))
-                message = None
-                if type(ans) is tuple:
-                    result, message = ans
-                else:
-                    result = ans
-
-                if result is None:
-                    result = DUNNO
+                success, result, message = self.examine_plugin(suspect, plugin)
+                if success and self.apply_plugin_result(suspect, plugin, result, message):
+                    break
+            finally:
+                self.tracktime(str(plugin), plugin=True)
 
-                suspect.tags['decisions'].append((plugin.section, result))
+    def run_plugins_concurrent(self, suspect, pluglist, concurrency, deadline=0.0, budgets=None):
+        """
+        Run scannerplugins on suspect in separate threads, independent plugins (see plugins_conflict)
+        are run concurrently. A plugin is started once all previous plugins it depends on are done.
+        Each plugin examines its own copy of the suspect (see Suspect.isolated_copy), the results
+        and the changes of the copies are applied in the configured order. So the first final
+        decision wins like with sequential processing. Plugins still running at this point
+        are abandoned without waiting for them, they have no effect on the suspect and the
+        following plugins are not started anymore.
+
+        Plugins exceeding their time budget or still running when the deadline for the message
+        expires are abandoned and handled like failed plugins. If the deadline expires before
+        a final decision the deadline_action is applied. Abandoned plugins can't be interrupted,
+        they are not started anymore while plugin_abandoned_max of them are still running.
+        The copy of the suspect of an abandoned plugin is never merged, so changes it makes
+        after the deadline don't show up in the message.
 
-                if result == DUNNO:
-                    suspect.debug('Plugin makes no final decision')
-                elif result == ACCEPT:
-                    suspect.debug(
-                        'Plugin accepts the message - skipping all further tests')
-                    self.logger.debug(
-                        'Plugin says: ACCEPT. Skipping all other tests')
-                    self.action = ACCEPT
-                    break
-                elif result == DELETE:
-                    suspect.debug(
-                        'Plugin DELETES this message - no further tests')
-                    self.logger.debug(
-                        'Plugin says: DELETE. Skipping all other tests')
-                    self.action = DELETE
-                    self.message = message
-                    self.trash(suspect, str(plugin))
-                    break
-                elif result == REJECT:
-                    suspect.debug(
-                        'Plugin REJECTS this message - no further tests')
-                    self.logger.debug(
-                        'Plugin says: REJECT. Skipping all other tests')
-                    self.action = REJECT
-                    self.message = message
-                    break
-                elif result == DEFER:
-                    suspect.debug(
-                        'Plugin DEFERS this message - no further tests')
-                    self.logger.debug(
-                        'Plugin says: DEFER. Skipping all other tests')
-                    self.action = DEFER
-                    self.message = message
+        Args:
+            suspect (Suspect): the suspect
+            pluglist (list): scannerplugins
+            concurrency (int): maximum number of plugins running concurrently
+            deadline (float): maximum time for all plugins in seconds, 0 for no limit
+            budgets (list): maximum time for each plugin in seconds, 0 for no limit
+        """
+        if budgets is None:
+            budgets = [0.0] * len(pluglist)
+        enddate = time.time() + deadline if deadline > 0 else None
+        dependencies = plugin_dependencies(pluglist)
+        results = {}  # index -> (success, result, message, copy of the suspect or None)
+        running = {}  # future -> (index, expires)
+        states = {}  # index -> state shared with the plugin thread
+        copies = {}  # index -> copy of the suspect examined by the plugin
+        abandoned_max = self._plugin_abandoned_max()
+        executor = self._plugin_executor(concurrency)
+        nextresult = 0
+        final = False
+        expired = False
+
+        while nextresult < len(pluglist) and not final:
+            startable = [index for index in range(len(pluglist)) if index not in results
+                         and index not in [i for i, _ in running.values()]
+                         and dependencies[index].issubset(results)]
+            for index in startable[:max(0, concurrency - len(running))]:
+                plugin = pluglist[index]
+                if abandoned_max and _abandoned_plugins[plugin.section] >= abandoned_max:
+                    results[index] = (False, DUNNO, None, None)
+                    self._plugin_timeout(suspect, plugin, 'too many abandoned instances running')
+                    continue
+                self.logger.debug('Running plugin %s' % plugin)
+                expires = time.time() + budgets[index] if budgets[index] > 0 else None
+                states[index] = dict(abandoned=False, finished=False)
+                # plugins which might change the headers in place get their own message representation
+                copy_message = getattr(plugin, 'reads_tags', None) is None or getattr(plugin, 'modifies_source', True)
+                copies[index] = suspect.isolated_copy(copy_message=copy_message)
+                future = executor.submit(self._examine_plugin_thread, copies[index], plugin, states[index])
+                running[future] = (index, expires)
+
+            self.set_workerstate("%s : Running Plugins %s" % (
+                suspect, ', '.join([str(pluglist[index]) for index, _ in sorted(running.values())])))
+
+            limits = [expires for _, expires in running.values() if expires is not None]
+            if enddate is not None:
+                limits.append(enddate)
+            timeout = max(0.0, min(limits) - time.time()) if limits else None
+            done, _ = wait(list(running.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)[0]
+                results[index] = future.result() + (copies.pop(index), )
+
+            now = time.time()
+            timedout = enddate is not None and now >= enddate
+            for future, (index, expires) in list(running.items()):
+                if timedout or (expires is not None and now >= expires):
+                    del running[future]
+                    self._abandon_plugin(pluglist[index], states[index])
+                    results[index] = (False, DUNNO, None, None)
+                    self._plugin_timeout(suspect, pluglist[index], 'deadline' if timedout else 'budget')
+            expired = timedout
+
+            while nextresult < len(pluglist) and (nextresult in results or expired):
+                plugin = pluglist[nextresult]
+                nextresult += 1
+                if nextresult - 1 not in results:
+                    suspect.tags.setdefault('fuglu.scan.skipped', []).append(plugin.section)
+                    continue
+                success, result, message, isolated = results[nextresult - 1]
+                if isolated is not None:
+                    suspect.merge_isolated_copy(isolated)
+                if success and self.apply_plugin_result(suspect, plugin, result, message):
+                    final = True
                     break
-                else:
-                    self.logger.error(
-                        'Invalid Message action Code: %s. Using DUNNO' % result)
 
-            except Exception as e:
-                CrashStore.store_exception()
-                exc = traceback.format_exc()
-                self.logger.error('Plugin %s failed: %s' % (str(plugin), exc))
-                suspect.debug('Plugin failed : %s . Please check fuglu log for more details' % e)
-                ptag = suspect.get_tag("processingerrors", defaultvalue=[])
-                ptag.append("Plugin %s failed: %s" % (str(plugin), str(e)))
-                suspect.set_tag("processingerrors", ptag)
-            finally:
-                self.tracktime(str(plugin), plugin=True)
+        if running:
+            # not waited for, their copies of the suspect are never merged
+            self.logger.debug('Abandoning plugins running after final decision: %s' % ', '.join(
+                [str(pluglist[index]) for index, _ in sorted(running.values())]))
+            for index, _ in running.values():
+                self._abandon_plugin(pluglist[index], states[index])
+
+        if expired:
+            self._deadline_expired(suspect, final)
+        self.tracktime("Plugins (concurrent)", plugin=True)
+
+    def _plugin_executor(self, concurrency):
+        """
+        Executor running the plugins for the sessions of the current worker thread. Threads of
+        abandoned plugins are left to the executor, a new executor is created once there are
+        not enough threads left for concurrency plugins.
+        """
+        abandoned = [state for state in getattr(_plugin_executors, 'abandoned', []) if not state['finished']]
+        executor = getattr(_plugin_executors, 'executor', None)
+        if executor is None or _plugin_executors.size - len(abandoned) < concurrency:
+            if executor is not None:
+                executor.shutdown(wait=False)
+            # some room for abandoned plugins before the executor has to be replaced
+            size = 2 * concurrency
+            executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='fuglu-plugin')
+            _plugin_executors.executor = executor
+            _plugin_executors.size = size
+            abandoned = []
+        _plugin_executors.abandoned = abandoned
+        return executor
+
+    def _examine_plugin_thread(self, suspect, plugin, state):
+        """examine_plugin in a separate thread, keeps track of abandoned plugins"""
+        try:
+            return self.examine_plugin(suspect, plugin, state)
+        finally:
+            with _abandoned_lock:
+                state['finished'] = True
+                if state['abandoned']:
+                    _abandoned_plugins[plugin.section] -= 1
+
+    def _abandon_plugin(self, plugin, state):
+        """the session doesn't wait for the plugin anymore, its results are dropped"""
+        with _abandoned_lock:
+            if not state['finished']:
+                state['abandoned'] = True
+                _abandoned_plugins[plugin.section] += 1
+                _plugin_executors.abandoned.append(state)
+
+    def _plugin_timeout(self, suspect, plugin, reason):
+        """Abandon a plugin which didn't finish in time, handled like a failed plugin"""
+        self.logger.warning('%s Plugin %s timed out (%s)' % (suspect.id, str(plugin), reason))
+        suspect.debug('Plugin %s timed out (%s)' % (str(plugin), reason))
+        ptag = suspect.get_tag("processingerrors", defaultvalue=[])
+        ptag.append("Plugin %s timed out (%s)" % (str(plugin), reason))
+        suspect.set_tag("processingerrors", ptag)
+        suspect.tags.setdefault('fuglu.scan.timeouts', []).append(plugin.section)
+
+    def _deadline_expired(self, suspect, final):
+        """Tag the suspect and apply deadline_action if there's no final decision yet"""
+        suspect.tags['fuglu.scan.deadline'] = True
+        if final:
+            return
+        action = string_to_actioncode(self.config.get('performance', 'deadline_action'), self.config)
+        if action is None:
+            self.logger.error('Invalid deadline_action, using DEFER')
+            action = DEFER
+        self.logger.warning('%s Scan deadline expired, skipped: %s, action: %s' % (
+            suspect.id, ', '.join(suspect.get_tag('fuglu.scan.skipped', [])), actioncode_to_string(action)))
+        suspect.tags['decisions'].append(('deadline', action))
+        if action != DUNNO:
+            self.action = action
+            self.message = self.config.get('performance', 'deadline_message')
+            if action == DELETE:
+                self.trash(suspect, 'deadline')
+
+    def examine_plugin(self, suspect, plugin, state=None):
+        """
+        Run examine of a single scannerplugin
+
+        Args:
+            suspect (Suspect): the suspect
+            plugin (ScannerPlugin): the plugin
+            state (dict): state of a plugin running in a separate thread, nothing is stored
+                          in the suspect anymore once the plugin is abandoned
+
+        Returns:
+            (bool, int, str): success, action code and message returned by the plugin
+        """
+        try:
+            suspect.debug('Running plugin %s' % str(plugin))
+            starttime = time.time()
+            ans = plugin.examine(suspect)
+            plugintime = time.time() - starttime
+            if state is not None and state['abandoned']:
+                self.logger.debug('%s Dropping result of abandoned plugin %s' % (suspect.id, str(plugin)))
+                return False, DUNNO, None
+            suspect.tags['scantimes'].append((plugin.section, plugintime))
+            message = None
+            if type(ans) is tuple:
+                result, message = ans
+            else:
+                result = ans
+
+            if result is None:
+                result = DUNNO
+            return True, result, message
+
+        except Exception as e:
+            if state is not None and state['abandoned']:
+                # the message might have been delivered and its tempfile removed already
+                self.logger.debug('%s Abandoned plugin %s failed: %s' % (suspect.id, str(plugin), str(e)))
+                return False, DUNNO, None
+            CrashStore.store_exception()
+            exc = traceback.format_exc()
+            self.logger.error('Plugin %s failed: %s' % (str(plugin), exc))
+            suspect.debug('Plugin failed : %s . Please check fuglu log for more details' % e)
+            ptag = suspect.get_tag("processingerrors", defaultvalue=[])
+            ptag.append("Plugin %s failed: %s" % (str(plugin), str(e)))
+            suspect.set_tag("processingerrors", ptag)
+            return False, DUNNO, None
+
+    def apply_plugin_result(self, suspect, plugin, result, message):
+        """
+        Store the decision of a scannerplugin
+
+        Returns:
+            bool: True if this is a final decision and no further plugins should run
+        """
+        suspect.tags['decisions'].append((plugin.section, result))
+
+        if result == DUNNO:
+            suspect.debug('Plugin makes no final decision')
+        elif result == ACCEPT:
+            suspect.debug(
+                'Plugin accepts the message - skipping all further tests')
+            self.logger.debug(
+                'Plugin says: ACCEPT. Skipping all other tests')
+            self.action = ACCEPT
+            return True
+        elif result == DELETE:
+            suspect.debug(
+                'Plugin DELETES this message - no further tests')
+            self.logger.debug(
+                'Plugin says: DELETE. Skipping all other tests')
+            self.action = DELETE
+            self.message = message
+            self.trash(suspect, str(plugin))
+            return True
+        elif result == REJECT:
+            suspect.debug(
+                'Plugin REJECTS this message - no further tests')
+            self.logger.debug(
+                'Plugin says: REJECT. Skipping all other tests')
+            self.action = REJECT
+            self.message = message
+            return True
+        elif result == DEFER:
+            suspect.debug(
+                'Plugin DEFERS this message - no further tests')
+            self.logger.debug(
+                'Plugin says: DEFER. Skipping all other tests')
+            self.action = DEFER
+            self.message = message
+            return True
+        else:
+            self.logger.error(
+                'Invalid Message action Code: %s. Using DUNNO' % result)
+        return False
 
     def run_prependers(self, suspect):
         """Run prependers on suspect"""
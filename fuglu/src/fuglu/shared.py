@@ -17,16 +17,21 @@
 #
 import hashlib
 import logging
+import mmap
 import os
 import sys
 import time
 import socket
+import tempfile
 import uuid
 import threading
+import collections
+import contextlib
+import copy
 from collections.abc import Mapping
 from fuglu.addrcheck import Addrcheck
 from fuglu.stringencode import force_uString, force_bString
-from fuglu.mailattach import Mailattachment_mgr
+from fuglu.mailattach import Mailattachment_mgr, NoExtractInfo
 from fuglu.lib.patchedemail import PatchedMessage, PatchedMIMEMultipart
 from fuglu.funkyconsole import FunkyConsole
 from html.parser import HTMLParser
@@ -37,8 +42,11 @@ import configparser
 import datetime
 from string import Template
 from email.header import Header, decode_header
+from email.parser import Parser
 from email.utils import getaddresses
 from .mixins import DefConfigMixin
+from fuglu.caching import VerdictCache
+from fuglu.stats import Statskeeper, StatDelta
 
 HAVE_BEAUTIFULSOUP = False
 try:
@@ -194,6 +202,260 @@ def yesno(val):
         return 'no'
 
 
+HEADER_SEPARATOR = re.compile(b'(?:\n\n)|(?:\r\n\r\n)')
+"""empty line between the headers and the body of a message source"""
+
+
+class _LazyBodyAttribute(object):
+    """Attribute of a LazyMessage set by parsing the message body"""
+
+    def __set_name__(self, owner, name):
+        self.key = '_lazy_%s' % name.lstrip('_')
+
+    def __get__(self, msgrep, owner=None):
+        if msgrep is None:
+            return self
+        msgrep._load_body()
+        return msgrep.__dict__.get(self.key)
+
+    def __set__(self, msgrep, value):
+        msgrep._load_body()
+        msgrep.__dict__[self.key] = value
+
+
+class LazyMessage(PatchedMessage):
+
+    """
+    Python email representation which only parses the header block of the message.
+    Header access works without touching the body, the body and the MIME parts are
+    parsed once the payload (or preamble, epilogue, defects) is accessed, for example
+    by walk(), get_payload() or as_bytes(). Headers modified before keep the changes.
+    """
+
+    _payload = _LazyBodyAttribute()
+    preamble = _LazyBodyAttribute()
+    epilogue = _LazyBodyAttribute()
+    defects = _LazyBodyAttribute()
+
+    def __init__(self, *args, **kwargs):
+        # only parsing the same message is serialized, see _load_body
+        self._load_lock = threading.Lock()
+        PatchedMessage.__init__(self, *args, **kwargs)
+
+    @classmethod
+    def from_source(cls, source):
+        """
+        Create the representation for a message source
+
+        Args:
+            source (bytes-like): message source, not copied until the body is parsed
+
+        Returns:
+            (LazyMessage) or (PatchedMessage) if the message has no body
+        """
+        source = memoryview(source)
+        separator = HEADER_SEPARATOR.search(source)
+        if separator is None:
+            return Parser(_class=PatchedMessage).parsestr(str(source, 'ASCII', 'surrogateescape'))
+
+        headerblock = str(source[:separator.end()], 'ASCII', 'surrogateescape')
+        msgrep = Parser(_class=cls).parsestr(headerblock, headersonly=True)
+        msgrep.__dict__['_lazy_source'] = source
+        return msgrep
+
+    def _load_body(self):
+        if self.__dict__.get('_lazy_source') is None:
+            return
+        # plugins running concurrently may access the body at the same time, the
+        # source is cleared only once all body attributes are set
+        with self._load_lock:
+            source = self.__dict__.get('_lazy_source')
+            if source is None:
+                return
+            # same as email.message_from_bytes, only the body attributes are taken over
+            full = Parser(_class=PatchedMessage).parsestr(str(source, 'ASCII', 'surrogateescape'))
+            for name in ('_payload', 'preamble', 'epilogue', 'defects'):
+                self.__dict__['_lazy_%s' % name.lstrip('_')] = getattr(full, name)
+            self.__dict__['_lazy_source'] = None
+            if isinstance(source, memoryview):
+                source.release()
+
+    def detach_source(self):
+        """
+        copy the unparsed body so the message no longer references the
+        source it was created from (e.g. before the source is unmapped)
+        """
+        with self._load_lock:
+            source = self.__dict__.get('_lazy_source')
+            if isinstance(source, memoryview):
+                self.__dict__['_lazy_source'] = source.tobytes()
+                source.release()
+
+    def __getstate__(self):
+        # copy and pickle the parsed message, views of the source and locks can't be pickled
+        self._load_body()
+        state = self.__dict__.copy()
+        del state['_load_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_lock = threading.Lock()
+
+    @property
+    def body_parsed(self):
+        """True once the body has been parsed"""
+        return self.__dict__.get('_lazy_source') is None
+
+
+class MessageSpool(object):
+
+    """
+    File like object receiving the message source in a session. Messages up to
+    maxsize bytes are kept in memory, a message growing larger is written to a
+    tempfile in tempdir. Messages in memory are written to disk only when a
+    plugin requests the path of the tempfile (see Suspect.tempfile).
+    """
+
+    def __init__(self, tempdir, maxsize=0, prefix='fuglu'):
+        self.tempdir = tempdir
+        self.maxsize = maxsize
+        self.prefix = prefix
+        self.size = 0
+
+        self.filename = None
+        """path of the tempfile, None as long as the message is in memory"""
+
+        self._chunks = []
+        self._data = None
+        self._fh = None
+        self._closed = False
+        self._discarded = False
+        # plugins running concurrently may request the tempfile at the same time
+        self._lock = threading.Lock()
+        if maxsize <= 0:
+            self._rollover()
+
+    @classmethod
+    def from_config(cls, config):
+        """create a spool for main.tempdir and performance.memory_spool_maxsize"""
+        try:
+            maxsize = config.getint('performance', 'memory_spool_maxsize')
+        except Exception:
+            maxsize = 0
+        return cls(config.get('main', 'tempdir'), maxsize)
+
+    @property
+    def in_memory(self):
+        return self.filename is None
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _rollover(self):
+        handle, filename = tempfile.mkstemp(prefix=self.prefix, dir=self.tempdir)
+        fh = os.fdopen(handle, 'w+b')
+        fh.writelines(self._chunks)
+        if self._closed:
+            fh.close()
+            fh = None
+        else:
+            fh.flush()
+        self._fh = fh
+        self._chunks = []
+        self._data = None
+        # the message is on disk only once the file is complete
+        self.filename = filename
+
+    def write(self, data):
+        self.size += len(data)
+        if self._fh is not None:
+            self._fh.write(data)
+            return
+        self._chunks.append(bytes(data))
+        self._data = None
+        if self.size > self.maxsize:
+            self._rollover()
+
+    def close(self):
+        """end of message, no more data is written"""
+        self._closed = True
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def getvalue(self):
+        """returns the content of a message in memory, None if it has been written to disk"""
+        with self._lock:
+            if not self.in_memory:
+                return None
+            if self._discarded:
+                raise IOError('message has been discarded')
+            if self._data is None:
+                self._data = b"".join(self._chunks)
+                self._chunks = [self._data]
+            return self._data
+
+    def to_file(self):
+        """write a message in memory to a tempfile, returns the filename"""
+        with self._lock:
+            if self._discarded:
+                raise IOError('message has been discarded')
+            if self.in_memory:
+                self._rollover()
+            return self.filename
+
+    def discard(self):
+        """
+        drop a message in memory once it has been processed, it can't be written to
+        disk anymore. Returns False if the message is on disk, the tempfile is kept.
+        """
+        with self._lock:
+            if not self.in_memory:
+                return False
+            self._discarded = True
+            self._chunks = []
+            self._data = None
+            return True
+
+
+def _copy_container(value):
+    """shallow copy of lists, sets and dicts, other values are returned as they are"""
+    if isinstance(value, (dict, list, set)):
+        return copy.copy(value)
+    return value
+
+
+def _merge_changes(target, base, changed):
+    """
+    Apply the changes from dict base to dict changed on target. Lists are
+    extended with the items appended in changed, dicts are merged key by key.
+    """
+    for key, value in changed.items():
+        current = target.get(key)
+        if key in base:
+            old = base[key]
+            if value is old:
+                continue
+        elif key in target and isinstance(value, (dict, list)):
+            # added on target in the meantime as well
+            old = value.__class__()
+        else:
+            target[key] = value
+            continue
+        if isinstance(value, dict) and isinstance(old, dict) and isinstance(current, dict):
+            _merge_changes(current, old, value)
+        elif isinstance(value, list) and isinstance(old, list) and isinstance(current, list) \
+                and value[:len(old)] == old:
+            current.extend(value[len(old):])
+        elif value != old:
+            target[key] = value
+    for key in base:
+        if key not in changed:
+            target.pop(key, None)
+
+
 class Suspect(object):
 
     """
@@ -202,7 +464,7 @@ class Suspect(object):
     """
 
     def __init__(self,
-                 from_address: str, recipients: Union[str, List[str]], tempfile: str,
+                 from_address: str, recipients: Union[str, List[str]], tempfile: Union[str, MessageSpool],
                  att_cachelimit: Optional[int]=None, att_defaultlimit: Optional[int]=None,
                  att_maxlimit: Optional[int]=None, smtp_options: Optional[Set]=None,
                  sasl_login: Optional[str]=None, sasl_sender: Optional[str]=None,
@@ -226,11 +488,21 @@ class Suspect(object):
         self.tags['decisions'] = []
         self.tags['scantimes'] = []
 
-        # temporary file containing the message source
-        self.tempfile = tempfile
+        # temporary file containing the message source or a spool which might
+        # keep the message in memory (see tempfile property)
+        if isinstance(tempfile, MessageSpool):
+            self._spool = tempfile
+            self._tempfile = None
+            self.size = tempfile.size
+        else:
+            self._spool = None
+            self._tempfile = tempfile
+            self.size = os.path.getsize(tempfile)
+
+        # read-only memory map of the tempfile, created on first access to the original source
+        self._original_map = None
 
         # stuff set from smtp transaction
-        self.size = os.path.getsize(tempfile)
         self.from_address = force_uString(from_address)
 
         # backwards compatibility, recipients can be a single address
@@ -281,6 +553,9 @@ class Suspect(object):
         self.added_headers = {}
         """To keep track of already added headers (not in self.addheaders)"""
 
+        self._header_modified = False
+        self._body_modified = False
+
         # keep track of original sender/receivers
         self.original_from_address = self.from_address
         self.original_recipients   = self.recipients
@@ -319,6 +594,41 @@ class Suspect(object):
     def orig_recipients_changed(self):
         return self.original_recipients != self.recipients
 
+    @property
+    def tempfile(self):
+        """
+        path of the file containing the original message source. A message received
+        in memory is written to a tempfile first, use get_original_source or
+        get_original_source_view if the plugin doesn't need a file.
+        """
+        if self._spool is not None:
+            return self._spool.to_file()
+        return self._tempfile
+
+    @tempfile.setter
+    def tempfile(self, value):
+        self._spool = None
+        self._tempfile = value
+
+    @property
+    def source_in_memory(self):
+        """True if the original message source is in memory and there is no tempfile"""
+        return self._spool is not None and self._spool.in_memory
+
+    def discard_source_in_memory(self):
+        """
+        Drop the original message source if it is in memory. Plugins still running on
+        a copy of the suspect can't write it to a tempfile afterwards.
+
+        Returns:
+            (bool): False if the message has been written to the tempfile
+        """
+        if self._spool is None or not self._spool.discard():
+            return False
+        self._spool = None
+        self._tempfile = None
+        return True
+
     @property
     def att_mgr(self):
         if self._att_mgr is None:
@@ -489,7 +799,7 @@ class Suspect(object):
                 self.added_headers["subject"] = newsubj
 
             # no need to reset attachment manager because of a header change
-            self.set_message_rep(msgrep,att_mgr_reset=False)
+            self.replace_headers(msgrep)
             if self.get_tag('origsubj') is None:
                 self.set_tag('origsubj', oldsubj)
             return True
@@ -521,7 +831,7 @@ class Suspect(object):
             self.added_headers[key] = value
 
         msg[key] = value
-        self.set_message_rep(msg,att_mgr_reset=False)
+        self.replace_headers(msg)
 
     @staticmethod
     def decode_msg_header(header, decode_errors="replace"):
@@ -821,26 +1131,24 @@ class Suspect(object):
         return self.log_format("Suspect ${id}: from=${from_address} to=${to_address} size=${size} spam=${spam} blocked=${blocked} virus=${virus} modified=${modified} decision=${decision} tags=${tags}")
 
     def get_message_rep(self):
-        """returns the python email api representation of this suspect"""
+        """
+        returns the python email api representation of this suspect. Only the headers
+        are parsed until the body or the MIME parts are accessed (see LazyMessage)
+        """
         # do we have a cached instance already?
         if self._msgrep is not None:
             return self._msgrep
 
-        if self.source is not None:
-            if isinstance(self.source, str):
-                msgrep = email.message_from_string(self.source, _class=PatchedMessage)
-            else:
-                msgrep = email.message_from_bytes(self.source, _class=PatchedMessage)
-
-            self._msgrep = msgrep
-            return msgrep
+        if isinstance(self.source, str):
+            msgrep = email.message_from_string(self.source, _class=PatchedMessage)
         else:
             # IMPORTANT: It is possible to use email.message_from_file BUT this will automatically replace
             #            '\r\n' in the message (_payload) by '\n' and the endtoend_test.py will fail!
-            tmpSource = self.get_original_source()
-            msgrep = email.message_from_bytes(tmpSource, _class=PatchedMessage)
-            self._msgrep = msgrep
-            return msgrep
+            # LazyMessage decodes directly from the view of the mapped tempfile like
+            # email.message_from_bytes does, this saves a copy of the whole message
+            msgrep = LazyMessage.from_source(self.get_source_view())
+        self._msgrep = msgrep
+        return msgrep
 
     def getMessageRep(self):
         """old name for get_message_rep"""
@@ -872,9 +1180,20 @@ class Suspect(object):
         return self.set_message_rep(msgrep)
 
     def is_modified(self):
-        """returns true if the message source has been modified"""
+        """
+        returns true if the message source has been modified, see is_header_modified
+        and is_body_modified to find out which part changed
+        """
         return self.source is not None
 
+    def is_header_modified(self):
+        """returns true if the message headers have been modified"""
+        return self._header_modified
+
+    def is_body_modified(self):
+        """returns true if the message body has been modified, changing only headers keeps the body"""
+        return self._body_modified
+
     def get_source(self, maxbytes=None):
         """returns the current message source, possibly changed by plugins"""
         if self.source is not None:
@@ -882,13 +1201,28 @@ class Suspect(object):
         else:
             return self.get_original_source(maxbytes)
 
+    def get_source_view(self, maxbytes=None):
+        """
+        returns the current message source as read-only memoryview, without
+        copying the content (see get_original_source_view)
+        """
+        if self.source is not None:
+            return memoryview(force_bString(self.source))[:maxbytes]
+        else:
+            return self.get_original_source_view(maxbytes)
+
     def getSource(self, maxbytes=None):
         """old name for get_source"""
         return self.get_source(maxbytes)
 
     def set_source(self, source, encoding='utf-8', att_mgr_reset=True):
         """ Store message source. This might be modified by plugins later on...
-        
+
+        Header and body changes are tracked separately (see is_header_modified,
+        is_body_modified), added and changed headers are recorded in added_headers
+        and modified_headers. If the body and the content type remain the same the
+        attachment manager is kept.
+
         Args:
             source (bytes,str,unicode): new message source
 
@@ -896,11 +1230,77 @@ class Suspect(object):
             encoding (str): encoding, default is utf-8
             att_mgr_reset (bool): Reset the attachment manager
         """
-        self.source = force_bString(source,encoding=encoding)
+        source = force_bString(source,encoding=encoding)
+        oldsource = self.get_source_view()
+
+        oldseparator = HEADER_SEPARATOR.search(oldsource)
+        newseparator = HEADER_SEPARATOR.search(source)
+        oldbodystart = oldseparator.end() if oldseparator else len(oldsource)
+        newbodystart = newseparator.end() if newseparator else len(source)
+        oldbody = oldsource[oldbodystart:]
+
+        body_modified = len(source) - newbodystart != len(oldbody) or not source.endswith(oldbody)
+        oldheaders = oldsource[:oldbodystart].tobytes()
+        newheaders = source[:newbodystart]
+        if oldheaders != newheaders:
+            self._header_modified = True
+            content_type_changed = self._track_header_changes(oldheaders, newheaders)
+        else:
+            content_type_changed = False
+        if body_modified:
+            self._body_modified = True
+
+        self.source = source
         self._msgrep = None
-        #if att_mgr_reset:
-            #self._att_mgr = None
-        self._att_mgr = None
+        if body_modified or content_type_changed:
+            self._att_mgr = None
+
+    def replace_headers(self, msgrep):
+        """
+        Replace the headers of the message source by the headers of msgrep,
+        the body is kept byte by byte.
+
+        Args:
+            msgrep (email): python email representation with the new headers
+        """
+        source = self.get_source_view()
+        separator = HEADER_SEPARATOR.search(source)
+        if separator is None:
+            # message without body
+            self.set_message_rep(msgrep, att_mgr_reset=False)
+            return
+
+        linesep = '\r\n' if separator.group(0) == b'\r\n\r\n' else '\n'
+        policy = msgrep.policy.clone(linesep=linesep)
+        headers = b"".join(policy.fold_binary(key, value) for key, value in msgrep.raw_items())
+        self.set_source(headers + force_bString(linesep) + source[separator.end():].tobytes())
+        # the body is the same, msgrep is still valid
+        self._msgrep = msgrep
+
+    def _track_header_changes(self, oldheaders, newheaders):
+        """
+        Record added and changed headers comparing two header blocks
+
+        Returns:
+            (bool): True if the content type changed
+        """
+        def parse(headerblock):
+            msgrep = Parser(_class=PatchedMessage).parsestr(str(headerblock, 'ASCII', 'surrogateescape'),
+                                                            headersonly=True)
+            values = {}
+            for key, value in msgrep.items():
+                # compare unfolded values
+                values.setdefault(key.lower(), (key, ' '.join(force_uString(value).split())))
+            return values
+
+        oldvalues = parse(oldheaders)
+        newvalues = parse(newheaders)
+        for lowerkey, (key, value) in newvalues.items():
+            if lowerkey not in oldvalues:
+                self.added_headers[key] = value
+            elif oldvalues[lowerkey][1] != value and key not in self.added_headers:
+                self.modified_headers[key] = value
+        return oldvalues.get('content-type', (None, None))[1] != newvalues.get('content-type', (None, None))[1]
 
     def setSource(self, source):
         """old name for set_source"""
@@ -908,17 +1308,111 @@ class Suspect(object):
 
     def get_original_source(self, maxbytes=None):
         """returns the original, unmodified message source"""
-        readbytes = -1
-        if maxbytes is not None:
-            readbytes = maxbytes
-        try:
-            with open(self.tempfile, 'rb') as fh:
-                source = fh.read(readbytes)
-        except Exception as e:
-            logging.getLogger('fuglu.suspect').error(
-                'Cannot retrieve original source from tempfile %s : %s' % (self.tempfile, str(e)))
-            raise e
-        return source
+        return self.get_original_source_view(maxbytes).tobytes()
+
+    def get_original_source_view(self, maxbytes=None):
+        """
+        returns the original, unmodified message source as read-only memoryview
+
+        The tempfile is memory mapped once on first access, neither the view
+        nor limiting it with maxbytes copies the message content.
+        """
+        if self.source_in_memory:
+            content = self._spool.getvalue()
+            # None if another thread has just written the message to disk
+            if content is not None:
+                return memoryview(content)[:maxbytes]
+        if self._original_map is None:
+            try:
+                with open(self.tempfile, 'rb') as fh:
+                    if os.fstat(fh.fileno()).st_size > 0:
+                        self._original_map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        # empty files can not be mapped
+                        self._original_map = b''
+            except Exception as e:
+                logging.getLogger('fuglu.suspect').error(
+                    'Cannot retrieve original source from tempfile %s : %s' % (self.tempfile, str(e)))
+                raise e
+        return memoryview(self._original_map)[:maxbytes]
+
+    def release_original_source(self):
+        """
+        unmap the tempfile. Views which are still referenced keep the map
+        alive until they are garbage collected.
+        """
+        if isinstance(self._msgrep, LazyMessage):
+            self._msgrep.detach_source()
+        if isinstance(self._original_map, mmap.mmap):
+            try:
+                self._original_map.close()
+            except BufferError:
+                pass
+        self._original_map = None
+
+    _ISOLATED_CONTAINERS = ('addheaders', 'added_headers', 'modified_headers')
+    _MESSAGE_ATTRIBUTES = ('source', '_msgrep', '_att_mgr', '_header_modified', '_body_modified')
+
+    def isolated_copy(self, copy_message=True):
+        """
+        Copy of the suspect for a plugin running concurrently with other plugins.
+        The tags, headers and message changes of the plugin are stored in the copy,
+        merge_isolated_copy applies them to this suspect.
+
+        Args:
+            copy_message (bool): the copy parses its own message representation, so
+                                 headers changed in place don't affect this suspect
+
+        Returns:
+            (Suspect): the copy
+        """
+        isolated = copy.copy(self)
+        base = dict(self.__dict__)
+        base['tags'] = dict((key, _copy_container(value)) for key, value in self.tags.items())
+        isolated.tags = dict((key, _copy_container(value)) for key, value in self.tags.items())
+        for name in Suspect._ISOLATED_CONTAINERS:
+            base[name] = dict(getattr(self, name))
+            setattr(isolated, name, dict(getattr(self, name)))
+        base['recipients'] = list(self.recipients)
+        isolated.recipients = list(self.recipients)
+        if copy_message:
+            isolated._msgrep = None
+        isolated._isolated_base = base
+        return isolated
+
+    def merge_isolated_copy(self, isolated):
+        """
+        Apply the changes made to a copy created by isolated_copy. Tags and headers
+        changed on this suspect in the meantime are kept, appended list items and
+        changed dict keys are merged.
+
+        Args:
+            isolated (Suspect): the copy
+        """
+        base = isolated.__dict__.pop('_isolated_base')
+        _merge_changes(self.tags, base['tags'], isolated.tags)
+        for name in Suspect._ISOLATED_CONTAINERS:
+            _merge_changes(getattr(self, name), base[name], getattr(isolated, name))
+        if isolated.recipients != base['recipients']:
+            self.recipients = isolated.recipients
+
+        if isolated.source is not base['source']:
+            for name in Suspect._MESSAGE_ATTRIBUTES:
+                self.__dict__[name] = isolated.__dict__[name]
+        elif self.source is base['source']:
+            # keep what the copy has parsed already
+            if self._msgrep is None:
+                self._msgrep = isolated._msgrep
+            if self._att_mgr is None:
+                self._att_mgr = isolated._att_mgr
+
+        handled = ('tags', 'recipients', '_original_map') + Suspect._ISOLATED_CONTAINERS \
+            + Suspect._MESSAGE_ATTRIBUTES
+        for name, value in isolated.__dict__.items():
+            if name not in handled and (name not in base or value is not base[name]):
+                self.__dict__[name] = value
+        if self._original_map is None:
+            self._original_map = isolated._original_map
 
     def getOriginalSource(self, maxbytes=None):
         """old name for get_original_source"""
@@ -931,9 +1425,11 @@ class Suspect(object):
         Returns:
             (unicode str) unicode for Py2, str for Py3
         """
-        headers = re.split(
-            b'(?:\n\n)|(?:\r\n\r\n)', self.get_source(maxbytes=1048576), 1)[0]
-        return force_uString(headers)
+        source = self.get_source_view(maxbytes=1048576)
+        separator = HEADER_SEPARATOR.search(source)
+        if separator is not None:
+            source = source[:separator.start()]
+        return force_uString(source.tobytes())
 
     def get_client_info(self, config=None):
         """returns information about the client that submitted this message.
@@ -1133,6 +1629,11 @@ class BasicPlugin(DefConfigMixin):
 
     """Base class for all plugins"""
 
+    # Declaration whether the plugin uses the client connection info (suspect.clientinfo,
+    # get_client_info or client* SuspectFilter fields). None means undeclared, the milter
+    # connector only skips the connect and helo stages if no plugin uses the info.
+    uses_clientinfo = None
+
     def __init__(self, config, section=None):
         super().__init__(config)
         if section is None:
@@ -1228,6 +1729,14 @@ class ScannerPlugin(BasicPlugin):
 
     """Scanner Plugin Base Class"""
 
+    # Declaration of the data used by examine(). Plugins declaring it can run concurrently
+    # to other independent plugins (performance.plugin_concurrency). 'tag:key' refers to
+    # a single key of a dict tag like 'spam' or 'virus'. reads_tags=None means undeclared,
+    # such a plugin always runs alone.
+    reads_tags = None
+    writes_tags = ()
+    modifies_source = False
+
     def examine(self, suspect):
         self._logger().warning('Unimplemented examine() method')
 
@@ -1235,6 +1744,7 @@ class ScannerPlugin(BasicPlugin):
 class AVScannerPlugin(ScannerPlugin):
     """AV Scanner Plugin Base Class - Scanner Plugins that communicate with external AV scanners"""
     enginename = 'generic-av'
+    uses_clientinfo = False
 
     def scan_stream(self, content, suspectid='(N/A)'):
         """
@@ -1245,6 +1755,101 @@ class AVScannerPlugin(ScannerPlugin):
         """
         self._logger().warning('Unimplemented scan_stream() method')
 
+    def scan_stream_cached(self, content, suspectid='(N/A)', digest=None, scan=None):
+        """
+        Like scan_stream, but if the AV verdict cache is enabled (performance.avcache_ttl) the
+        verdict of an earlier scan of the same content by the same engine and signature version
+        is returned without contacting the scanner.
+        :param content: file content as string
+        :param suspectid: suspect.id of currently processed suspect
+        :param digest: sha256 hexdigest of content if already known
+        :param scan: function called like scan_stream to scan the content, default scan_stream
+        :return: None if no virus is found, else a dict filename -> virusname
+        """
+        if scan is None:
+            scan = self.scan_stream
+        cache = get_av_verdict_cache(self.config)
+        if cache is None:
+            return scan(content, suspectid)
+        signature = self._engine_signature()
+        if signature is None:
+            return scan(content, suspectid)
+
+        if digest is None:
+            digest = hashlib.sha256(content if isinstance(content, memoryview) else force_bString(content)).hexdigest()
+        key = "%s:%s:%s:%s" % (self.section, self.enginename, signature, digest)
+        hit, viruses = cache.get(key)
+        if hit:
+            self._logger().debug('%s verdict found in AV cache' % suspectid)
+            Statskeeper().increase_counter_values(StatDelta(avcache_hit=1))
+            return viruses
+        Statskeeper().increase_counter_values(StatDelta(avcache_miss=1))
+        viruses = scan(content, suspectid)
+        cache.put(key, viruses)
+        return viruses
+
+    def scan_attachments_cached(self, suspect, archivelevel=0):
+        """
+        Scans the decoded MIME parts of the message one by one instead of the message source. Parts
+        with the same content are scanned once, across messages if the AV verdict cache is enabled.
+        With archivelevel > 0 archives are extracted up to this level and the members are scanned,
+        an archive which can't be extracted completely is scanned as a whole.
+        :param suspect: the suspect object
+        :param archivelevel: archive extraction level, 0 to scan archives as they are
+        :return: None if no virus is found, else a dict attachment name -> virusname
+        """
+        maxsize_extract = suspect.att_mgr.get_maxsize_extract(None)
+        verdicts = {}
+        viruses = {}
+        for attachment in suspect.att_mgr.get_objectlist(level=0):
+            objects = [attachment]
+            if archivelevel > 0 and attachment.is_archive:
+                noextractinfo = NoExtractInfo()
+                members = attachment.get_objectlist(0, archivelevel, maxsize_extract, noextractinfo=noextractinfo)
+                if not noextractinfo.get_filtered(minus_filters=[u"level"]):
+                    objects = members
+
+            for obj in objects:
+                if not obj.buffer:
+                    continue
+                digest = hashlib.sha256(force_bString(obj.buffer)).hexdigest()
+                if digest not in verdicts:
+                    verdicts[digest] = self.scan_stream_cached(obj.buffer, suspect.id, digest=digest)
+                if verdicts[digest]:
+                    for name, virusname in verdicts[digest].items():
+                        viruses[obj.filename if len(verdicts[digest]) == 1 else "%s/%s" % (obj.filename, name)] = virusname
+
+        self._logger().debug('%s scanned %u distinct parts' % (suspect.id, len(verdicts)))
+        if viruses == {}:
+            return None
+        return viruses
+
+    def _engine_signature(self):
+        """
+        Signature version of the scan engine, part of the AV verdict cache key so cached
+        verdicts are not used anymore after a signature update. Override if the engine
+        can report its version.
+        :return: version string, empty if unknown (cached verdicts only expire after avcache_ttl), None to not use the cache
+        """
+        return ''
+
+
+    def _virus_tags(self):
+        """
+        Tags read/written by _skip_on_previous_virus and _virusreport, helper for
+        the declaration of reads_tags and writes_tags
+        Returns:
+            (tuple, tuple): tags read, tags written
+        """
+        reads = ()
+        try:
+            if self.config.get(self.section, 'skip_on_previous_virus').lower() != 'none':
+                reads = ('virus', )
+        except Exception:
+            pass
+        writes = ('virus:%s' % self.enginename, '%s.virus' % self.enginename,
+                  '%s.virus' % self.__class__.__name__)
+        return reads, writes
 
     def _check_too_big(self, suspect):
         """
@@ -2132,6 +2737,628 @@ def get_default_cache():
     return CacheSingleton()
 
 
+_av_verdict_cache = (None, None, None)
+_av_verdict_cache_lock = threading.Lock()
+
+
+def get_av_verdict_cache(config):
+    """
+    Process unique verdict cache shared by the AV scanner plugins, created from the
+    performance section of the config. Like the default cache, a forked process
+    creates its own instance.
+
+    Args:
+        config (configparser.ConfigParser): fuglu config
+
+    Returns:
+        fuglu.caching.VerdictCache: the cache, None if disabled (avcache_ttl = 0)
+    """
+    global _av_verdict_cache
+    try:
+        settings = (config.getint('performance', 'avcache_ttl'),
+                    config.getint('performance', 'avcache_maxsize'),
+                    config.get('performance', 'avcache_redis'),
+                    config.get('performance', 'avcache_redispw'))
+    except Exception:
+        return None
+    if settings[0] <= 0:
+        return None
+
+    pid = os.getpid()
+    with _av_verdict_cache_lock:
+        cache, cachepid, cachesettings = _av_verdict_cache
+        if cache is None or cachepid != pid or cachesettings != settings:
+            ttl, maxsize, redisconfig, redispw = settings
+            redisclient = None
+            if redisconfig:
+                from fuglu.extensions.redisext import RedisKeepAlive, ENABLED as REDIS_ENABLED
+                if not REDIS_ENABLED:
+                    logging.getLogger("%s.avcache" % __package__).error(
+                        "avcache_redis is set but redis is not installed, AV verdict cache disabled")
+                    return None
+                host, port, db = redisconfig.split(':')
+                redisclient = RedisKeepAlive(host=host, port=int(port), db=int(db), password=redispw or None,
+                                             socket_keepalive=True, socket_timeout=2)
+            cache = VerdictCache(ttl, maxsize=maxsize, redis=redisclient)
+            _av_verdict_cache = (cache, pid, settings)
+        return cache
+
+
+class BackendPoolTimeout(Exception):
+    """no connection to the backend was released within the wait timeout of the pool"""
+
+
+class BackendReplyError(Exception):
+    """the backend answered, but with an error for this request (e.g. a size limit), it is still healthy"""
+
+
+class PooledConnection(object):
+    """
+    Connection to a scanner backend handed out by a BackendPool. Protocol state which
+    has to survive until the next use of the connection (e.g. clamd session ids) can be
+    kept in the state dict.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.created = time.time()
+        self.lastused = self.created
+        self.uses = 0
+        self.state = {}
+        self.reusable = True
+
+    def discard(self):
+        """close the connection on release instead of keeping it for reuse"""
+        self.reusable = False
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+def socket_alive(sock):
+    """
+    Default health check for idle pooled connections: the backend must neither have
+    closed the connection nor have sent data nobody asked for. Doesn't block.
+    """
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        data = sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+    # b'': closed by the backend
+    return False
+
+
+class BackendPool(object):
+    """
+    Bounded pool of connections to one scanner backend (host and port or unix socket).
+
+    connect is called without arguments to open a new socket. At most maxsize
+    connections (0: no limit) are open at the same time, further callers wait up to
+    waittimeout seconds for a connection to be released. Connections released as
+    reusable are kept for maxidle seconds and checked by healthcheck(sock) before
+    they are handed out again. Protocols which can't reuse a connection release it as
+    not reusable, they are still limited and measured by the pool.
+    """
+
+    def __init__(self, name, connect, maxsize=0, maxidle=20, waittimeout=30, healthcheck=socket_alive):
+        self.name = name
+        self.connect = connect
+        self.maxsize = maxsize
+        self.maxidle = maxidle
+        self.waittimeout = waittimeout
+        self.healthcheck = healthcheck
+        self.logger = logging.getLogger("%s.backendpool" % __package__)
+        self._idle = collections.deque()
+        self._queue = collections.deque()
+        self._inuse = 0
+        self._cond = threading.Condition()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.waittime = 0.0
+        self.maxwaittime = 0.0
+
+    def _evict_idle(self):
+        """close idle connections unused for more than maxidle seconds, call with the lock held"""
+        now = time.time()
+        while self._idle and now - self._idle[0].lastused > self.maxidle:
+            self._idle.popleft().close()
+            self.evicted += 1
+
+    def _record_wait(self, waited):
+        """call with the lock held"""
+        self.waits += 1
+        self.waittime += waited
+        self.maxwaittime = max(self.maxwaittime, waited)
+
+    def get(self, reuse=False):
+        """
+        Get a connection, blocks while maxsize connections are in use.
+
+        Args:
+            reuse (bool): hand out an idle connection if available, otherwise always open a new one
+
+        Returns:
+            PooledConnection: connection to release() after use
+
+        Raises:
+            BackendPoolTimeout: no connection available after waittimeout seconds
+        """
+        start = time.time()
+        waited = False
+        conn = None
+        with self._cond:
+            # callers are served in order, otherwise a thread releasing and getting a connection
+            # in a loop could take it again before a waiting thread wakes up
+            ticket = object()
+            self._queue.append(ticket)
+            try:
+                while True:
+                    if self._queue[0] is ticket:
+                        self._evict_idle()
+                        if reuse and self._idle:
+                            conn = self._idle.pop()
+                            break
+                        if self.maxsize <= 0 or self._inuse + len(self._idle) < self.maxsize:
+                            break
+                        if self._idle:
+                            # make room for a new connection
+                            self._idle.popleft().close()
+                            self.evicted += 1
+                            continue
+                    remaining = self.waittimeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        self._record_wait(time.time() - start)
+                        raise BackendPoolTimeout("no connection to %s available after %.1fs"
+                                                 % (self.name, self.waittimeout))
+                    waited = True
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+            self._inuse += 1
+            if waited:
+                self._record_wait(time.time() - start)
+
+        if conn is not None:
+            if self.healthcheck is None or self.healthcheck(conn.sock):
+                conn.uses += 1
+                with self._cond:
+                    self.reused += 1
+                return conn
+            self.logger.debug("%s: closing idle connection which failed the health check" % self.name)
+            conn.close()
+            with self._cond:
+                self.evicted += 1
+
+        try:
+            sock = self.connect()
+        except Exception:
+            with self._cond:
+                self._inuse -= 1
+                self._cond.notify_all()
+            raise
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # scanner protocols send small requests and wait for the answer, without this
+                # the request is delayed until the previous segment is acked (delayed ack)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        conn = PooledConnection(sock)
+        conn.uses = 1
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def release(self, conn, reusable=False):
+        """
+        Return a connection to the pool. Connections not reusable or discarded are closed.
+        """
+        conn.lastused = time.time()
+        keep = reusable and conn.reusable and self.maxidle > 0
+        with self._cond:
+            self._inuse -= 1
+            if keep:
+                self._idle.append(conn)
+            self._cond.notify_all()
+        if not keep:
+            conn.close()
+
+    @contextlib.contextmanager
+    def connection(self, reuse=False):
+        """
+        Context manager around get() and release(). The connection is closed if the
+        block raises an exception, the protocol state is unknown then.
+        """
+        conn = self.get(reuse)
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, reusable=False)
+            raise
+        self.release(conn, reusable=reuse)
+
+    def clear(self):
+        """close all idle connections"""
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+
+    def stats(self):
+        """pool size and counters since the pool was created"""
+        with self._cond:
+            return dict(
+                name=self.name,
+                maxsize=self.maxsize,
+                size=self._inuse + len(self._idle),
+                inuse=self._inuse,
+                idle=len(self._idle),
+                created=self.created,
+                reused=self.reused,
+                evicted=self.evicted,
+                waits=self.waits,
+                timeouts=self.timeouts,
+                waittime=self.waittime,
+                maxwaittime=self.maxwaittime,
+            )
+
+
+_backend_pools = {}
+_backend_pools_pid = None
+_backend_pools_lock = threading.Lock()
+
+
+def get_backend_pool(config, name, connect):
+    """
+    Process unique connection pool for the backend called name (e.g. clamd:host:port),
+    shared by all plugins connecting to the same backend. The limits are read from the
+    performance section on every call, so a reload applies them to existing pools.
+
+    Args:
+        config (configparser.ConfigParser): fuglu config
+        name (str): backend name, used as pool key and in the stats
+        connect (callable): returns a new connected socket to the backend
+
+    Returns:
+        BackendPool: the pool
+    """
+    global _backend_pools, _backend_pools_pid
+    settings = {}
+    for option, default in (('maxsize', 0), ('maxidle', 20), ('waittimeout', 30)):
+        try:
+            settings[option] = config.getfloat('performance', 'backendpool_%s' % option)
+        except Exception:
+            settings[option] = default
+    settings['maxsize'] = int(settings['maxsize'])
+
+    pid = os.getpid()
+    with _backend_pools_lock:
+        if _backend_pools_pid != pid:
+            # connections of the parent process are not ours to use
+            _backend_pools = {}
+            _backend_pools_pid = pid
+        pool = _backend_pools.get(name)
+        if pool is None:
+            pool = BackendPool(name, connect, **settings)
+            _backend_pools[name] = pool
+        else:
+            pool.connect = connect
+            for option, value in settings.items():
+                setattr(pool, option, value)
+        return pool
+
+
+def get_backend_pools():
+    """backend connection pools of this process"""
+    with _backend_pools_lock:
+        if _backend_pools_pid != os.getpid():
+            return []
+        return list(_backend_pools.values())
+
+
+BACKEND_BALANCER_VARS = {
+    'backends': {
+        'default': '',
+        'description': "comma separated list of backends to balance the requests over: host[:port] ([address]:port for IPv6, without port the default port of the daemon) or the path of a unix socket, optionally followed by a weight, e.g. scan1*2, scan2. Empty: use host and port",
+    },
+    'balance': {
+        'default': 'leastconn',
+        'description': "how a backend is selected. leastconn: fewest outstanding requests relative to the weight and the average response time, roundrobin: weighted round robin",
+    },
+    'maxfails': {
+        'default': '3',
+        'description': "take a backend out of the rotation after this many consecutive errors. 0: never",
+    },
+    'ejecttime': {
+        'default': '30',
+        'description': "seconds until a backend taken out of the rotation gets a request again, it is readmitted if this request succeeds",
+    },
+}
+
+
+class Backend(object):
+    """
+    One backend of a BackendBalancer with its load and health state
+
+    Args:
+        address (str): host:port, [IPv6 address]:port, host (if defaultport is given) or path of a unix socket
+        weight (int): share of the requests relative to the other backends
+        defaultport (int): port if address doesn't contain one
+    """
+
+    def __init__(self, address, weight=1, defaultport=None):
+        self.name = address
+        self.weight = weight
+        self.path = None
+        self.host = None
+        self.port = None
+        if address.startswith('/'):
+            self.path = address
+        else:
+            host, sep, port = address.rpartition(':')
+            if not sep or (']' not in address and ':' in host):
+                # no port or IPv6 address without brackets
+                host, port = address, defaultport
+            self.host = host.strip('[]')
+            if port is None:
+                raise ValueError("no port for backend %s" % address)
+            self.port = int(port)
+        if self.weight < 1:
+            raise ValueError("weight of backend %s must be at least 1" % address)
+
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # consecutive errors
+        self.ejections = 0
+        self.ejected_until = 0
+        self.probing = False
+        self.latency = None  # moving average of the response time
+        self.current = 0  # smooth weighted round robin state
+
+    @property
+    def sockaddr(self):
+        """path of the unix socket or (host, port)"""
+        if self.path is not None:
+            return self.path
+        return self.host, self.port
+
+    def __repr__(self):
+        return "<Backend %s>" % self.name
+
+
+class BackendBalancer(object):
+    """
+    Spreads the requests of a plugin over several backends and takes backends
+    failing maxfails times in a row out of the rotation for ejecttime seconds.
+    The first request after that is a test: the backend is readmitted if it
+    succeeds, ejected again otherwise. A thread retrying after an error gets a
+    different backend if there is one.
+
+    Args:
+        name (str): balancer name for logs and stats
+        backends (list): Backend objects
+        method (str): leastconn or roundrobin
+        maxfails (int): consecutive errors until a backend is ejected, 0: never
+        ejecttime (float): seconds a backend stays ejected
+    """
+    LATENCY_ALPHA = 0.3
+
+    def __init__(self, name, backends, method='leastconn', maxfails=3, ejecttime=30):
+        if not backends:
+            raise ValueError("no backends for %s" % name)
+        self.name = name
+        self.backends = backends
+        self.method = method
+        self.maxfails = maxfails
+        self.ejecttime = ejecttime
+        self.logger = logging.getLogger("%s.backendbalancer" % __package__)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._rotation = 0
+
+    def _available(self, backend, now):
+        """call with the lock held"""
+        if not backend.ejected_until:
+            return True
+        # one test request at a time once the ejection time is over
+        return now >= backend.ejected_until and not backend.probing
+
+    def select(self):
+        """
+        Choose the backend for a request and count it as outstanding, call finish() once done
+        """
+        now = time.time()
+        failed = getattr(self._local, 'failed', ())
+        with self._lock:
+            candidates = [b for b in self.backends if self._available(b, now)]
+            if not candidates:
+                # all ejected: rather try the one coming back first than fail right away
+                candidates = [min(self.backends, key=lambda b: b.ejected_until)]
+            candidates = [b for b in candidates if b not in failed] or candidates
+
+            if self.method == 'roundrobin':
+                total = sum(b.weight for b in candidates)
+                for b in candidates:
+                    b.current += b.weight
+                backend = max(candidates, key=lambda b: b.current)
+                backend.current -= total
+            else:
+                known = [b.latency for b in candidates if b.latency is not None]
+                default = min(known) if known else 1.0
+                # rotate the start to spread requests over equal backends
+                self._rotation = (self._rotation + 1) % len(candidates)
+                candidates = candidates[self._rotation:] + candidates[:self._rotation]
+                backend = min(candidates, key=lambda b: (b.outstanding + 1)
+                              * (b.latency if b.latency is not None else default) / b.weight)
+
+            backend.outstanding += 1
+            backend.requests += 1
+            if backend.ejected_until:
+                backend.probing = True
+        return backend
+
+    def finish(self, backend, success, duration=0.0):
+        """
+        Record the result of a request to a backend returned by select()
+
+        Args:
+            backend (Backend): the backend
+            success (bool): True if the backend answered, False on errors, None if unknown (not counted)
+            duration (float): response time in seconds
+        """
+        with self._lock:
+            backend.outstanding -= 1
+            if success:
+                backend.failures = 0
+                if backend.ejected_until:
+                    self.logger.info("%s: backend %s readmitted" % (self.name, backend.name))
+                    backend.ejected_until = 0
+                if backend.latency is None:
+                    backend.latency = duration
+                else:
+                    backend.latency += self.LATENCY_ALPHA * (duration - backend.latency)
+            elif success is not None:
+                backend.errors += 1
+                backend.failures += 1
+                if backend.probing or (not backend.ejected_until and 0 < self.maxfails <= backend.failures):
+                    self.logger.warning("%s: backend %s ejected for %ss after %u consecutive errors" % (
+                        self.name, backend.name, self.ejecttime, backend.failures))
+                    backend.ejected_until = time.time() + self.ejecttime
+                    backend.ejections += 1
+            backend.probing = False
+
+        if success:
+            self._local.failed = set()
+        elif success is not None:
+            failed = getattr(self._local, 'failed', set())
+            failed.add(backend)
+            self._local.failed = failed
+
+    @contextlib.contextmanager
+    def request(self):
+        """select() and finish() around a request, exceptions except BackendReplyError count as errors"""
+        backend = self.select()
+        start = time.time()
+        try:
+            yield backend
+        except BackendPoolTimeout:
+            # our own limit, says nothing about the backend
+            self.finish(backend, None)
+            raise
+        except BackendReplyError:
+            self.finish(backend, True, time.time() - start)
+            raise
+        except BaseException:
+            self.finish(backend, False, time.time() - start)
+            raise
+        self.finish(backend, True, time.time() - start)
+
+    @contextlib.contextmanager
+    def connection(self, getpool, reuse=False):
+        """
+        request() with a connection from the pool returned by getpool(backend)
+        """
+        with self.request() as backend:
+            with getpool(backend).connection(reuse) as conn:
+                yield conn
+
+    def stats(self):
+        """load and health of the backends"""
+        now = time.time()
+        with self._lock:
+            return [dict(
+                name=b.name,
+                weight=b.weight,
+                state='probing' if b.probing else 'ejected' if b.ejected_until > now else 'up',
+                outstanding=b.outstanding,
+                requests=b.requests,
+                errors=b.errors,
+                ejections=b.ejections,
+                latency=b.latency,
+            ) for b in self.backends]
+
+
+_backend_balancers = {}
+_backend_balancers_pid = None
+_backend_balancers_lock = threading.Lock()
+
+
+def get_backend_balancer(config, section, name, defaultport=None):
+    """
+    Process unique balancer over the backends configured in a plugin section
+    (options of BACKEND_BALANCER_VARS, host and port if no backends are listed).
+    Sections listing the same backends share the balancer and its health state.
+
+    Args:
+        config (configparser.ConfigParser): fuglu config (of the plugin, with defaults)
+        section (str): plugin section
+        name (str): backend type, e.g. spamd
+        defaultport (int): port of backends listed without port
+
+    Returns:
+        BackendBalancer: the balancer
+    """
+    global _backend_balancers, _backend_balancers_pid
+    backends = config.get(section, 'backends').strip()
+    if not backends:
+        host = config.get(section, 'host')
+        port = config.get(section, 'port')
+        if not port.isdigit():
+            backends = port
+        elif ':' in host:
+            backends = '[%s]:%s' % (host, port)
+        else:
+            backends = '%s:%s' % (host, port)
+    method = config.get(section, 'balance').lower()
+    maxfails = config.getint(section, 'maxfails')
+    ejecttime = config.getfloat(section, 'ejecttime')
+    key = '%s:%s' % (name, backends)
+
+    pid = os.getpid()
+    with _backend_balancers_lock:
+        if _backend_balancers_pid != pid:
+            _backend_balancers = {}
+            _backend_balancers_pid = pid
+        balancer = _backend_balancers.get(key)
+        if balancer is None:
+            backendlist = []
+            for address in backends.split(','):
+                address, sep, weight = address.strip().partition('*')
+                backendlist.append(Backend(address.strip(), int(weight) if sep else 1, defaultport))
+            balancer = BackendBalancer(name, backendlist)
+            _backend_balancers[key] = balancer
+        balancer.method = method
+        balancer.maxfails = maxfails
+        balancer.ejecttime = ejecttime
+        return balancer
+
+
+def get_backend_balancers():
+    """backend balancers of this process"""
+    with _backend_balancers_lock:
+        if _backend_balancers_pid != os.getpid():
+            return []
+        return list(_backend_balancers.values())
+
+
 def hash_bytestr_iter(bytesiter, hasher, ashexstr=False):
     """
     Create hash using a iterator.
@@ -32,12 +32,19 @@ class StatDelta(object):
         self.in_ = 0
         self.out = 0
         self.scantime = 0
+        self.refused = 0
+        self.reinject_new = 0
+        self.reinject_reused = 0
+        self.avcache_hit = 0
+        self.avcache_miss = 0
 
         for k,v in kwargs.items():
             setattr(self,k,v)
 
     def as_message(self):
-        return dict(event_type='statsdelta', total=self.total , spam=self.spam, ham=self.ham, virus=self.virus, blocked=self.blocked, in_=self.in_ , out=self.out, scantime=self.scantime)
+        return dict(event_type='statsdelta', total=self.total , spam=self.spam, ham=self.ham, virus=self.virus, blocked=self.blocked, in_=self.in_ , out=self.out, scantime=self.scantime, refused=self.refused,
+                    reinject_new=self.reinject_new, reinject_reused=self.reinject_reused,
+                    avcache_hit=self.avcache_hit, avcache_miss=self.avcache_miss)
 
 
 class Statskeeper(object):
@@ -55,6 +62,14 @@ class Statskeeper(object):
             self.blockedcount = 0
             self.incount = 0
             self.outcount = 0
+            # connections refused by admission control
+            self.refusedcount = 0
+            # re-inject connections opened and taken from the connection pool
+            self.reinjectnewcount = 0
+            self.reinjectreusedcount = 0
+            # AV verdict cache lookups
+            self.avcachehitcount = 0
+            self.avcachemisscount = 0
             self.scantimes = []
             self.starttime = time.time()
             self.lastscan = 0
@@ -126,6 +141,11 @@ class Statskeeper(object):
         self.lastscan = time.time()
         self.incount += statdelta.in_
         self.outcount += statdelta.out
+        self.refusedcount += statdelta.refused
+        self.reinjectnewcount += statdelta.reinject_new
+        self.reinjectreusedcount += statdelta.reinject_reused
+        self.avcachehitcount += statdelta.avcache_hit
+        self.avcachemisscount += statdelta.avcache_miss
         self.fire_stats_changed_event(statdelta)
 
     def fire_stats_changed_event(self,statdelta):
@@ -152,6 +172,20 @@ class Statskeeper(object):
         avgstring = "%.4f" % avg
         return avgstring
 
+    def reinject_reuse_ratio(self):
+        """Percentage of re-injects which used a pooled connection"""
+        total = self.reinjectnewcount + self.reinjectreusedcount
+        if total == 0:
+            return "0"
+        return "%.1f" % (100.0 * self.reinjectreusedcount / total)
+
+    def avcache_hit_ratio(self):
+        """Percentage of AV scans answered by the verdict cache"""
+        total = self.avcachehitcount + self.avcachemisscount
+        if total == 0:
+            return "0"
+        return "%.1f" % (100.0 * self.avcachehitcount / total)
+
     def _appendscantime(self, scantime):
         """add new entry to the list of scantimes"""
         try:
@@ -213,6 +247,18 @@ class StatsThread(object):
             self.write_mrtg(
                 '%s/scantime' % mrtgdir, self.stats.scantime(), None, uptime, self.identifier)
 
+            # connections refused by admission control
+            self.write_mrtg(
+                '%s/refused' % mrtgdir, float(self.stats.refusedcount), None, uptime, self.identifier)
+
+            # re-inject connections, new and reused
+            self.write_mrtg('%s/reinject' % mrtgdir, float(self.stats.reinjectnewcount),
+                            float(self.stats.reinjectreusedcount), uptime, self.identifier)
+
+            # AV verdict cache hits and misses
+            self.write_mrtg('%s/avcache' % mrtgdir, float(self.stats.avcachehitcount),
+                            float(self.stats.avcachemisscount), uptime, self.identifier)
+
     def write_mrtg(self, filename, value1, value2, uptime, identifier):
         try:
             with open(filename, 'w') as fp:
@@ -21,13 +21,29 @@ import queue
 import logging
 import weakref
 import importlib
+import collections
 from fuglu.protocolbase import compress_task, uncompress_task
 from fuglu.scansession import SessionHandler
 
 
 class ThreadPool(threading.Thread):
 
-    def __init__(self, controller, minthreads=1, maxthreads=20, queuesize=100, freeworkers=0):
+    def __init__(self, controller, minthreads=1, maxthreads=20, queuesize=100, freeworkers=0,
+                 target_latency=0.0, min_busy_ratio=0.5):
+        """
+        Pool of scanner threads.
+
+        Keyword Args:
+            minthreads (int): minimum number of threads
+            maxthreads (int): maximum number of threads
+            queuesize (int): maximum number of tasks waiting for a thread
+            freeworkers (int): minimum number of idle threads
+            target_latency (float): target for the time a task waits in the queue (seconds). If > 0 the pool
+                                    reacts immediately to tasks waiting without idle thread, otherwise the
+                                    pool size is checked every checkinterval seconds.
+            min_busy_ratio (float): with target_latency, idle threads are removed if the averaged ratio of
+                                    busy threads is below this value
+        """
         self.workers = []
         self.queuesize = queuesize
         self.tasks = queue.Queue(queuesize)
@@ -35,7 +51,7 @@ class ThreadPool(threading.Thread):
         self.maxthreads = maxthreads
         self.freeworkers = freeworkers
         assert self.minthreads > 0
-        assert self.maxthreads > self.minthreads
+        assert self.maxthreads >= self.minthreads
 
         self.logger = logging.getLogger('%s.threadpool' % __package__)
         self.threadlistlock = threading.Lock()
@@ -44,6 +60,21 @@ class ThreadPool(threading.Thread):
         self._stayalive = True
         self.laststats = 0
         self.statinverval = 60
+
+        # latency driven scaling
+        self.target_latency = target_latency
+        self.min_busy_ratio = min_busy_ratio
+        self.autoscale_interval = 1.0
+        self.ewma_alpha = 0.2
+        self.queue_wait_ewma = 0.0
+        self.lastdequeue = time.time()
+        self.busy_ratio_ewma = 0.0
+        self.lastscaledown = 0
+        self.decisions = collections.deque(maxlen=50)
+        self._wakeup = threading.Event()
+        # notified whenever a thread takes a task from the queue, see wait_for_room
+        self._dequeued = threading.Condition()
+
         self.controller = weakref.ref(controller)  # keep a weak reference to controller
         threading.Thread.__init__(self)
         self.name = 'Threadpool'
@@ -60,6 +91,7 @@ class ThreadPool(threading.Thread):
         if self._stayalive and not value:
             self._stayalive = False
             self._send_poison_pills()
+            self._wakeup.set()
         self._stayalive = value
 
     def _send_poison_pills(self):
@@ -69,7 +101,56 @@ class ThreadPool(threading.Thread):
 
     def add_task(self, session):
         if self._stayalive:
-            self.tasks.put(session)
+            # store time to measure how long the task waits for a thread
+            self.tasks.put((time.time(), session))
+            if self.target_latency > 0 and not self._idle_workers():
+                self._wakeup.set()
+
+    def queue_depth(self):
+        """number of tasks waiting for a thread"""
+        return self.tasks.qsize()
+
+    def wait_for_room(self, maxtasks, timeout=None):
+        """
+        Block until less than maxtasks tasks are waiting for a thread
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        with self._dequeued:
+            return self._dequeued.wait_for(lambda: self.tasks.qsize() < maxtasks, timeout)
+
+    def estimated_wait(self):
+        """estimated time a new task will wait for a thread (seconds)"""
+        if self.tasks.qsize() == 0 and self._idle_workers():
+            # the next task is picked up right away
+            return 0.0
+        return max(self.queue_wait_average(), self._oldest_task_wait())
+
+    def _idle_workers(self):
+        return [worker for worker in self.workers[:] if worker.workerstate == 'waiting for task']
+
+    def _ewma(self, average, value):
+        return self.ewma_alpha * value + (1.0 - self.ewma_alpha) * average
+
+    def queue_wait_average(self):
+        """
+        Averaged queue wait time. The average is only updated when a task is taken from
+        the queue, every autoscale_interval without any counts as a task which didn't
+        wait so the value of the last burst decays once the pool goes quiet.
+        """
+        quiet = time.time() - self.lastdequeue
+        if quiet <= self.autoscale_interval:
+            return self.queue_wait_ewma
+        return self.queue_wait_ewma * (1.0 - self.ewma_alpha) ** (quiet / self.autoscale_interval)
+
+    def _oldest_task_wait(self):
+        """time the oldest task in the queue is waiting already"""
+        with self.tasks.mutex:
+            for item in self.tasks.queue:
+                if item is not None:
+                    return time.time() - item[0]
+        return 0.0
 
     def add_task_from_socket(self, sock, handler_modulename, handler_classname, port):
         """
@@ -104,10 +185,18 @@ class ThreadPool(threading.Thread):
             except queue.Empty:
                 task = None
 
+            with self._dequeued:
+                self._dequeued.notify_all()
+
             if task is None:
                 # Poison pill or empty queue
                 return None
 
+            enqueued, task = task
+            now = time.time()
+            self.queue_wait_ewma = self._ewma(self.queue_wait_average(), now - enqueued)
+            self.lastdequeue = now
+
             sock, handler_modulename, handler_classname, port = uncompress_task(task)
             handler_class = getattr(importlib.import_module(handler_modulename), handler_classname)
 
@@ -124,8 +213,9 @@ class ThreadPool(threading.Thread):
             return None
 
     def run(self):
-        self.logger.debug('Threadpool initializing. minthreads=%s maxthreads=%s maxqueue=%s checkinterval=%s' % (
-            self.minthreads, self.maxthreads, self.queuesize, self.checkinterval))
+        self.logger.debug('Threadpool initializing. minthreads=%s maxthreads=%s maxqueue=%s checkinterval=%s '
+                          'target_latency=%s' % (self.minthreads, self.maxthreads, self.queuesize,
+                                                 self.checkinterval, self.target_latency))
 
         while self._stayalive:
             curthreads = self.workers
@@ -153,7 +243,12 @@ class ThreadPool(threading.Thread):
             # increase
             workload = float(queuesize) / float(numthreads)
 
-            if numthreads < self.maxthreads:
+            idle_workers = self._idle_workers()
+            self.busy_ratio_ewma = self._ewma(self.busy_ratio_ewma, 1.0 - float(len(idle_workers)) / numthreads)
+
+            if self.target_latency > 0:
+                changed = self._autoscale(numthreads, queuesize, idle_workers)
+            elif numthreads < self.maxthreads:
                 if workload > 1.0:
                     self._add_worker()
                     numthreads += 1
@@ -170,7 +265,7 @@ class ThreadPool(threading.Thread):
                         self.logger.debug("not adding worker because free workers already above threshold %u..."
                                           "(current idle workers: %u)" % (self.freeworkers, len(idle_workers)))
 
-            if workload < 1.0 and numthreads > self.minthreads:
+            if self.target_latency <= 0 and workload < 1.0 and numthreads > self.minthreads:
                 # remove idle workers if possible
                 idle_workers = [worker for worker in self.workers if worker.workerstate == 'waiting for task']
                 if len(idle_workers) > self.freeworkers:
@@ -188,10 +283,55 @@ class ThreadPool(threading.Thread):
                     queuesize, workload, numthreads, workerlist))
                 self.laststats = time.time()
 
-            time.sleep(self.checkinterval)
+            # wake up immediately on shutdown or if tasks are waiting without idle worker
+            self._wakeup.wait(self.autoscale_interval if self.target_latency > 0 else self.checkinterval)
+            self._wakeup.clear()
 
         self.logger.info('Threadpool shut down')
 
+    def _autoscale(self, numthreads, queuesize, idle_workers):
+        """
+        Adapt the number of workers based on the time tasks wait in the queue and the
+        averaged ratio of busy workers.
+
+        Returns:
+            bool: True if the number of workers changed
+        """
+        queue_wait = self.queue_wait_average()
+        latency = max(queue_wait, self._oldest_task_wait())
+        waiting = queuesize - len(idle_workers)
+
+        if waiting > 0 and numthreads < self.maxthreads:
+            if latency > self.target_latency:
+                # target missed, add a thread for every waiting task
+                num = min(waiting, self.maxthreads - numthreads)
+                reason = 'queue wait %.3fs > target %.3fs' % (latency, self.target_latency)
+            else:
+                num = 1
+                reason = '%u tasks waiting without idle worker' % waiting
+            self._add_worker(num)
+            self._record_decision('add', num, reason, numthreads + num, queuesize)
+            return True
+
+        now = time.time()
+        if (numthreads > self.minthreads and len(idle_workers) > self.freeworkers
+                and self.busy_ratio_ewma < self.min_busy_ratio
+                and queue_wait < self.target_latency / 2.0
+                and now - self.lastscaledown > self.checkinterval):
+            # remove one idle worker per checkinterval to avoid oscillating
+            self.lastscaledown = now
+            self._remove_worker(elements=[idle_workers[-1]])
+            self._record_decision('remove', 1, 'busy ratio %.2f < %.2f' % (self.busy_ratio_ewma, self.min_busy_ratio),
+                                  numthreads - 1, queuesize)
+            return True
+        return False
+
+    def _record_decision(self, action, num, reason, numthreads, queuesize):
+        decision = dict(time=time.time(), action=action, num=num, reason=reason, threads=numthreads,
+                        queuesize=queuesize, queue_wait=self.queue_wait_average(), busy_ratio=self.busy_ratio_ewma)
+        self.decisions.append(decision)
+        self.logger.debug('%s %u worker(s): %s' % (action, num, reason))
+
     def _remove_worker(self, num=1, elements=[]):
         self.logger.debug('Removing %s workerthread(s)' % num)
 
@@ -214,8 +354,8 @@ class ThreadPool(threading.Thread):
         for bla in range(0, num):
             self.threadcounter += 1
             worker = Worker("[%s]" % self.threadcounter, self)
-            self.workers.append(worker)
             worker.start()
+            self.workers.append(worker)
 
     def shutdown(self, newmanager=None):
         """
@@ -243,6 +383,7 @@ class ThreadPool(threading.Thread):
                 task = self.tasks.get(True)
                 if task is None:  # poison pill
                     break
+                enqueued, task = task
                 newmanager.add_task(task)
                 countmessages += 1
             self.logger.info("Moved %u messages to queue of new manager" % countmessages)
@@ -252,11 +393,16 @@ class ThreadPool(threading.Thread):
             while True:
                 # don't use the get_task_sessionhandler from Threadpool since this will
                 # not give anything once stayalive is False
-                sesshandler = self.tasks.get(True)
-                if sesshandler is None:  # poison pill -> shut down
+                task = self.tasks.get(True)
+                if task is None:  # poison pill -> shut down
                     break
                 mark_defer_counter += 1
-                sesshandler.protohandler.defer(return_message)
+                enqueued, task = task
+                sock, handler_modulename, handler_classname, port = uncompress_task(task)
+                handler_class = getattr(importlib.import_module(handler_modulename), handler_classname)
+                controller = self.controller()
+                if controller is not None:
+                    handler_class(sock, controller.config).defer(return_message)
 
             self.logger.info("Marked %s messages as '%s' to close queue" % (mark_defer_counter,return_message))
 
@@ -286,7 +432,8 @@ class Worker(threading.Thread):
     def run(self):
         self.logger.debug('thread start')
 
-        while self.stayalive:
+        # workers added while the pool is shutting down would not get a poison pill
+        while self.stayalive and self.pool.stayalive:
             self.workerstate = 'waiting for task'
             if self.noisy:
                 self.logger.debug('Getting new task...')
@@ -85,6 +85,78 @@ class ReloadTest(unittest.TestCase):
         mc.shutdown()
 
 
+    def test_hybrid_backend_reload(self):
+        """Test reload switching between thread and hybrid backend"""
+
+        config = RawConfigParser()
+        config.add_section('performance')
+        config.set('performance', 'minthreads', 2)
+        config.set('performance', 'maxthreads', 40)
+        config.set('performance', 'backend', 'hybrid')
+        config.set('performance', 'initialprocs', 2)
+        config.set('performance', 'hybrid_minthreads', 2)
+        config.set('performance', 'hybrid_maxthreads', 5)
+        config.set('performance', 'join_timeout', 2.0)
+
+        mc = MainController(config)
+        mc.propagate_core_defaults()
+
+        mc.threadpool = mc._start_threadpool()
+        time.sleep(0.1)
+        self.assertIsNone(mc.procpool)
+        self.assertIsNotNone(mc.threadpool)
+
+        # now reload will replace the threadpool by a procpool running threads
+        mc.reload()
+        time.sleep(0.1)
+        self.assertIsNone(mc.threadpool)
+        self.assertIsNotNone(mc.procpool)
+        self.assertEqual(2, len(mc.procpool.workers))
+        self.assertEqual(5, mc.procpool.maxthreads)
+
+        config.set('performance', 'backend', 'thread')
+        mc.reload()
+        time.sleep(0.1)
+        self.assertIsNone(mc.procpool)
+        self.assertIsNotNone(mc.threadpool)
+        mc.shutdown()
+
+
+    def test_rolling_reload(self):
+        """Test replacing the worker processes of the running procpool on reload"""
+
+        config = RawConfigParser()
+        config.add_section('performance')
+        config.set('performance', 'backend', 'process')
+        config.set('performance', 'initialprocs', 3)
+        config.set('performance', 'reload_batchsize', 2)
+        config.set('performance', 'join_timeout', 2.0)
+
+        mc = MainController(config)
+        mc.propagate_core_defaults()
+
+        mc.procpool = mc._start_processpool()
+        procpool = mc.procpool
+        oldworkers = procpool.workers[:]
+        mc.reload()
+        timeout = time.time() + 20.0
+        while not (procpool.reload_status or '').startswith('complete') and time.time() < timeout:
+            time.sleep(0.1)
+
+        self.assertTrue(procpool is mc.procpool)
+        self.assertEqual(3, len(procpool.workers))
+        for worker in oldworkers:
+            self.assertNotIn(worker, procpool.workers)
+            self.assertFalse(worker.is_alive())
+
+        # a different number of processes requires a new pool
+        config.set('performance', 'initialprocs', 2)
+        mc.reload()
+        self.assertFalse(procpool is mc.procpool)
+        self.assertEqual(2, len(mc.procpool.workers))
+        mc.shutdown()
+
+
 class MultipleMCsTest(unittest.TestCase):
     """
     Even if there are multiple MainControllers they should not cause crashes as long as they
@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+from unittestsetup import TESTDATADIR
+import unittest
+import socket
+import tempfile
+import shutil
+import time
+from configparser import RawConfigParser
+from fuglu.core import MainController
+from fuglu.asyncpool import AsyncioPool, AsyncSessionState
+
+
+class AsyncioPoolTest(unittest.TestCase):
+    """Test receiving and scanning messages with the asyncio backend"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fuglu-asyncpool-test')
+        config = RawConfigParser()
+        config.add_section("main")
+        config.set('main', 'plugins', '')
+        config.set('main', 'prependers', '')
+        config.set('main', 'appenders', '')
+        config.set('main', 'tempdir', self.tempdir)
+        config.add_section("performance")
+        config.set('performance', 'backend', 'asyncio')
+        config.set('performance', 'maxthreads', 2)
+
+        self.mc = MainController(config)
+        self.mc.propagate_core_defaults()
+        self.mc.load_plugins()
+        self.pool = AsyncioPool(self.mc, maxthreads=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.tempdir)
+
+    def _send_nc_message(self, message):
+        client, server = socket.socketpair()
+        client.settimeout(10)
+        self.pool.add_task_from_socket(server, 'fuglu.connectors.ncconnector', 'NCHandler', 0)
+        client.recv(1024)  # banner
+        client.sendall(message)
+        client.shutdown(socket.SHUT_WR)
+
+        answer = []
+        while True:
+            data = client.recv(1024)
+            if not data:
+                break
+            answer.append(data)
+        client.close()
+        return b"".join(answer)
+
+    def test_nc_sessions(self):
+        """Messages received in the event loop are scanned and answered"""
+        message = b"Subject: asyncio test\r\n\r\nhello\r\n"
+        for _ in range(3):
+            answer = self._send_nc_message(message)
+            self.assertTrue(answer.startswith(b"DUNNO:"), answer)
+            self.assertIn(b"Subject: asyncio test", answer)
+        self.assertEqual(3, self.pool.sessioncounter)
+
+    def test_shutdown(self):
+        """The event loop thread ends on shutdown"""
+        self.pool.shutdown()
+        self.assertFalse(self.pool.is_alive())
+
+    def test_refused_after_shutdown(self):
+        """Connections added while shutting down are closed"""
+        self.pool.shutdown()
+        client, server = socket.socketpair()
+        client.settimeout(10)
+        self.pool.add_task_from_socket(server, 'fuglu.connectors.ncconnector', 'NCHandler', 0)
+        self.assertEqual(-1, server.fileno())
+        self.assertEqual(b"", client.recv(1024))
+        client.close()
+
+    def test_estimated_wait(self):
+        """The wait is estimated from messages waiting for a scanner thread"""
+        self.assertEqual(0.0, self.pool.estimated_wait())
+        state = AsyncSessionState('[test]', 0)
+        state.waiting_since = time.time() - 2
+        self.pool.workers.append(state)
+        try:
+            self.assertEqual(1, self.pool.queue_depth())
+            self.assertGreaterEqual(self.pool.estimated_wait(), 2)
+        finally:
+            self.pool.workers.remove(state)
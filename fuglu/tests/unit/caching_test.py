@@ -1,7 +1,8 @@
 # -*- coding: UTF-8 -*-
 import unittestsetup # has to be here because this is the first test and it modifys the pythonpath
 import unittest
-from fuglu.caching import smart_cached_memberfunc, smart_cached_property, Cachelimits, Cachestats
+from fuglu.caching import smart_cached_memberfunc, smart_cached_property, Cachelimits, Cachestats, VerdictCache
+import time
 
 class CachingTests(unittest.TestCase):
     def test_cachedProperty(self):
@@ -299,3 +300,29 @@ class CachingTests(unittest.TestCase):
 
         # print cache stats on screen
         print(c.string_cachestats())
+
+
+class VerdictCacheTests(unittest.TestCase):
+    def test_verdicts(self):
+        """Clean verdicts (None) are cached too"""
+        cache = VerdictCache(60)
+        self.assertEqual((False, None), cache.get('a'))
+        cache.put('a', None)
+        cache.put('b', {'stream': 'Eicar-Test-Signature'})
+        self.assertEqual((True, None), cache.get('a'))
+        self.assertEqual((True, {'stream': 'Eicar-Test-Signature'}), cache.get('b'))
+
+    def test_limits(self):
+        """Expired and least recently used verdicts are dropped"""
+        cache = VerdictCache(60, maxsize=2)
+        cache.put('a', None)
+        cache.put('b', None)
+        cache.get('a')
+        cache.put('c', None)
+        self.assertEqual(2, len(cache))
+        self.assertFalse(cache.get('b')[0])
+        self.assertTrue(cache.get('a')[0])
+
+        cache.ttl = -1
+        cache.put('d', None)
+        self.assertFalse(cache.get('d')[0])
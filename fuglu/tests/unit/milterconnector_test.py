@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+import unittestsetup
+import unittest
+import socket
+from configparser import RawConfigParser
+from fuglu.connectors.milterconnector import MilterHandler, LIMBMILTER_AVAILABLE
+
+
+class DeclaredPlugin(object):
+    def __init__(self, uses_clientinfo):
+        self.uses_clientinfo = uses_clientinfo
+
+
+class UndeclaredPlugin(object):
+    pass
+
+
+@unittest.skipUnless(LIMBMILTER_AVAILABLE, "libmilter not installed")
+class MilterNegotiationTest(unittest.TestCase):
+    """Test the milter stages requested depending on the plugins"""
+
+    def setUp(self):
+        import libmilter as lm
+        self.lm = lm
+        self.sock, self.mta = socket.socketpair()
+        self.handler = MilterHandler(self.sock, RawConfigParser())
+        self.skipped = lm.SMFIP_NOCONNECT | lm.SMFIP_NOHELO
+
+    def tearDown(self):
+        self.sock.close()
+        self.mta.close()
+
+    def test_no_reply(self):
+        """The MTA doesn't wait for a reply to DATA"""
+        self.assertTrue(self.handler.sess.protos & self.lm.SMFIP_NR_DATA)
+
+    def test_skip_connect(self):
+        """Connect and helo are skipped if no plugin uses the client info"""
+        self.handler.set_plugins([DeclaredPlugin(False), DeclaredPlugin(False)])
+        self.assertEqual(self.skipped, self.handler.sess.protos & self.skipped)
+
+    def test_keep_connect(self):
+        """Connect and helo are kept for plugins using or not declaring the client info"""
+        self.handler.set_plugins([DeclaredPlugin(False), DeclaredPlugin(True)])
+        self.assertEqual(0, self.handler.sess.protos & self.skipped)
+        self.handler.set_plugins([DeclaredPlugin(False), UndeclaredPlugin()])
+        self.assertEqual(0, self.handler.sess.protos & self.skipped)
+
+    def test_negotiated(self):
+        """Stages can't be changed once the options are negotiated"""
+        self.handler.sess._mtaVersion = 6
+        self.handler.set_plugins([])
+        self.assertEqual(0, self.handler.sess.protos & self.skipped)
@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+import unittestsetup
+import unittest
+import os
+import socket
+import struct
+import array
+import tempfile
+import threading
+from configparser import RawConfigParser
+from fuglu.shared import Suspect
+from fuglu.plugins import clamav
+from fuglu.plugins.clamav import ClamavPlugin
+
+
+class FakeClamd(threading.Thread):
+    """clamd stand-in on a unix socket answering INSTREAM, FILDES and SCAN for one connection, optionally in an IDSESSION"""
+
+    def __init__(self, sock, commands):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+        self.commands = commands
+
+    def recvall(self, count):
+        data = b''
+        while len(data) < count:
+            data += self.sock.recv(count - len(data))
+        return data
+
+    def verdict(self, name, content):
+        if b'EICAR' in content:
+            return name + b': Eicar-Test-Signature FOUND\0'
+        return name + b': OK\0'
+
+    def command(self):
+        command = b''
+        while not command.endswith(b'\0'):
+            data = self.sock.recv(1)
+            if not data:
+                return None
+            command += data
+        return command
+
+    def reply(self, command):
+        if command == b'zINSTREAM\0':
+            content = b''
+            while True:
+                size = struct.unpack('!L', self.recvall(4))[0]
+                if not size:
+                    break
+                content += self.recvall(size)
+            if b'TOOBIG' in content:
+                return b'INSTREAM size limit exceeded. ERROR\0'
+            return self.verdict(b'stream', content)
+        elif command == b'zFILDES\0':
+            fds = array.array('i')
+            msg, ancdata, flags, addr = self.sock.recvmsg(1, socket.CMSG_LEN(fds.itemsize))
+            fds.frombytes(ancdata[0][2])
+            with os.fdopen(fds[0], 'rb') as fh:
+                return self.verdict(b'fd[10]', fh.read())
+        elif command.startswith(b'zSCAN /'):
+            path = command[6:-1]
+            if b'denied' in path:
+                return path + b': lstat() failed: Permission denied. ERROR\0'
+            with open(path, 'rb') as fh:
+                return self.verdict(path, fh.read())
+
+    def run(self):
+        # session id of the next reply in an IDSESSION, 0 without session
+        session = 0
+        while True:
+            command = self.command()
+            if command is None or command == b'zEND\0':
+                break
+            self.commands.append(command.rstrip(b'\0').split()[0])
+            if command == b'zIDSESSION\0':
+                session = 1
+                continue
+            reply = self.reply(command)
+            if not session:
+                self.sock.sendall(reply)
+                break
+            self.sock.sendall(b'%d: ' % session + reply)
+            session += 1
+        self.sock.close()
+
+
+class ClamavScanmethodTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fuglu-unittest')
+        self.socketpath = os.path.join(self.tempdir, 'clamd.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socketpath)
+        self.server.listen(5)
+        self.commands = []
+        self.connections = 0
+        threading.Thread(target=self.serve, daemon=True).start()
+
+        config = RawConfigParser()
+        config.add_section('virus')
+        config.set('virus', 'defaultvirusaction', 'DELETE')
+        config.add_section('ClamavPlugin')
+        config.set('ClamavPlugin', 'port', self.socketpath)
+        config.set('ClamavPlugin', 'maxsize', '10000000')
+        config.set('ClamavPlugin', 'retries', '1')
+        self.config = config
+        self.plugin = ClamavPlugin(config)
+
+    def tearDown(self):
+        self.server.close()
+        for filename in os.listdir(self.tempdir):
+            os.remove(os.path.join(self.tempdir, filename))
+        os.rmdir(self.tempdir)
+
+    def serve(self):
+        while True:
+            try:
+                sock = self.server.accept()[0]
+            except OSError:
+                return
+            self.connections += 1
+            FakeClamd(sock, self.commands).start()
+
+    def _suspect(self, source, name='message'):
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, 'wb') as fh:
+            fh.write(source)
+        return Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', filename)
+
+    def test_scanmethods(self):
+        """Messages on disk are scanned by file descriptor or path"""
+        for scanmethod in ('FILDES', 'SCAN', 'INSTREAM'):
+            self.config.set('ClamavPlugin', 'scanmethod', scanmethod)
+            self.commands[:] = []
+            suspect = self._suspect(b'Subject: test\r\n\r\nEICAR\r\n')
+            self.plugin.examine(suspect)
+            self.assertEqual([b'z' + scanmethod.encode()], self.commands)
+            self.assertEqual(1, len(suspect.get_tag('ClamAV.virus')))
+            suspect = self._suspect(b'Subject: test\r\n\r\nclean\r\n')
+            self.plugin.examine(suspect)
+            self.assertFalse(suspect.is_virus())
+
+    def test_fallback(self):
+        """INSTREAM is used for modified messages and if clamd can't scan the file"""
+        self.config.set('ClamavPlugin', 'scanmethod', 'SCAN')
+        suspect = self._suspect(b'Subject: test\r\n\r\nEICAR\r\n', name='denied')
+        self.plugin.examine(suspect)
+        self.assertEqual([b'zSCAN', b'zINSTREAM'], self.commands)
+        self.assertTrue(suspect.is_virus())
+
+        self.commands[:] = []
+        suspect = self._suspect(b'Subject: test\r\n\r\nclean\r\n')
+        suspect.set_source(b'Subject: test\r\n\r\nEICAR\r\n')
+        self.plugin.examine(suspect)
+        self.assertEqual([b'zINSTREAM'], self.commands)
+        self.assertTrue(suspect.is_virus())
+
+    def test_pipelining(self):
+        """With pipelining the scans are sent over a pooled IDSESSION connection"""
+        self.config.set('ClamavPlugin', 'pipelining', 'True')
+        for source in (b'clean', b'EICAR', b'clean'):
+            suspect = self._suspect(b'Subject: test\r\n\r\n%s\r\n' % source)
+            self.plugin.examine(suspect)
+            self.assertEqual(source == b'EICAR', suspect.is_virus())
+        self.assertEqual(1, self.connections)
+        self.assertEqual([b'zIDSESSION', b'zINSTREAM', b'zINSTREAM', b'zINSTREAM'], self.commands)
+
+        # the session is ended after MAX_SCANS_PER_SOCKET scans
+        maxscans = clamav.MAX_SCANS_PER_SOCKET
+        clamav.MAX_SCANS_PER_SOCKET = 4
+        self.addCleanup(setattr, clamav, 'MAX_SCANS_PER_SOCKET', maxscans)
+        for _ in range(2):
+            self.plugin.examine(self._suspect(b'Subject: test\r\n\r\nclean\r\n'))
+        self.assertEqual(2, self.connections)
+
+    def test_failover(self):
+        """Messages are scanned by the remaining clamd if one is down, which is ejected"""
+        down = os.path.join(self.tempdir, 'down.sock')
+        self.config.set('ClamavPlugin', 'backends', '%s, %s' % (down, self.socketpath))
+        self.config.set('ClamavPlugin', 'retries', '2')
+        for _ in range(10):
+            suspect = self._suspect(b'Subject: test\r\n\r\nEICAR\r\n')
+            self.plugin.examine(suspect)
+            self.assertTrue(suspect.is_virus())
+        stats = dict((backend['name'], backend) for backend in self.plugin._balancer().stats())
+        self.assertEqual(3, stats[down]['errors'])
+        self.assertEqual('ejected', stats[down]['state'])
+        self.assertEqual(10, stats[self.socketpath]['requests'])
+
+    def test_reply_error(self):
+        """Errors answered by clamd don't take it out of the rotation"""
+        for _ in range(5):
+            suspect = self._suspect(b'Subject: test\r\n\r\nTOOBIG\r\n')
+            self.plugin.examine(suspect)
+            self.assertFalse(suspect.is_virus())
+        stats = self.plugin._balancer().stats()[0]
+        self.assertEqual((5, 0, 'up'), (stats['requests'], stats['errors'], stats['state']))
@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+from unittestsetup import TESTDATADIR
+import unittest
+import socket
+from configparser import RawConfigParser
+from unittest.mock import patch
+from fuglu.core import MainController
+from fuglu.procpool import WorkerRecycler, current_rss
+from fuglu.protocolbase import BasicTCPServer
+from fuglu.connectors.ncconnector import NCHandler
+from fuglu.stats import Statskeeper, StatDelta
+
+
+class WorkerRecyclerTest(unittest.TestCase):
+    """Test the limits for recycling worker processes"""
+
+    def setUp(self):
+        self.config = RawConfigParser()
+        self.config.add_section('performance')
+        self.config.set('performance', 'max_messages_per_worker', '0')
+        self.config.set('performance', 'max_rss_per_worker', '0')
+
+    def test_disabled(self):
+        """No limits configured"""
+        recycler = WorkerRecycler(self.config)
+        Statskeeper().increase_counter_values(StatDelta(total=10))
+        self.assertIsNone(recycler.reason())
+
+    def test_max_messages(self):
+        """Messages processed before the worker was created are not counted"""
+        Statskeeper().increase_counter_values(StatDelta(total=5))
+        self.config.set('performance', 'max_messages_per_worker', '3')
+        recycler = WorkerRecycler(self.config)
+        Statskeeper().increase_counter_values(StatDelta(total=2))
+        self.assertIsNone(recycler.reason())
+        Statskeeper().increase_counter_values(StatDelta(total=1))
+        self.assertIsNotNone(recycler.reason())
+
+    def test_max_rss(self):
+        """Limit below the current memory usage"""
+        self.assertTrue(current_rss() > 1024 * 1024)
+        self.config.set('performance', 'max_rss_per_worker', '1')
+        recycler = WorkerRecycler(self.config)
+        self.assertIsNotNone(recycler.reason())
+
+
+class ListenerDrainTest(unittest.TestCase):
+    """Test handing over the connections of a worker's listener before it's closed"""
+
+    def setUp(self):
+        config = RawConfigParser()
+        config.add_section('main')
+        config.set('main', 'plugins', '')
+        config.set('main', 'prependers', '')
+        config.set('main', 'appenders', '')
+        self.mc = MainController(config)
+        self.mc.propagate_core_defaults()
+        self.mc.reuseport = True
+        self.server = BasicTCPServer(self.mc, port=0, address='127.0.0.1', protohandlerclass=NCHandler)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def test_drain(self):
+        """Connections waiting in the accept queue are handled, not reset"""
+        port = self.server._socket.getsockname()[1]
+        for _ in range(3):
+            self.clients.append(socket.create_connection(('127.0.0.1', port)))
+
+        handled = []
+        with patch.object(self.server, 'handle_connection', handled.append):
+            self.server.drain()
+        self.assertEqual(3, len(handled))
+        for sock in handled:
+            sock.close()
+        self.assertFalse(self.server.stayalive)
+        self.assertRaises(OSError, socket.create_connection, ('127.0.0.1', port))
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from unittestsetup import TESTDATADIR
 import unittest
+import time
 from configparser import RawConfigParser
-from fuglu.shared import Suspect, ScannerPlugin, PrependerPlugin, AppenderPlugin, DUNNO
+from fuglu.shared import Suspect, ScannerPlugin, PrependerPlugin, AppenderPlugin, DUNNO, REJECT, DEFER
 from fuglu.core import MainController
 from fuglu.scansession import SessionHandler
 
@@ -148,3 +149,196 @@ class ProcessingErrorsTagTest(unittest.TestCase):
 
         ptags = suspect.get_tag("processingerrors")
         self.assertEqual(['Appender RaiseExceptionAppender failed: Appender Plugin not implemented'], ptags)
+
+
+class SleepPlugin(ScannerPlugin):
+    """Dummy waiting for a backend"""
+    reads_tags = ()
+
+    def __init__(self, config, section, sleep, result=DUNNO, writes_tags=()):
+        ScannerPlugin.__init__(self, config, section)
+        self.sleep = sleep
+        self.result = result
+        self.writes_tags = writes_tags
+        self.started = None
+
+    def examine(self, suspect):
+        self.started = time.time()
+        time.sleep(self.sleep)
+        return self.result
+
+
+class TaggingPlugin(SleepPlugin):
+    """Dummy tagging the suspect and adding a header once it's done"""
+
+    def examine(self, suspect):
+        result = SleepPlugin.examine(self, suspect)
+        suspect.set_tag(self.section, True)
+        suspect.tags['spam'][self.section] = True
+        ptag = suspect.get_tag('processingerrors', defaultvalue=[])
+        ptag.append(self.section)
+        suspect.set_tag('processingerrors', ptag)
+        suspect.add_header('X-%s' % self.section, 'yes')
+        return result
+
+
+class ConcurrentPluginsTest(unittest.TestCase):
+    """Tests running independent plugins concurrently"""
+
+    def setUp(self):
+        self.config = RawConfigParser()
+        self.config.add_section("main")
+        self.config.set('main', 'trashdir', '')
+        self.config.add_section("performance")
+        self.config.set('performance', 'plugin_concurrency', '4')
+        self.suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', '/dev/null')
+
+    def test_concurrent(self):
+        """Independent plugins run concurrently, decisions are stored in plugin order"""
+        plugins = [SleepPlugin(self.config, 'P%u' % i, 0.3 - 0.1 * i, writes_tags=('spam:P%u' % i, )) for i in range(3)]
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        start = time.time()
+        shandler.run_plugins(self.suspect, plugins)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual([('P0', DUNNO), ('P1', DUNNO), ('P2', DUNNO)], self.suspect.tags['decisions'])
+        # the threads are kept for the next message
+        self.assertIs(shandler._plugin_executor(4), shandler._plugin_executor(4))
+
+    def test_dependencies(self):
+        """Plugins depending on tags of previous plugins or without declaration wait"""
+        writer = SleepPlugin(self.config, 'writer', 0.2, writes_tags=('SAPlugin.tempheader', ))
+        reader = SleepPlugin(self.config, 'reader', 0.0)
+        reader.reads_tags = ('SAPlugin.tempheader', )
+        undeclared = SleepPlugin(self.config, 'undeclared', 0.0)
+        undeclared.reads_tags = None
+        plugins = [writer, reader, undeclared]
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        shandler.run_plugins(self.suspect, plugins)
+        self.assertTrue(reader.started - writer.started >= 0.2)
+        self.assertTrue(undeclared.started >= reader.started)
+
+    def test_early_exit(self):
+        """The first final decision in plugin order wins, following plugins are not started"""
+        plugins = [SleepPlugin(self.config, 'slow', 0.3),
+                   SleepPlugin(self.config, 'reject', 0.1, result=REJECT),
+                   SleepPlugin(self.config, 'after', 0.0)]
+        plugins[2].reads_tags = None  # has to wait for the others
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        shandler.run_plugins(self.suspect, plugins)
+        self.assertEqual(REJECT, shandler.action)
+        self.assertEqual([('slow', DUNNO), ('reject', REJECT)], self.suspect.tags['decisions'])
+        self.assertIsNone(plugins[2].started)
+
+
+    def test_merge(self):
+        """Tags and headers of concurrent plugins are all kept"""
+        plugins = [TaggingPlugin(self.config, 'P%u' % i, 0.2 - 0.1 * i, writes_tags=('P%u' % i, )) for i in range(3)]
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        shandler.run_plugins(self.suspect, plugins)
+        for plugin in plugins:
+            self.assertTrue(self.suspect.get_tag(plugin.section))
+            self.assertTrue(self.suspect.tags['spam'][plugin.section])
+            self.assertEqual('yes', self.suspect.addheaders['X-%s' % plugin.section])
+        self.assertEqual(['P0', 'P1', 'P2'], self.suspect.get_tag('processingerrors'))
+
+    def test_after_final_decision(self):
+        """Plugins still running after a final decision are abandoned and don't change the suspect"""
+        plugins = [SleepPlugin(self.config, 'reject', 0.1, result=REJECT),
+                   TaggingPlugin(self.config, 'running', 0.5)]
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        start = time.time()
+        shandler.run_plugins(self.suspect, plugins)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(REJECT, shandler.action)
+        self.assertIsNotNone(plugins[1].started)
+        time.sleep(0.6)
+        self.assertIsNone(self.suspect.get_tag('running'))
+        self.assertEqual({}, self.suspect.tags['spam'])
+        self.assertEqual({}, self.suspect.addheaders)
+
+
+class PluginDeadlineTest(unittest.TestCase):
+    """Tests the per message deadline and plugin time budgets"""
+
+    def setUp(self):
+        self.config = RawConfigParser()
+        self.config.add_section("main")
+        self.config.set('main', 'trashdir', '')
+        self.config.add_section("performance")
+        self.config.set('performance', 'plugin_concurrency', '1')
+        self.config.set('performance', 'message_deadline', '0')
+        self.config.set('performance', 'deadline_action', 'DEFER')
+        self.config.set('performance', 'deadline_message', 'scan timeout')
+        self.suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', '/dev/null')
+
+    def test_budget(self):
+        """A plugin exceeding its budget is abandoned, the next plugin runs"""
+        self.config.add_section('hung')
+        self.config.set('hung', 'scan_budget', '0.1')
+        plugins = [SleepPlugin(self.config, 'hung', 1.0), SleepPlugin(self.config, 'next', 0.0)]
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        start = time.time()
+        shandler.run_plugins(self.suspect, plugins)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(['hung'], self.suspect.get_tag('fuglu.scan.timeouts'))
+        self.assertEqual([('next', DUNNO)], self.suspect.tags['decisions'])
+        self.assertEqual(DUNNO, shandler.action)
+
+    def test_deadline(self):
+        """Remaining plugins are skipped and the deadline action is applied"""
+        self.config.set('performance', 'message_deadline', '0.2')
+        plugins = [SleepPlugin(self.config, 'first', 0.0), SleepPlugin(self.config, 'hung', 1.0),
+                   SleepPlugin(self.config, 'skipped', 0.0)]
+        shandler = SessionHandler(None, self.config, [], plugins, [], 0)
+
+        start = time.time()
+        shandler.run_plugins(self.suspect, plugins)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(self.suspect.get_tag('fuglu.scan.deadline'))
+        self.assertEqual(['hung'], self.suspect.get_tag('fuglu.scan.timeouts'))
+        self.assertEqual(['skipped'], self.suspect.get_tag('fuglu.scan.skipped'))
+        self.assertEqual([('first', DUNNO), ('deadline', DEFER)], self.suspect.tags['decisions'])
+        self.assertEqual(DEFER, shandler.action)
+        self.assertEqual('scan timeout', shandler.message)
+
+    def test_abandoned_changes(self):
+        """Changes of an abandoned plugin after the deadline don't show up"""
+        self.config.set('performance', 'message_deadline', '0.1')
+        plugin = TaggingPlugin(self.config, 'late', 0.3)
+        shandler = SessionHandler(None, self.config, [], [plugin], [], 0)
+
+        shandler.run_plugins(self.suspect, [plugin])
+        self.assertEqual(['late'], self.suspect.get_tag('fuglu.scan.timeouts'))
+        time.sleep(0.4)
+        self.assertIsNone(self.suspect.get_tag('late'))
+        self.assertEqual({}, self.suspect.tags['spam'])
+        self.assertEqual({}, self.suspect.addheaders)
+        self.assertEqual(['Plugin TaggingPlugin(late) timed out (deadline)'], self.suspect.get_tag('processingerrors'))
+
+    def test_abandoned(self):
+        """Abandoned plugins don't touch the suspect and aren't started again while too many are running"""
+        self.config.set('performance', 'plugin_abandoned_max', '1')
+        self.config.add_section('stuck')
+        self.config.set('stuck', 'scan_budget', '0.1')
+        plugin = SleepPlugin(self.config, 'stuck', 0.4)
+        shandler = SessionHandler(None, self.config, [], [plugin], [], 0)
+
+        shandler.run_plugins(self.suspect, [plugin])
+        self.assertEqual(['stuck'], self.suspect.get_tag('fuglu.scan.timeouts'))
+
+        plugin.started = None
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', '/dev/null')
+        shandler.run_plugins(suspect, [plugin])
+        self.assertIsNone(plugin.started)
+        self.assertEqual(['stuck'], suspect.get_tag('fuglu.scan.timeouts'))
+
+        time.sleep(0.5)
+        self.assertEqual([], self.suspect.tags['scantimes'])
+        shandler.run_plugins(suspect, [plugin])
+        self.assertIsNotNone(plugin.started)
@@ -2,13 +2,27 @@
 from unittestsetup import TESTDATADIR
 import unittest
 import string
-from fuglu.shared import Suspect, SuspectFilter, string_to_actioncode, actioncode_to_string, apply_template, REJECT, FileList
+from fuglu.shared import Suspect, SuspectFilter, string_to_actioncode, actioncode_to_string, apply_template, REJECT, DUNNO, FileList, MessageSpool, LazyMessage, AVScannerPlugin, BackendPool, BackendPoolTimeout, get_backend_pool, \
+    Backend, BackendBalancer, BackendReplyError, get_backend_balancer
+from fuglu.stats import Statskeeper
 from fuglu.addrcheck import Addrcheck
 import email
 import os
 import sys
 import datetime
+import tempfile
+import shutil
 from fuglu.stringencode import force_uString, force_bString
+from fuglu.lib.patchedemail import PatchedMessage, PatchedMIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+import io
+import zipfile
+import copy
+import pickle
+import socket
+import threading
+import time
 from email.header import Header
 from configparser import ConfigParser
 from unittest.mock import patch
@@ -132,6 +146,58 @@ class SuspectTestCase(unittest.TestCase):
         self.assertEqual(type(suspect.get_source()),bytestype,"Wrong return type for get_source after setting unicode source")
         self.assertEqual(suspect.get_source(),test_source_binary,"Binary source content has to remain the same as the unicode content sent in")
 
+    def test_source_view(self):
+        """Test the memory mapped original source"""
+        filename = TESTDATADIR + '/helloworld.eml'
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', filename)
+        with open(filename, 'rb') as fh:
+            content = fh.read()
+
+        view = suspect.get_original_source_view()
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(content, view.tobytes())
+        self.assertEqual(content[:10], suspect.get_original_source_view(maxbytes=10).tobytes())
+        self.assertEqual(content[:10], suspect.get_original_source(maxbytes=10))
+        self.assertEqual(content, suspect.get_source_view().tobytes())
+
+        # the view keeps the map alive
+        suspect.release_original_source()
+        self.assertEqual(content, view.tobytes())
+        self.assertEqual(content, suspect.get_original_source())
+
+        suspect.set_source(b"Subject: changed\r\n\r\nchanged")
+        self.assertEqual(b"Subject: changed\r\n\r\nchanged", suspect.get_source_view().tobytes())
+        self.assertEqual(content, suspect.get_original_source())
+
+        empty = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', '/dev/null')
+        self.assertEqual(b"", empty.get_original_source())
+
+    def test_header_body_tracking(self):
+        """Header changes keep the body and the attachment manager"""
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', TESTDATADIR + '/6mbzipattachment.eml')
+        original = suspect.get_original_source()
+        body = original[original.index(b'\n\n'):]
+        att_mgr = suspect.att_mgr
+
+        suspect.set_header('Subject', 'changed')
+        suspect.add_header('X-Immediate', 'yes', immediate=True)
+        self.assertTrue(suspect.is_modified())
+        self.assertTrue(suspect.is_header_modified())
+        self.assertFalse(suspect.is_body_modified())
+        self.assertTrue(suspect.get_source().endswith(body))
+        self.assertIs(att_mgr, suspect.att_mgr)
+        self.assertEqual('changed', suspect.modified_headers['Subject'])
+        self.assertEqual('yes', suspect.added_headers['X-Immediate'])
+
+        # headers added by replacing the source (SpamAssassin) are found as well
+        suspect.set_source(b'X-Spam-Status: No\r\n' + suspect.get_source())
+        self.assertFalse(suspect.is_body_modified())
+        self.assertEqual('No', suspect.added_headers['X-Spam-Status'])
+
+        suspect.set_source(suspect.get_source() + b'\r\nappended')
+        self.assertTrue(suspect.is_body_modified())
+        self.assertIsNot(att_mgr, suspect.att_mgr)
+
     def test_add_header(self):
         """Test add_header for Python 2/3 consistency with different input types"""
         suspectorig = Suspect('sender@unittests.fuglu.org',
@@ -519,6 +585,261 @@ class SuspectTestCase(unittest.TestCase):
         self.assertEqual(100,len(source_stripped_attachments),
                         "after stripping zip attachment and limiting size, size should be 100")
 
+class MessageSpoolTestCase(unittest.TestCase):
+
+    """Test receiving messages in memory"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fuglu-spool-test')
+        with open(TESTDATADIR + '/helloworld.eml', 'rb') as fh:
+            self.content = fh.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _receive(self, maxsize):
+        spool = MessageSpool(self.tempdir, maxsize)
+        for i in range(0, len(self.content), 100):
+            spool.write(self.content[i:i + 100])
+        spool.close()
+        return spool
+
+    def test_in_memory(self):
+        """Small messages stay in memory until a plugin needs the tempfile"""
+        spool = self._receive(len(self.content))
+        self.assertTrue(spool.in_memory)
+        self.assertEqual([], os.listdir(self.tempdir))
+
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', spool)
+        self.assertTrue(suspect.source_in_memory)
+        self.assertEqual(len(self.content), suspect.size)
+        self.assertEqual(self.content, suspect.get_original_source())
+        self.assertEqual(self.content[:10], suspect.get_source_view(maxbytes=10).tobytes())
+        self.assertEqual('Hello world!', suspect.get_message_rep()['Subject'])
+        self.assertEqual([], os.listdir(self.tempdir))
+
+        filename = suspect.tempfile
+        self.assertFalse(suspect.source_in_memory)
+        self.assertEqual([os.path.basename(filename)], os.listdir(self.tempdir))
+        with open(filename, 'rb') as fh:
+            self.assertEqual(self.content, fh.read())
+        self.assertEqual(self.content, suspect.get_original_source())
+
+    def test_discard(self):
+        """A discarded message can't be written to disk anymore"""
+        spool = self._receive(len(self.content))
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', spool)
+        isolated = suspect.isolated_copy()
+        self.assertTrue(suspect.discard_source_in_memory())
+        self.assertIsNone(suspect.tempfile)
+        self.assertRaises(IOError, lambda: isolated.tempfile)
+        self.assertRaises(IOError, isolated.get_original_source)
+        self.assertEqual([], os.listdir(self.tempdir))
+
+        spool = self._receive(len(self.content))
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', spool)
+        filename = suspect.tempfile
+        self.assertFalse(suspect.discard_source_in_memory())
+        self.assertEqual(filename, suspect.tempfile)
+
+    def test_rollover(self):
+        """Messages growing past maxsize are written to disk"""
+        spool = self._receive(len(self.content) - 1)
+        self.assertFalse(spool.in_memory)
+        with open(spool.filename, 'rb') as fh:
+            self.assertEqual(self.content, fh.read())
+
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', spool)
+        self.assertFalse(suspect.source_in_memory)
+        self.assertEqual(spool.filename, suspect.tempfile)
+        self.assertEqual(self.content, suspect.get_original_source())
+
+    def test_concurrent_tempfile(self):
+        """Threads requesting the tempfile at the same time all get the complete file"""
+        for _ in range(20):
+            spool = self._receive(len(self.content))
+            suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', spool)
+            barrier = threading.Barrier(8)
+            results = []
+
+            def access(index):
+                barrier.wait()
+                if index % 2:
+                    filename = suspect.tempfile
+                    with open(filename, 'rb') as fh:
+                        results.append((filename, fh.read()))
+                else:
+                    results.append((None, suspect.get_original_source()))
+
+            threads = [threading.Thread(target=access, args=(index,)) for index in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(8, len(results))
+            self.assertEqual([os.path.basename(suspect.tempfile)], os.listdir(self.tempdir))
+            for filename, content in results:
+                self.assertIn(filename, (None, suspect.tempfile))
+                self.assertEqual(self.content, content)
+            suspect.release_original_source()
+            os.remove(suspect.tempfile)
+
+    def test_disabled(self):
+        """Without maxsize the tempfile is created immediately"""
+        spool = MessageSpool(self.tempdir)
+        self.assertFalse(spool.in_memory)
+        self.assertEqual([os.path.basename(spool.filename)], os.listdir(self.tempdir))
+        spool.close()
+
+
+class IsolatedCopyTestCase(unittest.TestCase):
+
+    """Test merging the changes of suspect copies examined by concurrent plugins"""
+
+    def setUp(self):
+        self.suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', TESTDATADIR + '/helloworld.eml')
+        self.suspect.set_tag('removed', True)
+
+    def test_isolated(self):
+        """Changes of a copy are not visible before they are merged"""
+        isolated = self.suspect.isolated_copy()
+        isolated.set_tag('new', 1)
+        isolated.tags['spam']['copy'] = True
+        isolated.add_header('X-Copy', 'yes')
+        isolated.recipients.append('other@unittests.fuglu.org')
+        isolated.set_header('Subject', 'changed')
+        del isolated.tags['removed']
+
+        self.assertIsNone(self.suspect.get_tag('new'))
+        self.assertEqual({}, self.suspect.tags['spam'])
+        self.assertEqual({}, self.suspect.addheaders)
+        self.assertEqual(['recipient@unittests.fuglu.org'], self.suspect.recipients)
+        self.assertEqual('Hello world!', self.suspect.get_message_rep()['Subject'])
+        self.assertFalse(self.suspect.is_modified())
+
+        self.suspect.merge_isolated_copy(isolated)
+        self.assertEqual(1, self.suspect.get_tag('new'))
+        self.assertEqual({'copy': True}, self.suspect.tags['spam'])
+        self.assertEqual({'X-Copy': 'yes'}, self.suspect.addheaders)
+        self.assertEqual(['recipient@unittests.fuglu.org', 'other@unittests.fuglu.org'], self.suspect.recipients)
+        self.assertEqual('changed', self.suspect.get_message_rep()['Subject'])
+        self.assertTrue(self.suspect.is_header_modified())
+        self.assertIsNone(self.suspect.get_tag('removed'))
+
+    def test_merge(self):
+        """Changes of several copies are all kept"""
+        copies = [self.suspect.isolated_copy(copy_message=False) for _ in range(2)]
+        for index, isolated in enumerate(copies):
+            isolated.tags['virus']['copy%u' % index] = False
+            isolated.tags['decisions'].append(('copy%u' % index, DUNNO))
+            ptag = isolated.get_tag('processingerrors', defaultvalue=[])
+            ptag.append('error %u' % index)
+            isolated.set_tag('processingerrors', ptag)
+        for isolated in copies:
+            self.suspect.merge_isolated_copy(isolated)
+
+        self.assertEqual({'copy0': False, 'copy1': False}, self.suspect.tags['virus'])
+        self.assertEqual([('copy0', DUNNO), ('copy1', DUNNO)], self.suspect.tags['decisions'])
+        self.assertEqual(['error 0', 'error 1'], self.suspect.get_tag('processingerrors'))
+        self.assertTrue(self.suspect.get_tag('removed'))
+
+
+class LazyMessageTestCase(unittest.TestCase):
+
+    """Test header-only message parsing"""
+
+    def _compare(self, filename):
+        with open(TESTDATADIR + '/' + filename, 'rb') as fh:
+            source = fh.read()
+        eager = email.message_from_bytes(source, _class=PatchedMessage)
+        lazy = LazyMessage.from_source(source)
+
+        self.assertEqual(eager.items(), lazy.items())
+        self.assertEqual(eager.get_content_type(), lazy.get_content_type())
+        self.assertFalse(lazy.body_parsed)
+
+        self.assertEqual([part.get_content_type() for part in eager.walk()],
+                         [part.get_content_type() for part in lazy.walk()])
+        self.assertTrue(lazy.body_parsed)
+        self.assertEqual(eager.as_bytes(), lazy.as_bytes())
+
+    def test_multipart(self):
+        """Parts are the same as with a complete parse"""
+        self._compare('6mbzipattachment.eml')
+        self._compare('inline_image.eml')
+
+    def test_simple(self):
+        """Simple message without MIME parts"""
+        self._compare('helloworld.eml')
+
+    def test_modified_headers(self):
+        """Headers changed before the body is parsed are kept"""
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', TESTDATADIR + '/helloworld.eml')
+        msgrep = suspect.get_message_rep()
+        self.assertIsInstance(msgrep, LazyMessage)
+        msgrep.replace_header('Subject', 'changed')
+        self.assertFalse(msgrep.body_parsed)
+        suspect.set_message_rep(msgrep)
+        self.assertIn(b'Subject: changed', suspect.get_source())
+        self.assertIn(suspect.get_original_source().split(b'\n\n', 1)[1], suspect.get_source())
+
+    def test_headers_only(self):
+        """Source without body"""
+        msgrep = LazyMessage.from_source(b"Subject: no body")
+        self.assertEqual('no body', msgrep['Subject'])
+
+    def test_copy_unparsed(self):
+        """Messages can be copied and pickled before the body is parsed"""
+        with open(TESTDATADIR + '/helloworld.eml', 'rb') as fh:
+            source = fh.read()
+        eager = email.message_from_bytes(source, _class=PatchedMessage)
+
+        lazy = LazyMessage.from_source(memoryview(source))
+        self.assertFalse(lazy.body_parsed)
+        self.assertEqual(eager.as_bytes(), copy.deepcopy(lazy).as_bytes())
+
+        lazy = LazyMessage.from_source(memoryview(source))
+        self.assertEqual(eager.as_bytes(), pickle.loads(pickle.dumps(lazy)).as_bytes())
+
+        # every message has its own lock
+        copied = copy.deepcopy(lazy)
+        self.assertIsNot(lazy._load_lock, copied._load_lock)
+        self.assertIsNot(lazy._load_lock, LazyMessage.from_source(source)._load_lock)
+
+    def test_release_source(self):
+        """The message doesn't keep the unmapped tempfile referenced"""
+        suspect = Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', TESTDATADIR + '/helloworld.eml')
+        msgrep = suspect.get_message_rep()
+        original_map = suspect._original_map
+        suspect.release_original_source()
+        self.assertTrue(original_map.closed)
+        self.assertFalse(msgrep.body_parsed)
+        self.assertIn(suspect.get_original_source().split(b'\n\n', 1)[1], msgrep.as_bytes())
+
+    def test_concurrent_load(self):
+        """Threads accessing the body at the same time all see the parsed body"""
+        # enough parts to keep the parser busy for a while
+        parts = b''.join(b'--sep\r\nContent-Type: text/plain\r\n\r\npart %u\r\n' % i for i in range(2000))
+        source = (b'Content-Type: multipart/mixed; boundary="sep"\r\n\r\n' + parts + b'--sep--\r\n')
+        lazy = LazyMessage.from_source(source)
+        barrier = threading.Barrier(4)
+        payloads = []
+
+        def access():
+            barrier.wait()
+            payloads.append(lazy.get_payload())
+
+        threads = [threading.Thread(target=access) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(payloads))
+        for payload in payloads:
+            self.assertEqual(2000, len(payload))
+
+
 class SuspectFilterTestCase(unittest.TestCase):
 
     """Test Suspectfilter"""
@@ -1086,3 +1407,287 @@ class StaticFunctionTests(unittest.TestCase):
                                                                          "fancy-test-header",
                                                                          u"Fancy Value")
 
+
+
+class CountingAVPlugin(AVScannerPlugin):
+    """AV plugin counting the scans, content containing 'EICAR' is a virus"""
+
+    def __init__(self, config, section=None):
+        AVScannerPlugin.__init__(self, config, section)
+        self.scans = 0
+        self.signature = '1'
+
+    def scan_stream(self, content, suspectid='(N/A)'):
+        self.scans += 1
+        if b'EICAR' in force_bString(bytes(content) if isinstance(content, memoryview) else content):
+            return {'stream': 'Eicar-Test-Signature'}
+        return None
+
+    def _engine_signature(self):
+        return self.signature
+
+
+class AVVerdictCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = ConfigParser()
+        self.config.add_section('performance')
+        self.config.set('performance', 'avcache_ttl', '60')
+        self.config.set('performance', 'avcache_maxsize', '100')
+        self.config.set('performance', 'avcache_redis', '')
+        self.config.set('performance', 'avcache_redispw', '')
+        self.plugin = CountingAVPlugin(self.config)
+
+    def test_cached(self):
+        """Same content is scanned once per signature version"""
+        stats = Statskeeper()
+        hits = stats.avcachehitcount
+        self.assertIsNone(self.plugin.scan_stream_cached(b'clean'))
+        self.assertIsNone(self.plugin.scan_stream_cached(memoryview(b'clean')))
+        self.assertEqual({'stream': 'Eicar-Test-Signature'}, self.plugin.scan_stream_cached('EICAR'))
+        self.assertEqual({'stream': 'Eicar-Test-Signature'}, self.plugin.scan_stream_cached(b'EICAR'))
+        self.assertEqual(2, self.plugin.scans)
+        self.assertEqual(hits + 2, stats.avcachehitcount)
+
+        self.plugin.signature = '2'
+        self.plugin.scan_stream_cached(b'clean')
+        self.assertEqual(3, self.plugin.scans)
+
+    def test_disabled(self):
+        """Content is always scanned if the cache is disabled or the signature unknown"""
+        self.plugin.signature = None
+        self.plugin.scan_stream_cached(b'clean')
+        self.plugin.scan_stream_cached(b'clean')
+        self.assertEqual(2, self.plugin.scans)
+
+        self.plugin.signature = '1'
+        self.config.set('performance', 'avcache_ttl', '0')
+        self.plugin.scan_stream_cached(b'clean')
+        self.plugin.scan_stream_cached(b'clean')
+        self.assertEqual(4, self.plugin.scans)
+
+    def _attachment_suspect(self, parts):
+        """suspect with a text body and the given (filename, content) attachments"""
+        msg = PatchedMIMEMultipart()
+        msg['Subject'] = 'attachments'
+        msg.attach(MIMEText('hello'))
+        for filename, content in parts:
+            attachment = MIMEApplication(content)
+            attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+            msg.attach(attachment)
+        tmpfile = tempfile.NamedTemporaryFile(suffix='attachments', prefix='fuglu-unittest', dir='/tmp', delete=False)
+        tmpfile.write(msg.as_bytes())
+        tmpfile.close()
+        self.addCleanup(os.remove, tmpfile.name)
+        return Suspect('sender@unittests.fuglu.org', 'recipient@unittests.fuglu.org', tmpfile.name)
+
+    def test_attachments(self):
+        """Decoded parts are scanned once and infected parts are reported by name"""
+        self.config.set('performance', 'avcache_ttl', '0')
+        suspect = self._attachment_suspect([('a.bin', b'clean'), ('b.bin', b'clean'), ('c.com', b'EICAR')])
+        self.assertEqual({'c.com': 'Eicar-Test-Signature'}, self.plugin.scan_attachments_cached(suspect))
+        # text body, clean and infected attachment
+        self.assertEqual(3, self.plugin.scans)
+
+    def test_archive_members(self):
+        """Archive members are scanned instead of the archive if requested"""
+        self.config.set('performance', 'avcache_ttl', '0')
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('clean.txt', b'clean')
+            zf.writestr('eicar.com', b'EICAR')
+        suspect = self._attachment_suspect([('files.zip', archive.getvalue())])
+        self.plugin.scan_attachments_cached(suspect)
+        # text body and archive
+        self.assertEqual(2, self.plugin.scans)
+        self.assertEqual({'eicar.com': 'Eicar-Test-Signature'},
+                         self.plugin.scan_attachments_cached(suspect, archivelevel=1))
+        self.assertEqual(5, self.plugin.scans)
+
+
+class BackendPoolTestCase(unittest.TestCase):
+    """Test the connection pool to the scanner backends"""
+
+    def setUp(self):
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+
+    def connect(self):
+        sock, peer = socket.socketpair()
+        self.peers.append(peer)
+        return sock
+
+    def test_reuse(self):
+        """Connections released as reusable are handed out again, others are closed"""
+        pool = BackendPool('test', self.connect)
+        conn = pool.get(reuse=True)
+        pool.release(conn, reusable=True)
+        self.assertIs(conn, pool.get(reuse=True))
+        self.assertEqual(2, conn.uses)
+        pool.release(conn, reusable=False)
+        self.assertEqual(-1, conn.sock.fileno())
+        stats = pool.stats()
+        self.assertEqual((1, 1, 0), (stats['created'], stats['reused'], stats['size']))
+
+    def test_oneshot(self):
+        """Connections are not reused unless requested"""
+        pool = BackendPool('test', self.connect)
+        conn = pool.get(reuse=True)
+        pool.release(conn, reusable=True)
+        self.assertIsNot(conn, pool.get())
+
+    def test_connection_error(self):
+        """Connections are closed if the protocol fails"""
+        pool = BackendPool('test', self.connect)
+        with self.assertRaises(ValueError):
+            with pool.connection(reuse=True) as conn:
+                raise ValueError()
+        self.assertEqual(-1, conn.sock.fileno())
+        self.assertEqual(0, pool.stats()['size'])
+
+    def test_health_check(self):
+        """Idle connections closed by the backend or expired are not handed out"""
+        pool = BackendPool('test', self.connect)
+        conn = pool.get(reuse=True)
+        pool.release(conn, reusable=True)
+        self.peers[0].close()
+        self.assertIsNot(conn, pool.get(reuse=True))
+
+        pool = BackendPool('test', self.connect, maxidle=0.01)
+        conn = pool.get(reuse=True)
+        pool.release(conn, reusable=True)
+        time.sleep(0.02)
+        self.assertIsNot(conn, pool.get(reuse=True))
+        self.assertEqual(1, pool.stats()['evicted'])
+
+    def test_bounded(self):
+        """Callers wait for a free connection if the pool is full"""
+        pool = BackendPool('test', self.connect, maxsize=1, waittimeout=0.05)
+        conn = pool.get()
+        self.assertRaises(BackendPoolTimeout, pool.get)
+
+        threading.Timer(0.01, pool.release, [conn]).start()
+        pool.waittimeout = 5
+        pool.release(pool.get())
+        stats = pool.stats()
+        self.assertEqual((2, 1, 0), (stats['waits'], stats['timeouts'], stats['size']))
+        self.assertGreater(stats['maxwaittime'], 0)
+
+    def test_registry(self):
+        """Plugins connecting to the same backend share the pool"""
+        config = ConfigParser()
+        config.add_section('performance')
+        config.set('performance', 'backendpool_maxsize', '5')
+        pool = get_backend_pool(config, 'unittest:backend', self.connect)
+        self.assertEqual(5, pool.maxsize)
+        config.set('performance', 'backendpool_maxsize', '3')
+        self.assertIs(pool, get_backend_pool(config, 'unittest:backend', self.connect))
+        self.assertEqual(3, pool.maxsize)
+
+
+class BackendBalancerTestCase(unittest.TestCase):
+    """Test selection and health tracking of balanced backends"""
+
+    def _request(self, balancer, failing=(), duration=0.1):
+        """request to the selected backend, fails if its name is in failing"""
+        backend = balancer.select()
+        balancer.finish(backend, backend.name not in failing, duration)
+        return backend.name
+
+    def test_parse(self):
+        """Backends are given as host:port, host, [IPv6]:port or unix socket path"""
+        backend = Backend('scan1:783')
+        self.assertEqual(('scan1', 783), backend.sockaddr)
+        self.assertEqual(('scan1', 783), Backend('scan1', defaultport=783).sockaddr)
+        self.assertEqual(('::1', 3310), Backend('[::1]:3310').sockaddr)
+        self.assertEqual(('::1', 3310), Backend('::1', defaultport=3310).sockaddr)
+        self.assertEqual('/run/clamd.sock', Backend('/run/clamd.sock').sockaddr)
+        self.assertRaises(ValueError, Backend, 'scan1')
+
+    def test_roundrobin(self):
+        """Requests are distributed by weight"""
+        balancer = BackendBalancer('test', [Backend('a:1', weight=2), Backend('b:1')], method='roundrobin')
+        names = [self._request(balancer) for _ in range(6)]
+        self.assertEqual(4, names.count('a:1'))
+        self.assertEqual(2, names.count('b:1'))
+
+    def test_leastconn(self):
+        """The backend with the fewest outstanding requests and the shortest response time is selected"""
+        balancer = BackendBalancer('test', [Backend('a:1'), Backend('b:1')])
+        first = balancer.select()
+        second = balancer.select()
+        self.assertNotEqual(first, second)
+        balancer.finish(first, True, 0.1)
+        balancer.finish(second, True, 1.0)
+        self.assertEqual(first.name, self._request(balancer))
+        self.assertEqual(first.name, self._request(balancer))
+
+    def test_failover(self):
+        """A thread retrying after an error gets another backend"""
+        balancer = BackendBalancer('test', [Backend('a:1'), Backend('b:1')], method='roundrobin')
+        failed = self._request(balancer, failing=('a:1', 'b:1'))
+        self.assertNotEqual(failed, self._request(balancer))
+
+    def test_ejection(self):
+        """Failing backends are ejected and readmitted after a successful test request"""
+        balancer = BackendBalancer('test', [Backend('a:1'), Backend('b:1')], maxfails=2, ejecttime=0.05)
+        a = balancer.backends[0]
+        for _ in range(10):
+            self._request(balancer, failing=('a:1',))
+        self.assertEqual(2, a.errors)
+        self.assertEqual(1, a.ejections)
+
+        # failed test request
+        time.sleep(0.06)
+        names = [self._request(balancer, failing=('a:1',)) for _ in range(4)]
+        self.assertEqual(1, names.count('a:1'))
+        self.assertEqual(2, a.ejections)
+
+        time.sleep(0.06)
+        names = [self._request(balancer) for _ in range(4)]
+        self.assertIn('a:1', names)
+        self.assertEqual(0, a.ejected_until)
+        self.assertEqual(2, a.ejections)
+
+    def test_request(self):
+        """Exceptions in a request count as errors"""
+        balancer = BackendBalancer('test', [Backend('a:1')])
+        with self.assertRaises(ValueError):
+            with balancer.request():
+                raise ValueError()
+        with self.assertRaises(BackendPoolTimeout):
+            with balancer.request():
+                raise BackendPoolTimeout()
+        with balancer.request():
+            pass
+        stats = balancer.stats()[0]
+        self.assertEqual((3, 1, 0), (stats['requests'], stats['errors'], stats['outstanding']))
+
+    def test_reply_error(self):
+        """Errors answered by the backend don't eject it"""
+        balancer = BackendBalancer('test', [Backend('a:1')], maxfails=2)
+        for _ in range(3):
+            with self.assertRaises(BackendReplyError):
+                with balancer.request():
+                    raise BackendReplyError('INSTREAM size limit exceeded. ERROR')
+        stats = balancer.stats()[0]
+        self.assertEqual((3, 0, 'up'), (stats['requests'], stats['errors'], stats['state']))
+
+    def test_registry(self):
+        """The balancer is built from the plugin section"""
+        config = ConfigParser()
+        config.add_section('test')
+        for option, value in (('host', 'localhost'), ('port', '783'), ('backends', ''), ('balance', 'leastconn'),
+                              ('maxfails', '3'), ('ejecttime', '30')):
+            config.set('test', option, value)
+        balancer = get_backend_balancer(config, 'test', 'unittest')
+        self.assertEqual(['localhost:783'], [b.name for b in balancer.backends])
+        config.set('test', 'backends', 'scan1*2, scan2:784')
+        config.set('test', 'balance', 'roundrobin')
+        balancer = get_backend_balancer(config, 'test', 'unittest', defaultport=783)
+        self.assertEqual([('scan1', 783, 2), ('scan2', 784, 1)],
+                         [(b.host, b.port, b.weight) for b in balancer.backends])
+        self.assertEqual('roundrobin', balancer.method)
+        self.assertIs(balancer, get_backend_balancer(config, 'test', 'unittest', defaultport=783))
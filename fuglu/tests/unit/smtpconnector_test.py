@@ -0,0 +1,326 @@
+# -*- coding: UTF-8 -*-
+from unittestsetup import TESTDATADIR
+import unittest
+import threading
+import smtplib
+import tempfile
+from configparser import RawConfigParser
+from unittest.mock import patch
+from fuglu.connectors.smtpconnector import FUSMTPClient, StreamedMessage, SMTPConnectionPool, SMTPSession
+from fuglu.connectors.esmtpconnector import ESMTPPassthroughSession
+from fuglu.shared import Suspect
+
+
+class CaptureClient(FUSMTPClient):
+    """client collecting the data sent instead of talking to a server"""
+
+    def __init__(self):
+        FUSMTPClient.__init__(self)
+        self.sent = []
+
+    def putcmd(self, cmd, args=""):
+        pass
+
+    def getreply(self):
+        return 354, b"go ahead"
+
+    def send(self, s):
+        self.sent.append(bytes(s))
+
+
+class StreamedMessageTest(unittest.TestCase):
+    """Test re-injecting messages in chunks"""
+
+    def _compare(self, headers, source, chunksize):
+        client = CaptureClient()
+        client.data(StreamedMessage(headers, source, chunksize=chunksize))
+        streamed = b"".join(client.sent)
+
+        client = CaptureClient()
+        smtplib.SMTP.data(client, headers + source)
+        self.assertEqual(b"".join(client.sent), streamed)
+
+    def test_dot_stuffing(self):
+        """Leading periods are quoted like smtplib does, also across chunk boundaries"""
+        source = b"Subject: dots\r\n\r\n.first\r\n..second\r\nthird.\r\n.\r\nend\n.bare lf"
+        for chunksize in (1, 2, 3, 7, 1024):
+            self._compare(b"X-Fuglu: test\r\n", source, chunksize)
+            self._compare(b"", source, chunksize)
+            self._compare(b"", b"." + source + b"\r\n", chunksize)
+
+    def test_large(self):
+        """Chunks of a message read from the testdata"""
+        with open(TESTDATADIR + '/6mbzipattachment.eml', 'rb') as fh:
+            source = fh.read()
+        self._compare(b"X-Fuglu: test\r\n", source, 65536)
+
+    def test_len(self):
+        """Size of headers and source for the SIZE extension"""
+        self.assertEqual(15, len(StreamedMessage(b"X: y\r\n", b"123456789")))
+
+    def test_header_modified(self):
+        """After header changes the original body is still sent from the tempfile"""
+        with tempfile.NamedTemporaryFile(suffix='.eml') as fh:
+            fh.write(b"Subject: old\r\nX-Spam: yes\r\n\r\nbody\r\n.line\r\n")
+            fh.flush()
+            suspect = Suspect('sender@example.com', 'recipient@example.com', fh.name)
+            suspect.set_header('Subject', 'new')
+            suspect.add_header('X-Fuglu', 'test', immediate=True)
+            self.assertFalse(suspect.is_body_modified())
+
+            msg = StreamedMessage.from_suspect(suspect, headers=b"X-Added: 1\r\n")
+            self.assertEqual(fh.name, msg.filename)
+            self.assertEqual(b"body\r\n.line\r\n", bytes(msg.source))
+            fh.seek(msg.offset)
+            self.assertEqual(bytes(msg.source), fh.read())
+
+            client = CaptureClient()
+            client.data(msg)
+            expected = CaptureClient()
+            smtplib.SMTP.data(expected, b"X-Added: 1\r\n" + suspect.get_source())
+            self.assertEqual(b"".join(expected.sent), b"".join(client.sent))
+
+            suspect.set_source(suspect.get_source() + b"appended\r\n")
+            self.assertIsNone(StreamedMessage.from_suspect(suspect).filename)
+
+
+class BdatTest(unittest.TestCase):
+    """Test re-injecting messages using BDAT"""
+
+    def setUp(self):
+        self.client = CaptureClient()
+        self.client.commands = []
+        self.client.putcmd = lambda cmd, args="": self.client.commands.append((cmd, args))
+        self.client.esmtp_features = {'chunking': ''}
+
+    def test_fallback(self):
+        """DATA is used unless enabled and advertised by the server"""
+        msg = StreamedMessage(b"X-Fuglu: test\r\n", b"\r\n.body\r\n")
+        self.client.data(msg)
+        self.assertEqual([("data", "")], self.client.commands)
+
+        self.client.use_bdat = True
+        self.client.esmtp_features = {}
+        self.client.commands = []
+        self.client.data(msg)
+        self.assertEqual([("data", "")], self.client.commands)
+
+    def test_bdat(self):
+        """The message is sent as it is in a single chunk"""
+        self.client.use_bdat = True
+        self.client.data(StreamedMessage(b"X-Fuglu: test\r\n", b"\r\n.body", chunksize=2))
+        self.assertEqual([("bdat", "22 LAST")], self.client.commands)
+        self.assertEqual(b"X-Fuglu: test\r\n\r\n.body", b"".join(self.client.sent))
+
+
+class PoolClient(object):
+    """connection recording the commands sent to the server"""
+
+    def __init__(self, host, port):
+        self.sock = object()
+        self.commands = []
+        self.rset_code = 250
+
+    def ehlo(self, name):
+        self.commands.append('ehlo')
+        return 250, b"ok"
+
+    def helo(self, name):
+        self.commands.append('helo')
+        return 250, b"ok"
+
+    def rset(self):
+        self.commands.append('rset')
+        if self.rset_code is None:
+            raise smtplib.SMTPServerDisconnected()
+        return self.rset_code, b"ok"
+
+    def quit(self):
+        self.commands.append('quit')
+        self.sock = None
+
+    def close(self):
+        self.sock = None
+
+
+@patch('fuglu.connectors.smtpconnector.FUSMTPClient', PoolClient)
+class SMTPConnectionPoolTest(unittest.TestCase):
+    """Test reusing re-inject connections"""
+
+    def setUp(self):
+        self.pool = SMTPConnectionPool()
+
+    def test_disabled(self):
+        """Connections are closed if maxage is 0"""
+        client, reused = self.pool.get('localhost', 25, 'fuglu')
+        self.assertFalse(reused)
+        self.pool.release(client)
+        self.assertEqual(['helo', 'quit'], client.commands)
+        self.assertFalse(self.pool.get('localhost', 25, 'fuglu')[1])
+
+    def test_reuse(self):
+        """Connections are reset and reused until maxmessages is reached"""
+        limits = dict(maxage=60, maxmessages=2)
+        client, reused = self.pool.get('localhost', 25, 'fuglu', esmtp=True, **limits)
+        self.assertFalse(reused)
+        self.pool.release(client, **limits)
+
+        # other helo or greeting
+        self.assertFalse(self.pool.get('localhost', 25, 'other', esmtp=True, **limits)[1])
+        self.assertFalse(self.pool.get('localhost', 25, 'fuglu', **limits)[1])
+
+        second, reused = self.pool.get('localhost', 25, 'fuglu', esmtp=True, **limits)
+        self.assertTrue(reused)
+        self.assertIs(client, second)
+        self.pool.release(client, **limits)
+        self.assertEqual(['ehlo', 'rset', 'quit'], client.commands)
+        self.assertFalse(self.pool.get('localhost', 25, 'fuglu', esmtp=True, **limits)[1])
+
+    def test_unusable(self):
+        """Broken connections or failed transactions are not reused"""
+        limits = dict(maxage=60)
+        client = self.pool.get('localhost', 25, 'fuglu', **limits)[0]
+        self.pool.release(client, reusable=False, **limits)
+        self.assertEqual(['helo', 'quit'], client.commands)
+
+        client = self.pool.get('localhost', 25, 'fuglu', **limits)[0]
+        self.pool.release(client, **limits)
+        client.rset_code = None
+        newclient, reused = self.pool.get('localhost', 25, 'fuglu', **limits)
+        self.assertFalse(reused)
+        self.assertIsNot(client, newclient)
+
+    def test_shared(self):
+        """Connections released by a thread which ended are reused by other threads"""
+        limits = dict(maxage=60)
+        clients = []
+
+        def deliver():
+            client = self.pool.get('localhost', 25, 'fuglu', **limits)[0]
+            clients.append(client)
+            self.pool.release(client, **limits)
+
+        thread = threading.Thread(target=deliver)
+        thread.start()
+        thread.join()
+        client, reused = self.pool.get('localhost', 25, 'fuglu', **limits)
+        self.assertTrue(reused)
+        self.assertIs(clients[0], client)
+        self.pool.release(client, **limits)
+
+    def test_close_all(self):
+        """Idle connections are closed right away, connections in use once they are released"""
+        limits = dict(maxage=60)
+        idle = self.pool.get('localhost', 25, 'fuglu', **limits)[0]
+        busy = self.pool.get('localhost', 25, 'fuglu', **limits)[0]
+        self.pool.release(idle, **limits)
+
+        self.pool.close_all()
+        self.assertEqual(['helo', 'quit'], idle.commands)
+        self.assertEqual(['helo'], busy.commands)
+        self.pool.release(busy, **limits)
+        self.assertEqual(['helo', 'quit'], busy.commands)
+        self.assertFalse(self.pool.get('localhost', 25, 'fuglu', **limits)[1])
+
+
+class OfflineESMTPSession(ESMTPPassthroughSession):
+    """esmtp session accepting all commands instead of forwarding them"""
+
+    def forwardCommand(self, command):
+        return "250 OK"
+
+
+class SMTPReceiveTest(unittest.TestCase):
+    """Test the buffered receive state machine of SMTPSession"""
+
+    def setUp(self):
+        self.config = RawConfigParser()
+        self.config.add_section('main')
+        self.config.set('main', 'tempdir', tempfile.gettempdir())
+        self.config.set('main', 'outgoinghelo', 'fuglu.test')
+        self.config.add_section('performance')
+        self.config.set('performance', 'memory_spool_maxsize', '10000000')
+
+    def _receive(self, data, chunksize, sessionclass=SMTPSession):
+        sess = sessionclass(None, self.config)
+        replies = []
+        complete = False
+        for start in range(0, len(data), chunksize):
+            buf = bytearray(data[start:start + chunksize])
+            received, complete = sess.receive(buf, len(buf))
+            replies.extend(rsp for rsp, keep in received)
+            if complete:
+                # bytes received after the message are kept for the session
+                sess._inbuf += data[start + chunksize:]
+                break
+        return sess, replies, complete
+
+    def test_unstuffing(self):
+        """The message is unstuffed and complete for any chunk boundaries"""
+        source = b"Subject: dots\r\n\r\n.first\r\n..second\r\nthird.\r\n.\r\n\r\n.\r\nend\r\n"
+        client = CaptureClient()
+        smtplib.SMTP.data(client, source)
+        commands = b"EHLO client\r\nMAIL FROM:<sender@fuglu.org>\r\nRCPT TO:<rcpt@fuglu.org>\r\nDATA\r\n"
+        for chunksize in (1, 2, 3, 5, 7, 1024):
+            sess, replies, complete = self._receive(commands + b"".join(client.sent) + b"QUIT\r\n", chunksize)
+            self.assertTrue(complete)
+            self.assertEqual(4, len(replies))
+            self.assertTrue(replies[-1].startswith("354"))
+            self.assertEqual(source, sess.tempfile.getvalue())
+            self.assertEqual(["sender@fuglu.org", ["rcpt@fuglu.org"]], [sess.from_address, sess.recipients])
+            self.assertEqual(b"QUIT\r\n", sess._inbuf)
+
+    def test_empty(self):
+        """A terminator right after DATA is an empty message"""
+        sess, replies, complete = self._receive(
+            b"HELO client\r\nMAIL FROM:<>\r\nRCPT TO:<rcpt@fuglu.org>\r\nDATA\r\n.\r\n", 1024)
+        self.assertTrue(complete)
+        self.assertEqual(b"", sess.tempfile.getvalue())
+
+    def test_pipelining(self):
+        """Pipelined commands are answered together"""
+        self.config.set('main', 'incomingpipelining', 'True')
+        sess = SMTPSession(None, self.config)
+        buf = bytearray(b"EHLO client\r\nMAIL FROM:<sender@fuglu.org>\r\nRCPT TO:<a@fuglu.org>\r\n"
+                        b"RCPT TO:<b@fuglu.org>\r\nDATA\r\n")
+        replies, complete = sess.receive(buf, len(buf))
+        self.assertFalse(complete)
+        self.assertEqual(5, len(replies))
+        self.assertTrue(replies[0][0].endswith("\r\n250 PIPELINING"))
+        self.assertTrue(replies[-1][0].startswith("354"))
+        self.assertEqual(["a@fuglu.org", "b@fuglu.org"], sess.recipients)
+
+    def test_bdat(self):
+        """Chunks are stored as they are"""
+        self.config.set('main', 'incomingchunking', 'True')
+        source = b"Subject: chunks\r\n\r\n..not stuffed\r\n.\r\n"
+        commands = (b"EHLO client\r\nMAIL FROM:<sender@fuglu.org>\r\nRCPT TO:<rcpt@fuglu.org>\r\n"
+                    b"BDAT 10\r\n" + source[:10] + b"BDAT " + str(len(source) - 10).encode() + b"\r\n" + source[10:]
+                    + b"BDAT 0 LAST\r\n")
+        for sessionclass in (SMTPSession, OfflineESMTPSession):
+            for chunksize in (1, 3, 1024):
+                sess, replies, complete = self._receive(commands, chunksize, sessionclass=sessionclass)
+                self.assertTrue(complete)
+                self.assertEqual(["250 10 octets received", "250 %s octets received" % (len(source) - 10)],
+                                 replies[-2:])
+                self.assertEqual(source, sess.tempfile.getvalue())
+
+    def test_bdat_errors(self):
+        """The octets of refused chunks are read and dropped"""
+        self.config.set('main', 'incomingchunking', 'True')
+        sess, replies, complete = self._receive(
+            b"EHLO client\r\nBDAT 6 LAST\r\nDATA\r\nMAIL FROM:<sender@fuglu.org>\r\nRCPT TO:<rcpt@fuglu.org>\r\n"
+            b"BDAT 3\r\nabcDATA\r\nRSET\r\nBDAT x\r\n", 1024)
+        self.assertFalse(complete)
+        self.assertEqual(["503 Bad command sequence", "250 OK", "250 OK", "250 3 octets received",
+                          "503 Bad command sequence", "250 OK", "501 Syntax: BDAT <size> [LAST]"], replies[1:])
+        self.assertIsNone(sess.tempfile)
+
+    def test_esmtp_ehlo(self):
+        """The extensions of the outgoing server are replaced by the ones of the session"""
+        self.config.set('main', 'incomingpipelining', 'True')
+        sess = ESMTPPassthroughSession(None, self.config)
+        self.assertEqual("250-mx.fuglu.org\r\n250-SIZE 1000\r\n250-XFORWARD NAME ADDR\r\n250 PIPELINING",
+                         sess.filter_ehlo("250-mx.fuglu.org\r\n250-PIPELINING\r\n250-SIZE 1000\r\n"
+                                          "250-CHUNKING\r\n250-XFORWARD NAME ADDR\r\n250 BINARYMIME"))
+        self.assertEqual("250-mx.fuglu.org\r\n250 PIPELINING", sess.filter_ehlo("250 mx.fuglu.org"))
@@ -0,0 +1,191 @@
+# -*- coding: UTF-8 -*-
+from unittestsetup import TESTDATADIR
+import unittest
+import socket
+import tempfile
+import shutil
+import time
+from configparser import RawConfigParser
+from fuglu.core import MainController
+from fuglu.threadpool import ThreadPool
+from fuglu.protocolbase import BasicTCPServer
+from fuglu.connectors.ncconnector import NCHandler
+from fuglu.stats import Statskeeper
+
+
+class ThreadPoolAutoscaleTest(unittest.TestCase):
+    """Test latency driven scaling of the threadpool"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fuglu-threadpool-test')
+        config = RawConfigParser()
+        config.add_section("main")
+        config.set('main', 'plugins', '')
+        config.set('main', 'prependers', '')
+        config.set('main', 'appenders', '')
+        config.set('main', 'tempdir', self.tempdir)
+
+        self.mc = MainController(config)
+        self.mc.propagate_core_defaults()
+        self.mc.load_plugins()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        shutil.rmtree(self.tempdir)
+
+    def _add_blocking_task(self, pool):
+        """netcat session which waits for the client to send the message"""
+        client, server = socket.socketpair()
+        self.clients.append(client)
+        pool.add_task_from_socket(server, 'fuglu.connectors.ncconnector', 'NCHandler', 0)
+
+    def test_scale_up(self):
+        """Threads are added immediately for waiting tasks"""
+        pool = ThreadPool(self.mc, minthreads=1, maxthreads=5, queuesize=10, target_latency=0.05)
+        try:
+            time.sleep(0.1)
+            for _ in range(4):
+                self._add_blocking_task(pool)
+
+            timeout = time.time() + 3.0
+            while len(pool.workers) < 4 and time.time() < timeout:
+                time.sleep(0.01)
+            self.assertEqual(4, len(pool.workers))
+            self.assertTrue(len(pool.decisions) > 0)
+            self.assertEqual('add', pool.decisions[-1]['action'])
+        finally:
+            for client in self.clients:
+                client.shutdown(socket.SHUT_WR)
+            pool.shutdown()
+
+    def test_scale_down_after_burst(self):
+        """The queue wait of a past burst doesn't keep idle threads alive"""
+        pool = ThreadPool(self.mc, minthreads=1, maxthreads=3, queuesize=10, target_latency=0.05)
+        try:
+            # last tasks of the burst waited long, then nothing was dequeued for a while
+            pool.queue_wait_ewma = 1.0
+            pool.lastdequeue = time.time() - 30 * pool.autoscale_interval
+            self.assertTrue(pool.queue_wait_average() < pool.target_latency / 2.0)
+            pool._add_worker(2)
+
+            timeout = time.time() + 3.0
+            while len(pool.workers) > 2 and time.time() < timeout:
+                time.sleep(0.01)
+            self.assertEqual(2, len(pool.workers))
+            self.assertEqual('remove', pool.decisions[-1]['action'])
+        finally:
+            pool.shutdown()
+
+    def test_fixed_size(self):
+        """minthreads == maxthreads gives a pool of fixed size"""
+        pool = ThreadPool(self.mc, minthreads=1, maxthreads=1, queuesize=10, target_latency=0.05)
+        try:
+            for _ in range(3):
+                self._add_blocking_task(pool)
+            time.sleep(0.2)
+            self.assertEqual(1, len(pool.workers))
+        finally:
+            for client in self.clients:
+                client.shutdown(socket.SHUT_WR)
+            pool.shutdown()
+
+    def test_wait_for_room(self):
+        """Waiting for room in the queue ends once a thread takes a task"""
+        pool = ThreadPool(self.mc, minthreads=1, maxthreads=1, queuesize=10)
+        try:
+            for _ in range(2):
+                self._add_blocking_task(pool)
+            self.assertFalse(pool.wait_for_room(1, timeout=0.2))
+
+            self.clients[0].shutdown(socket.SHUT_WR)
+            start = time.time()
+            self.assertTrue(pool.wait_for_room(1, timeout=3.0))
+            self.assertTrue(time.time() - start < 1.0)
+        finally:
+            for client in self.clients[1:]:
+                client.shutdown(socket.SHUT_WR)
+            pool.shutdown()
+
+
+class AdmissionControlTest(unittest.TestCase):
+    """Test refusing connections while the threadpool is saturated"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='fuglu-admission-test')
+        config = RawConfigParser()
+        config.add_section("main")
+        config.set('main', 'plugins', '')
+        config.set('main', 'prependers', '')
+        config.set('main', 'appenders', '')
+        config.set('main', 'tempdir', self.tempdir)
+        config.add_section("performance")
+        config.set('performance', 'admission_max_queue', '1')
+
+        self.mc = MainController(config)
+        self.mc.propagate_core_defaults()
+        self.mc.load_plugins()
+        self.mc.threadpool = ThreadPool(self.mc, minthreads=1, maxthreads=2, queuesize=10, target_latency=0.05)
+        self.server = BasicTCPServer(self.mc, port=0, address='127.0.0.1', protohandlerclass=NCHandler)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.shutdown()
+        self.mc.threadpool.shutdown()
+        shutil.rmtree(self.tempdir)
+
+    def _connect(self):
+        client, server = socket.socketpair()
+        client.settimeout(5)
+        self.clients.append(client)
+        self.server.handle_connection(server)
+        return client
+
+    def test_refuse(self):
+        """New connections are deferred immediately once the queue limit is reached"""
+        # block all threads
+        self._connect()
+        self._connect()
+        timeout = time.time() + 3.0
+        while (self.mc.threadpool.queue_depth() > 0 or len(self.mc.threadpool.workers) < 2) and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertIsNone(self.mc.admission_check())
+        self._connect()  # waits in the queue
+        self.assertIsNotNone(self.mc.admission_check())
+
+        refused_before = Statskeeper().refusedcount
+        client = self._connect()
+        answer = client.recv(1024)
+        self.assertTrue(answer.startswith(b"DEFER:"), answer)
+        self.assertEqual(b"", client.recv(1024))
+        self.assertEqual(refused_before + 1, Statskeeper().refusedcount)
+
+        for client in self.clients:
+            client.shutdown(socket.SHUT_WR)
+
+    def test_recover(self):
+        """Connections are accepted again once the queue has drained"""
+        self.mc.config.set('performance', 'admission_max_queue', '0')
+        self.mc.config.set('performance', 'admission_max_wait', '0.5')
+        pool = self.mc.threadpool
+
+        # block all threads
+        self._connect()
+        self._connect()
+        timeout = time.time() + 3.0
+        while (pool.queue_depth() > 0 or pool._idle_workers() or len(pool.workers) < 2) and time.time() < timeout:
+            time.sleep(0.01)
+        # the last tasks waited long
+        pool.queue_wait_ewma = 0.8
+        pool.lastdequeue = time.time()
+        self.assertIsNotNone(self.mc.admission_check())
+
+        for client in self.clients:
+            client.shutdown(socket.SHUT_WR)
+        timeout = time.time() + 3.0
+        while self.mc.admission_check() is not None and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertIsNone(self.mc.admission_check())